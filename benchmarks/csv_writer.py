@@ -0,0 +1,94 @@
+'''\
+Time the csv encoding of batches: unicodecsv.DictWriter against
+BatchCsvWriter, on synthetic rows.  The outputs are checked to be the same.
+
+    python benchmarks/csv_writer.py [--rows N] [--batch-size N]
+'''
+
+import argparse
+import random
+import time
+from cStringIO import StringIO
+
+import unicodecsv
+
+from complex_xml_to_csvs.csv_writer import BatchCsvWriter
+
+
+FIELDS = [
+    'ceg_id', 'alrovat_id', 'nev', 'cim', 'kelt', 'hatalyos', 'bejegyzes',
+    'torles', 'megjegyzes'
+]
+WORDS = [
+    u'Kft.', u'Zrt.', u'Budapest', u'utca', u'\u0151rs\xe9g', u't\xfck\xf6r',
+    u'"Alfa"', u'1,5', u'sor\nt\xf6r\xe9s', u'2014.01.01', u''
+]
+
+
+def synthetic_rows(count):
+    rng = random.Random(0)
+    rows = []
+    for i in xrange(count):
+        row = {
+            field: u' '.join(rng.choice(WORDS) for _ in range(3))
+            for field in FIELDS[2:]
+        }
+        row['ceg_id'] = u'{0:010d}'.format(i // 5)
+        row['alrovat_id'] = unicode(i % 5)
+        rows.append(row)
+    return rows
+
+
+def batches(rows, batch_size):
+    for start in xrange(0, len(rows), batch_size):
+        yield rows[start:start + batch_size]
+
+
+def with_unicodecsv(rows, batch_size):
+    f = StringIO()
+    for batch in batches(rows, batch_size):
+        writer = unicodecsv.DictWriter(f, FIELDS)
+        writer.writerows(batch)
+    return f.getvalue()
+
+
+def with_batch_writer(rows, batch_size):
+    f = StringIO()
+    for batch in batches(rows, batch_size):
+        writer = BatchCsvWriter(FIELDS)
+        f.write(writer.encode_rows(batch))
+    return f.getvalue()
+
+
+def timed(function, *args):
+    best = None
+    for _ in range(3):
+        start = time.time()
+        result = function(*args)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    rows = synthetic_rows(args.rows)
+    expected, old_time = timed(with_unicodecsv, rows, args.batch_size)
+    output, new_time = timed(with_batch_writer, rows, args.batch_size)
+    assert output == expected, 'outputs differ'
+
+    print('{0} rows, {1} bytes'.format(len(rows), len(output)))
+    print('unicodecsv.DictWriter: {0:.3f} s'.format(old_time))
+    print('BatchCsvWriter:        {0:.3f} s'.format(new_time))
+    print('speedup: {0:.1f}x'.format(old_time / new_time))
+
+
+if __name__ == '__main__':
+    main()
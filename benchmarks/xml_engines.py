@@ -0,0 +1,132 @@
+'''\
+Time the conversion of ISO8859-2 xml by the sax and expat engines, to utf-8
+and ISO8859-2 csv, on synthetic cegs (or the xml files given).  Rows are
+encoded as by complex-xml-to-csvs, but kept in memory.  The outputs of the
+engines are checked to be the same.
+
+    python benchmarks/xml_engines.py [--cegs N] [XML_FILE...]
+'''
+
+import argparse
+import random
+import time
+from cStringIO import StringIO
+
+from complex_xml_to_csvs.complex_xml_to_csvs import (
+    ENGINES, FileProcessor, open_file, table_name, BATCH_SIZE
+)
+from complex_xml_to_csvs.record_processors import (
+    BatchMakerRecordProcessor, BatchProcessor
+)
+from complex_xml_to_csvs.csv_writer import BatchCsvWriter
+
+
+ENCODINGS = ['utf-8', 'iso8859-2']
+WORDS = [
+    'Kft.', 'Budapest', 'utca', '\xf5rs\xe9g', 't\xfck\xf6r', '&quot;A&quot;',
+    '1,5', '2014.01.01', '\xc1rv\xedzt\xfbr\xf5'
+]
+
+
+def synthetic_xml(ceg_count):
+    rng = random.Random(0)
+    output = StringIO()
+    output.write('<?xml version="1.0" encoding="ISO8859-2" ?>\n<export>\n')
+    for ceg_id in xrange(ceg_count):
+        output.write('<ceg id="{0:010d}">\n'.format(ceg_id))
+        for rovat_id in range(1 + ceg_id % 5):
+            output.write('<rovat id="{0}">\n'.format(rovat_id))
+            for alrovat_id in range(1, 1 + ceg_id % 3):
+                output.write('<alrovat id="{0}">\n'.format(alrovat_id))
+                for mezo_id in ('nev', 'cim', 'kelt'):
+                    output.write(
+                        '<mezo id="{0}">{1}<ujsor/>{2}</mezo>\n'.format(
+                            mezo_id,
+                            ' '.join(rng.choice(WORDS) for _ in range(3)),
+                            rng.choice(WORDS)
+                        )
+                    )
+                output.write('</alrovat>\n')
+            output.write('</rovat>\n')
+        output.write('</ceg>\n')
+    output.write('</export>\n')
+    return output.getvalue()
+
+
+class EncodingBatchProcessor(BatchProcessor):
+
+    '''Encode the rows of batches like CsvSplitter, into memory'''
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.output = StringIO()
+
+    def process(self, batch):
+        rows_per_tables = {}
+        for record in batch:
+            for rovat, alrovats in record.iteritems():
+                if rovat == 'ceg_id':
+                    continue
+                rows = rows_per_tables.setdefault(table_name(rovat), [])
+                for alrovat in alrovats:
+                    rows.append(dict(alrovat, ceg_id=record['ceg_id']))
+        for table, rows in sorted(rows_per_tables.items()):
+            fields = ['ceg_id', 'alrovat_id', 'nev', 'cim', 'kelt']
+            self.output.write(
+                BatchCsvWriter(fields, self.encoding).encode_rows(rows)
+            )
+
+
+def convert(documents, engine, encoding):
+    batch_processor = EncodingBatchProcessor(encoding)
+    file_processor = FileProcessor(
+        BatchMakerRecordProcessor(BATCH_SIZE, batch_processor),
+        ENGINES[engine]
+    )
+    for document in documents:
+        file_processor.process(StringIO(document))
+    return batch_processor.output.getvalue()
+
+
+def timed(function, *args):
+    best = None
+    for _ in range(3):
+        start = time.time()
+        result = function(*args)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('--cegs', type=int, default=20000)
+    parser.add_argument('xml_files', nargs='*')
+    args = parser.parse_args()
+
+    if args.xml_files:
+        documents = []
+        for fname in args.xml_files:
+            with open_file(fname) as f:
+                documents.append(f.read())
+    else:
+        documents = [synthetic_xml(args.cegs)]
+
+    print('{0} bytes of xml'.format(sum(len(d) for d in documents)))
+    for encoding in ENCODINGS:
+        outputs = {}
+        for engine in sorted(ENGINES, reverse=True):
+            outputs[engine], seconds = timed(
+                convert, documents, engine, encoding
+            )
+            print(
+                '{0:5} -> {1:9}: {2:.3f} s'.format(engine, encoding, seconds)
+            )
+        assert len(set(outputs.values())) == 1, 'outputs differ'
+
+
+if __name__ == '__main__':
+    main()
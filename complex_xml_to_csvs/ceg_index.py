@@ -0,0 +1,283 @@
+'''Index of the csv rows by ceg_id
+
+The rows of a ceg are contiguous in every csv file written, so their place
+is recorded while writing: a tab separated line per ceg and csv file
+
+    ceg_id    csv file (relative to OUTPUT_DIR)    byte offset    byte length
+
+is appended to the OUTPUT_DIR/rovat_N.idx.log file of the table.  At the end
+of the run the appended lines are merged into OUTPUT_DIR/rovat_N.idx, which
+has the same lines sorted by ceg_id: it is searched by bisection in a memory
+map, a lookup does not read the whole index.
+
+ceg-lookup reads the rows of cegs from the csv files by the index.
+'''
+
+import argparse
+import heapq
+import os
+import sys
+
+
+INDEX_SUFFIX = '.idx'
+LOG_SUFFIX = '.log'
+
+
+def index_name(output_dir, table_name):
+    return os.path.join(output_dir, table_name + INDEX_SUFFIX)
+
+
+def log_name(output_dir, table_name):
+    '''The file of the entries appended since the index was merged'''
+    return index_name(output_dir, table_name) + LOG_SUFFIX
+
+
+def format_entries(entries):
+    return ''.join(
+        '{0}\t{1}\t{2}\t{3}\n'.format(ceg_id, path, offset, length)
+        for ceg_id, path, offset, length in entries
+    )
+
+
+def append_entries(index_fname, entries):
+    data = format_entries(entries)
+    # a single write on an O_APPEND descriptor: parallel writers do not mix
+    fd = os.open(index_fname, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+
+def parse_entry(line):
+    ceg_id, path, offset, length = line.rstrip('\n').split('\t')
+    return ceg_id, path, int(offset), int(length)
+
+
+def read_entries(index_fname):
+    with open(index_fname, 'rb') as f:
+        for line in f:
+            yield parse_entry(line)
+
+
+def append_shifted_index(index_fname, final_index_fname, shift):
+    '''Append the index of a csv appended to the final csv at shift'''
+    append_entries(
+        final_index_fname,
+        [
+            (ceg_id, path, offset + shift, length)
+            for ceg_id, path, offset, length in read_entries(index_fname)
+        ]
+    )
+
+
+class CegIndexWriter(object):
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+
+    def write(self, table_name, csv_name, entries):
+        '''Record (ceg_id, offset, length) entries of the table csv_name'''
+        path = os.path.relpath(csv_name, self.output_dir)
+        append_entries(
+            log_name(self.output_dir, table_name),
+            [
+                (ceg_id, path, offset, length)
+                for ceg_id, offset, length in entries
+            ]
+        )
+
+
+def keyed_lines(lines, source):
+    '''(ceg_id, source, position, line) of the lines, to merge them'''
+    for position, line in enumerate(lines):
+        yield line[:line.index('\t')], source, position, line
+
+
+def merge_index(output_dir, table_name):
+    '''Merge the appended entries of table_name into its sorted index
+
+    Entries of the same ceg_id keep their order.
+    '''
+    log_fname = log_name(output_dir, table_name)
+    if not os.path.exists(log_fname):
+        return
+    index_fname = index_name(output_dir, table_name)
+    with open(log_fname, 'rb') as f:
+        appended = sorted(keyed_lines(f, 1))
+    tmp_fname = index_fname + '.new'
+    with open(tmp_fname, 'wb') as output:
+        if os.path.exists(index_fname):
+            with open(index_fname, 'rb') as f:
+                for _, _, _, line in heapq.merge(
+                        keyed_lines(f, 0), appended):
+                    output.write(line)
+        else:
+            for _, _, _, line in appended:
+                output.write(line)
+    os.rename(tmp_fname, index_fname)
+    os.remove(log_fname)
+
+
+def index_table_names(output_dir):
+    '''Tables with an index, merged or not'''
+    return sorted(set(
+        fname[:-len(INDEX_SUFFIX)]
+        for fname in os.listdir(output_dir)
+        if fname.endswith(INDEX_SUFFIX)
+    ) | set(
+        fname[:-len(INDEX_SUFFIX + LOG_SUFFIX)]
+        for fname in os.listdir(output_dir)
+        if fname.endswith(INDEX_SUFFIX + LOG_SUFFIX)
+    ))
+
+
+def merge_indexes(output_dir):
+    '''Merge the entries appended in the run into the sorted indexes'''
+    for table_name in index_table_names(output_dir):
+        merge_index(output_dir, table_name)
+
+
+class SortedIndex(object):
+
+    '''Read only access to a sorted index file'''
+
+    def __init__(self, fname):
+        import mmap
+
+        self.file = open(fname, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        # an empty file can not be mapped
+        self.map = (
+            mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            if size else b''
+        )
+
+    def key(self, start):
+        return self.map[start:self.map.find('\t', start)]
+
+    def line_end(self, start):
+        return self.map.find('\n', start) + 1
+
+    def find(self, ceg_id):
+        '''Start of the first line with a ceg_id not less than ceg_id'''
+        low, high = 0, len(self.map)
+        # low and high are line starts
+        while low < high:
+            start = self.map.rfind('\n', low, (low + high) // 2) + 1 or low
+            if self.key(start) < ceg_id:
+                low = self.line_end(start)
+            else:
+                high = start
+        return low
+
+    def entries(self, ceg_id):
+        '''Generate the entries of ceg_id'''
+        start = self.find(ceg_id)
+        while start < len(self.map) and self.key(start) == ceg_id:
+            end = self.line_end(start)
+            yield parse_entry(self.map[start:end])
+            start = end
+
+    def close(self):
+        if self.map:
+            self.map.close()
+        self.file.close()
+
+
+def index_entries(output_dir, table_name, ceg_ids):
+    '''Entries of ceg_ids: of the sorted index, then of the appended ones'''
+    index_fname = index_name(output_dir, table_name)
+    if os.path.exists(index_fname):
+        index = SortedIndex(index_fname)
+        try:
+            for ceg_id in sorted(ceg_ids):
+                for entry in index.entries(ceg_id):
+                    yield entry
+        finally:
+            index.close()
+    log_fname = log_name(output_dir, table_name)
+    if os.path.exists(log_fname):
+        for entry in read_entries(log_fname):
+            if entry[0] in ceg_ids:
+                yield entry
+
+
+def lookup(output_dir, table_name, ceg_ids):
+    '''Generate (csv path, rows) for the ceg_ids in table_name'''
+    ceg_ids = set(ceg_ids)
+    for ceg_id, path, offset, length in index_entries(
+            output_dir, table_name, ceg_ids):
+        with open(os.path.join(output_dir, path), 'rb') as f:
+            f.seek(offset)
+            yield path, f.read(length)
+
+
+def read_header(csv_fname):
+    with open(csv_fname, 'rb') as f:
+        return f.readline()
+
+
+def write_rows(output_dir, table_name, ceg_ids, output, title=False):
+    header_written = False
+    for path, rows in lookup(output_dir, table_name, ceg_ids):
+        if not header_written:
+            if title:
+                output.write('==> {0} <==\n'.format(table_name))
+            output.write(read_header(os.path.join(output_dir, path)))
+            header_written = True
+        output.write(rows)
+    return header_written
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description='Print the csv rows of cegs using the ceg_id index'
+    )
+
+    parser.add_argument(
+        '--output-dir',
+        default='output',
+        help=(
+            'directory of the converted csv files and their index'
+            ' (default: %(default)s)'
+        )
+    )
+    parser.add_argument(
+        '--table',
+        help=(
+            'print rows of this table only, e.g. rovat_3'
+            ' (default: all tables, each with a title line)'
+        )
+    )
+    parser.add_argument(
+        'ceg_ids',
+        nargs='+',
+        metavar='ceg_id',
+        help='ceg id to look up'
+    )
+
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+
+    if args.table:
+        found = write_rows(
+            args.output_dir, args.table, args.ceg_ids, sys.stdout
+        )
+    else:
+        found = False
+        for table_name in index_table_names(args.output_dir):
+            found = write_rows(
+                args.output_dir, table_name, args.ceg_ids, sys.stdout,
+                title=True
+            ) or found
+
+    if not found:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+'''Ceg level changes between deliveries
+
+The content hash of every converted ceg is stored in a hash database, so
+the next delivery can be converted to the new and changed cegs only, and
+the ids of the cegs no longer delivered can be listed.
+
+The database is a file of fixed size (ceg_id, digest) records sorted by
+ceg_id, searched by bisection in a memory map: it is compact and needs no
+loading.  Every conversion (file or chunk) writes the hashes it has seen
+into a sorted part file next to the database, the parts are merged into
+the new database at the end of the run.  A ceg_id seen more than once
+keeps its first record: that of the earliest conversion, and within a
+conversion the earliest one.
+'''
+
+import hashlib
+import heapq
+import mmap
+import os
+import shutil
+
+
+ID_WIDTH = 20
+DIGEST_SIZE = 16
+RECORD_SIZE = ID_WIDTH + DIGEST_SIZE
+PARTS_SUFFIX = '.parts'
+
+
+def as_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return value.encode('utf-8')
+
+
+def content_hash(document):
+    '''Digest of a State.document, independent of the order of rovats/mezos
+    '''
+    digest = hashlib.md5()
+    for rovat in sorted(document):
+        if rovat == 'ceg_id':
+            continue
+        digest.update(b'\x01' + as_bytes(rovat))
+        for alrovat in document[rovat]:
+            digest.update(b'\x02')
+            for mezo in sorted(alrovat):
+                digest.update(
+                    b'\x03' + as_bytes(mezo) + b'\x00'
+                    + as_bytes(alrovat[mezo])
+                )
+    return digest.digest()
+
+
+def record_key(ceg_id):
+    key = as_bytes(ceg_id)
+    if len(key) > ID_WIDTH:
+        raise ValueError('ceg_id too long: {0!r}'.format(ceg_id))
+    return key.ljust(ID_WIDTH, b'\0')
+
+
+def ceg_id_of(record):
+    return record[:ID_WIDTH].rstrip(b'\0')
+
+
+def parts_dir(database_fname):
+    return database_fname + PARTS_SUFFIX
+
+
+def part_name(database_fname, base_fname):
+    '''base_fname starts with the sequence of its conversion: NNNNNN.name
+
+    The parts are merged in the order of their conversions.
+    '''
+    return os.path.join(parts_dir(database_fname), base_fname)
+
+
+def part_sequence(fname):
+    return int(fname.partition('.')[0])
+
+
+def remove_parts(database_fname):
+    shutil.rmtree(parts_dir(database_fname), ignore_errors=True)
+
+
+class HashDatabase(object):
+
+    '''Read only access to a hash database file'''
+
+    def __init__(self, fname):
+        self.file = open(fname, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        assert size % RECORD_SIZE == 0, fname
+        self.count = size // RECORD_SIZE
+        # an empty file can not be mapped
+        self.map = (
+            mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            if size else b''
+        )
+
+    def __len__(self):
+        return self.count
+
+    def record(self, position):
+        start = position * RECORD_SIZE
+        return self.map[start:start + RECORD_SIZE]
+
+    def get(self, ceg_id):
+        '''The digest of ceg_id, None if it is not in the database'''
+        key = record_key(ceg_id)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            start = middle * RECORD_SIZE
+            if self.map[start:start + ID_WIDTH] < key:
+                low = middle + 1
+            else:
+                high = middle
+        record = self.record(low)
+        if record[:ID_WIDTH] == key:
+            return record[ID_WIDTH:]
+        return None
+
+    def __iter__(self):
+        for position in xrange(self.count):
+            yield self.record(position)
+
+    def close(self):
+        if self.count:
+            self.map.close()
+        self.file.close()
+
+
+def write_records(fname, records):
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'wb') as f:
+        for record in records:
+            f.write(record)
+    os.rename(tmp_fname, fname)
+
+
+def read_records(fname):
+    with open(fname, 'rb') as f:
+        while True:
+            record = f.read(RECORD_SIZE)
+            if not record:
+                return
+            yield record
+
+
+class HashCollector(object):
+
+    '''Collect the hashes of a conversion into a part file'''
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.records = []
+
+    def add(self, ceg_id, digest):
+        self.records.append(record_key(ceg_id) + digest)
+
+    def close(self):
+        dirname = os.path.dirname(self.fname)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # created by a parallel conversion
+                pass
+        # stable: repeated ceg_ids stay in the order they were seen
+        self.records.sort(key=lambda record: record[:ID_WIDTH])
+        write_records(self.fname, self.records)
+        self.records = []
+
+
+def unique_records(records):
+    '''Drop repeated ceg_ids of records sorted by ceg_id, keep the first'''
+    last_key = None
+    for record in records:
+        key = record[:ID_WIDTH]
+        if key != last_key:
+            yield record
+            last_key = key
+
+
+def ordered_records(fname, position):
+    # ties of ceg_ids are broken by the position of the part, not the digest
+    for record in read_records(fname):
+        yield record[:ID_WIDTH], position, record
+
+
+def merged_parts(database_fname):
+    directory = parts_dir(database_fname)
+    part_fnames = [
+        os.path.join(directory, fname)
+        for fname in (
+            sorted(os.listdir(directory), key=part_sequence)
+            if os.path.isdir(directory) else []
+        )
+    ]
+    merged = heapq.merge(*[
+        ordered_records(fname, position)
+        for position, fname in enumerate(part_fnames)
+    ])
+    return part_fnames, unique_records(record for _, _, record in merged)
+
+
+def deleted_ceg_ids(old_records, new_records):
+    '''ceg_ids of sorted old_records missing from sorted new_records'''
+    new_keys = (record[:ID_WIDTH] for record in new_records)
+    new_key = next(new_keys, None)
+    for old_record in old_records:
+        old_key = old_record[:ID_WIDTH]
+        while new_key is not None and new_key < old_key:
+            new_key = next(new_keys, None)
+        if new_key != old_key:
+            yield ceg_id_of(old_record)
+
+
+def update_database(database_fname, deleted_fname):
+    '''Merge the parts into the new database, list the deleted ceg_ids
+
+    Returns the number of deleted ceg_ids.
+    '''
+    part_fnames, records = merged_parts(database_fname)
+    tmp_fname = database_fname + '.new'
+    write_records(tmp_fname, records)
+
+    deleted = 0
+    with open(deleted_fname, 'wb') as deleted_file:
+        if os.path.exists(database_fname):
+            old_database = HashDatabase(database_fname)
+            new_database = HashDatabase(tmp_fname)
+            try:
+                for ceg_id in deleted_ceg_ids(old_database, new_database):
+                    deleted_file.write(ceg_id + b'\n')
+                    deleted += 1
+            finally:
+                old_database.close()
+                new_database.close()
+
+    os.rename(tmp_fname, database_fname)
+    for fname in part_fnames:
+        os.remove(fname)
+    if part_fnames:
+        os.rmdir(parts_dir(database_fname))
+    return deleted
@@ -0,0 +1,120 @@
+'''Split Complex's XML into smaller, independently parsable documents
+
+Every chunk is a complete XML document with the original declaration and
+<export> element, containing whole <ceg> elements only, so chunks can be
+converted in parallel and their output concatenated in order.
+
+As "<" can not appear in character data or attribute values, the start of
+a <ceg> element can be found without parsing.
+'''
+
+import re
+
+
+CEG_START = b'<ceg'
+CEG_START_FOLLOWERS = b' \t\r\n>'
+EXPORT_END = b'</export>\n'
+CEG_ID = re.compile(br'<ceg\s[^>]*\bid\s*=\s*["\']([^"\']*)')
+
+
+def is_ceg_start(data, position):
+    next_position = position + len(CEG_START)
+    return (
+        next_position < len(data)
+        and data[next_position:next_position + 1] in CEG_START_FOLLOWERS
+    )
+
+
+def find_ceg_start(data, start=0):
+    position = data.find(CEG_START, start)
+    while position >= 0 and not is_ceg_start(data, position):
+        position = data.find(CEG_START, position + 1)
+    return position
+
+
+def rfind_ceg_start(data):
+    position = data.rfind(CEG_START)
+    while position >= 0 and not is_ceg_start(data, position):
+        position = data.rfind(CEG_START, 0, position)
+    return position
+
+
+def ceg_chunks(input_source, chunk_size):
+    '''Generate XML documents of about chunk_size bytes from input_source
+
+    A <ceg> larger than chunk_size is not split, it makes a larger chunk.
+    '''
+    head = None
+    data = b''
+    while True:
+        block = input_source.read(chunk_size)
+        data += block
+        if head is None:
+            ceg_start = find_ceg_start(data)
+            if ceg_start < 0:
+                if block:
+                    continue
+                # no <ceg> at all
+                if data:
+                    yield data
+                return
+            head, data = data[:ceg_start], data[ceg_start:]
+
+        if not block:
+            if data:
+                yield head + data
+            return
+
+        if len(data) < chunk_size:
+            continue
+        ceg_start = rfind_ceg_start(data)
+        if ceg_start > 0:
+            yield head + data[:ceg_start] + EXPORT_END
+            data = data[ceg_start:]
+
+
+def ceg_id_of(record):
+    match = CEG_ID.match(record)
+    return match.group(1) if match else None
+
+
+def ceg_records(input_source, block_size=1 << 20):
+    '''Generate (head, byte offset, record) for every <ceg> of input_source
+
+    head is the start of the document before the first <ceg>, record is the
+    raw <ceg> element with the white space following it.  The elements are
+    not checked, a record is just the data between two <ceg> starts.
+    '''
+    head = None
+    # position of data in input
+    offset = 0
+    data = b''
+    while True:
+        block = input_source.read(block_size)
+        data += block
+        if head is None:
+            ceg_start = find_ceg_start(data)
+            if ceg_start < 0:
+                if block:
+                    continue
+                return
+            head, data = data[:ceg_start], data[ceg_start:]
+            offset = ceg_start
+
+        start = 0
+        next_start = find_ceg_start(data, 1)
+        while next_start >= 0:
+            yield head, offset + start, data[start:next_start]
+            start = next_start
+            next_start = find_ceg_start(data, start + 1)
+
+        if not block:
+            end = data.rfind(EXPORT_END.rstrip())
+            if end < start:
+                end = len(data)
+            if start < end:
+                yield head, offset + start, data[start:end]
+            return
+
+        offset += start
+        data = data[start:]
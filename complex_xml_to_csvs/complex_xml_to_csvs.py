@@ -1,40 +1,89 @@
 import argparse
 
+import codecs
+import copy
 import os
-import gzip
+import signal
 
 import xml.sax
 import sys
+import time
+from cStringIO import StringIO
 
-import complex_schema
 import logging
+from collections import namedtuple, Counter, defaultdict
 
 log = logging.getLogger('complex_xml_to_csvs')
 
 
 # classes that do something with the data
 from record_processors import (
+    RequiredNumberOfRecordsRead,
     CountLimitingRecordProcessor,
+    CountingRecordProcessor,
+    CollectingRecordProcessor,
     BatchMakerRecordProcessor,
-    CsvSplitter
+    ChangeFilteringRecordProcessor,
+    CsvSplitter,
+    CsvAppender,
+    PartitioningCsvAppender,
+    TransformingBatchProcessor,
+    SortingBatchProcessor,
+    table_name
 )
+# the modules of the optional features are imported when used
+from pipeline import (
+    RECORDS, BATCHES, Context, InvalidPipeline,
+    register_stage, build_pipeline, stage_names, import_stage_modules,
+    read_stage_file,
+)
+
 
+MEGABYTE = 1 << 20
+# of --changes, in OUTPUT_DIR
+DELETED_FNAME = 'deleted_ceg_ids.txt'
+# of the streams of --listen, without --chunk-size
+STREAM_CHUNK_SIZE = 4 * MEGABYTE
+BATCH_SIZE = 1000
+# of the reads of the expat engine
+PARSE_BLOCK_SIZE = 64 * 1024
 
 STATES = 'export/ceg/rovat/alrovat/mezo/ujsor'.split('/')
+ELEMENTS_WITH_ID = set('ceg/rovat/alrovat/mezo'.split('/'))
+ENCODING = 'ISO8859-2'
+# what to do with a rovat repeated in a ceg, or a mezo in an alrovat:
+# stop, keep the first or the last one, or concatenate them (the rows of
+# rovats, the text of mezos - separated by a line break)
+DUPLICATE_POLICIES = ('error', 'first', 'last', 'concat')
+MEZO_SEPARATOR = '\n'
 
 
 class InvalidHierarchy(xml.sax.SAXParseException):
     pass
 
 
+class DuplicateId(ValueError):
+    pass
+
+
+class DuplicateElement(xml.sax.SAXParseException):
+    pass
+
+
 class State:
 
-    def __init__(self, record_processor=None):
+    def __init__(self, record_processor=None, duplicates='last', counts=None):
         self.document = None
         self.rovat = None
         self.alrovat = None
+        # the text of the current mezo goes to mezos[mezo_id]: the alrovat,
+        # or a throw-away dict for an ignored duplicate
+        self.mezos = None
 
         self.record_processor = record_processor
+        self.duplicates = duplicates
+        # duplicate_rovats, duplicate_mezos
+        self.counts = Counter() if counts is None else counts
 
         self.index = 0
         self.ceg_id = None
@@ -56,6 +105,12 @@ class State:
 
     def start_rovat(self, rovat_id):
         self.rovat = []
+        if rovat_id in self.document:
+            self.count_duplicate('duplicate_rovats', 'rovat', rovat_id)
+            if self.duplicates == 'first':
+                return
+            if self.duplicates == 'concat':
+                self.rovat = self.document[rovat_id]
         self.document[rovat_id] = self.rovat
 
     def start_alrovat(self, alrovat_id):
@@ -64,10 +119,27 @@ class State:
 
     def start_mezo(self, mezo_id):
         self.mezo_id = mezo_id
+        self.mezos = self.alrovat
+        if mezo_id in self.alrovat:
+            self.count_duplicate('duplicate_mezos', 'mezo', mezo_id)
+            if self.duplicates == 'first':
+                self.mezos = {mezo_id: ''}
+                return
+            if self.duplicates == 'concat':
+                self.alrovat[mezo_id] += MEZO_SEPARATOR
+                return
         self.alrovat[mezo_id] = ''
 
+    def count_duplicate(self, counter, name, element_id):
+        self.counts[counter] += 1
+        if self.duplicates == 'error':
+            raise DuplicateId(
+                'duplicate {0} {1} in ceg {2}'
+                .format(name, element_id, self.ceg_id)
+            )
+
     def append_mezo(self, characters):
-        self.alrovat[self.mezo_id] += characters
+        self.mezos[self.mezo_id] += characters
 
     def record_complete(self):
         self.record_processor.process(self.document)
@@ -89,7 +161,10 @@ class ComplexXMLHandler(xml.sax.handler.ContentHandler):
                 self._locator
             )
         assert name in self.handlers, name
-        self.handlers[name].start(name, attrs, self.state)
+        try:
+            self.handlers[name].start(name, attrs, self.state)
+        except DuplicateId as e:
+            raise DuplicateElement(str(e), e, self._locator)
         self.state.index += 1
 
     def endElement(self, name):
@@ -174,29 +249,369 @@ def xml_handler_map():
     )
 
 
+class ExpatLocator(xml.sax.xmlreader.Locator):
+
+    def __init__(self, parser, system_id=None):
+        self.parser = parser
+        self.system_id = system_id
+
+    def getColumnNumber(self):
+        return self.parser.CurrentColumnNumber
+
+    def getLineNumber(self):
+        return self.parser.CurrentLineNumber
+
+    def getSystemId(self):
+        return self.system_id
+
+
+def expat_parse(input_source, handler, block_size=PARSE_BLOCK_SIZE):
+    '''Parse input_source (a file) with expat directly, driving handler
+
+    Text is not decoded to unicode: handler gets utf-8 encoded str, expat
+    transcodes it from the encoding declared by the xml in C.  Parse errors
+    are raised as SAXParseException, like by xml.sax.parse, located in the
+    file name of input_source.
+    '''
+    parser = ExpatFeedParser(
+        handler, block_size, getattr(input_source, 'name', None)
+    )
+    for block in iter(lambda: input_source.read(block_size), ''):
+        parser.feed(block)
+    parser.close()
+
+
+class ExpatFeedParser(object):
+
+    '''Incremental expat parser driving handler, see expat_parse'''
+
+    def __init__(
+            self, handler, block_size=PARSE_BLOCK_SIZE, system_id=None):
+        import xml.parsers.expat
+
+        self.parser = parser = xml.parsers.expat.ParserCreate()
+        parser.returns_unicode = False
+        parser.buffer_text = True
+        parser.buffer_size = block_size
+        self.locator = ExpatLocator(parser, system_id)
+        handler.setDocumentLocator(self.locator)
+        parser.StartElementHandler = handler.startElement
+        parser.EndElementHandler = handler.endElement
+        parser.CharacterDataHandler = handler.characters
+
+    def parse(self, data, is_final):
+        import xml.parsers.expat
+
+        try:
+            self.parser.Parse(data, is_final)
+        except xml.parsers.expat.ExpatError as e:
+            raise xml.sax.SAXParseException(
+                xml.parsers.expat.ErrorString(e.code), e, self.locator
+            )
+
+    def feed(self, data):
+        self.parse(data, False)
+
+    def close(self):
+        self.parse('', True)
+
+
+def sax_feed_parser(handler, block_size=PARSE_BLOCK_SIZE):
+    parser = xml.sax.make_parser()
+    parser.setContentHandler(handler)
+    return parser
+
+
+# name -> function parsing a file with a sax handler
+ENGINES = dict(
+    sax=xml.sax.parse,
+    expat=expat_parse,
+)
+# name -> incremental parser (with feed and close) for a sax handler
+FEED_PARSERS = dict(
+    sax=sax_feed_parser,
+    expat=ExpatFeedParser,
+)
+
+
+def iter_records(path, engine='sax', block_size=PARSE_BLOCK_SIZE):
+    '''Generate the records (State.document dicts) of an xml file
+
+    path is a file name (.gz files are decompressed) or a file object.  The
+    input is parsed block_size bytes at a time, only the records of a block
+    are kept in memory.  Parse errors are raised.  Stopping early - by
+    itertools.islice, break or close() - closes the file.
+    '''
+    records = CollectingRecordProcessor()
+    parser = FEED_PARSERS[engine](
+        ComplexXMLHandler(xml_handler_map(), State(records)), block_size
+    )
+    input_source = path if hasattr(path, 'read') else open_file(path)
+    try:
+        while True:
+            block = input_source.read(block_size)
+            if block:
+                parser.feed(block)
+            else:
+                parser.close()
+            for record in records.records:
+                yield record
+            del records.records[:]
+            if not block:
+                return
+    finally:
+        if input_source is not path:
+            input_source.close()
+
+
 class FileProcessor:
 
-    def __init__(self, record_processor):
+    '''Parse a file into record_processor
+
+    duplicates is the policy for repeated rovats and mezos (see
+    DUPLICATE_POLICIES), counts counts them.
+    '''
+
+    def __init__(
+            self, record_processor, parse_xml=xml.sax.parse,
+            duplicates='last'):
         self.record_processor = record_processor
+        self.parse_xml = parse_xml
+        self.duplicates = duplicates
+        self.counts = Counter()
+
+    def new_state(self):
+        return State(self.record_processor, self.duplicates, self.counts)
 
     def parse(self, input_source):
-        state = State(record_processor=self.record_processor)
+        state = self.new_state()
         try:
-            xml.sax.parse(
+            self.parse_xml(
                 input_source,
                 ComplexXMLHandler(
                     handlers=xml_handler_map(),
                     state=state)
             )
-        except:
-            log.exception('Error during parsing')
+        except RequiredNumberOfRecordsRead:
+            pass
 
     def process(self, input_source):
-        self.parse(input_source)
-        self.record_processor.flush()
+        '''Parse input_source, parse errors are raised
+
+        The records parsed before an error are still passed on.
+        '''
+        try:
+            self.parse(input_source)
+        finally:
+            self.record_processor.flush()
+
+
+class RecoveringFileProcessor(FileProcessor):
+
+    '''Parse ceg by ceg: bad cegs are put into quarantine, parsing goes on
+    '''
+
+    def __init__(
+            self, record_processor, quarantine, parse_xml=xml.sax.parse,
+            duplicates='last'):
+        FileProcessor.__init__(self, record_processor, parse_xml, duplicates)
+        self.quarantine = quarantine
+
+    def parse(self, input_source):
+        from chunks import ceg_records, ceg_id_of, EXPORT_END
+
+        handler = ComplexXMLHandler(handlers=xml_handler_map(), state=None)
+        system_id = getattr(input_source, 'name', None)
+        # where the record starts in the input
+        line = column = None
+        try:
+            for head, offset, record in ceg_records(input_source):
+                if line is None:
+                    line, column = text_end(head, 1, 0)
+                ceg_id = ceg_id_of(record)
+                self.quarantine.remember(head, ceg_id, offset, record)
+                handler.state = self.new_state()
+                try:
+                    self.parse_xml(
+                        StringIO(head + record + EXPORT_END), handler
+                    )
+                except RequiredNumberOfRecordsRead:
+                    raise
+                except xml.sax.SAXParseException as e:
+                    self.quarantine.add(
+                        ceg_id,
+                        input_location(e, head, system_id, line, column)
+                    )
+                except xml.sax.SAXException as e:
+                    self.quarantine.add(ceg_id, e)
+                line, column = text_end(record, line, column)
+        except RequiredNumberOfRecordsRead:
+            pass
+
+
+def text_end(text, line, column):
+    '''(line, column) after text, which starts at (line, column)'''
+    newlines = text.count('\n')
+    if newlines:
+        return line + newlines, len(text) - text.rfind('\n') - 1
+    return line, column + len(text)
+
+
+def input_location(error, head, system_id, line, column):
+    '''The message of error, located in the input instead of the document
+    of head and a single record, which starts at (line, column) in the input
+    '''
+    head_line, head_column = text_end(head, 1, 0)
+    error_line = error.getLineNumber()
+    error_column = error.getColumnNumber()
+    if error_line == head_line:
+        error_column += column - head_column
+    return '{0}:{1}:{2}: {3}'.format(
+        system_id or '<unknown>',
+        line + error_line - head_line,
+        error_column,
+        error.getMessage()
+    )
+
+
+class Problem(
+        namedtuple('Problem', 'fname line byte_offset ceg_id message')):
+
+    def __str__(self):
+        return '{0}:{1}: byte {2}: ceg {3}: {4}'.format(*self)
+
+
+class TooManyProblems(Exception):
+    pass
+
+
+def normalized_encoding(encoding):
+    return (encoding or '').upper().replace('-', '')
+
+
+class StructureValidator(object):
+
+    '''Check a file without converting it, reporting the place of problems
+
+    Checks: well-formedness, declared encoding, element hierarchy, id
+    attributes, rovat and mezo ids against the schema, rovats repeated in a
+    ceg and mezos in an alrovat.
+    '''
+
+    MAX_PROBLEMS = 100
+    BLOCK_SIZE = 1 << 20
+
+    def __init__(self, tables):
+        self.fields_per_tables = {
+            table.name: set(field.name for field in table.fields)
+            for table in tables
+        }
+
+    def problem(self, message, line=None, byte_offset=None):
+        if len(self.problems) == self.MAX_PROBLEMS:
+            message = 'too many problems, giving up'
+        self.problems.append(
+            Problem(
+                self.fname,
+                line or self.parser.CurrentLineNumber,
+                byte_offset or self.parser.CurrentByteIndex,
+                self.ceg_id,
+                message
+            )
+        )
+        if len(self.problems) > self.MAX_PROBLEMS:
+            raise TooManyProblems
+
+    def xml_declaration(self, version, encoding, standalone):
+        self.encoding = encoding
+        if normalized_encoding(encoding) != normalized_encoding(ENCODING):
+            self.problem(
+                'encoding {0} instead of {1}'.format(encoding, ENCODING)
+            )
+
+    def start_element(self, name, attrs):
+        if self.encoding is None:
+            self.encoding = 'UTF-8'
+            self.problem('no xml declaration')
+
+        depth = len(self.stack)
+        expected = STATES[depth] if depth < len(STATES) else None
+        if name != expected:
+            self.problem('hierarchy problem: unexpected start-element {0}'
+                         .format(name))
+        self.stack.append(name)
+
+        if name not in ELEMENTS_WITH_ID:
+            return
+        element_id = attrs.get('id')
+        if element_id is None:
+            self.problem('{0} without id'.format(name))
+            return
+
+        if name == 'ceg':
+            self.ceg_id = element_id
+        elif name == 'rovat':
+            self.table = table_name(element_id)
+            if self.table not in self.fields_per_tables:
+                self.problem('unknown rovat {0}'.format(element_id))
+            self.check_duplicate(self.rovat_ids, 'rovat', element_id)
+        elif name == 'mezo':
+            self.check_duplicate(self.mezo_ids, 'mezo', element_id)
+            fields = self.fields_per_tables.get(self.table)
+            if fields is not None and element_id not in fields:
+                self.problem(
+                    'unknown mezo {0} in {1}'.format(element_id, self.table)
+                )
+
+    def check_duplicate(self, element_ids, name, element_id):
+        if element_id in element_ids:
+            self.problem('duplicate {0} {1}'.format(name, element_id))
+        element_ids.add(element_id)
+
+    def end_element(self, name):
+        self.stack.pop()
+        if name == 'ceg':
+            self.ceg_id = None
+            self.rovat_ids.clear()
+        elif name == 'rovat':
+            self.table = None
+        elif name == 'alrovat':
+            self.mezo_ids.clear()
+
+    def validate(self, input_source, fname):
+        import xml.parsers.expat
+
+        self.fname = fname
+        self.problems = []
+        self.stack = []
+        self.ceg_id = self.table = self.encoding = None
+        self.rovat_ids = set()
+        self.mezo_ids = set()
+        self.parser = parser = xml.parsers.expat.ParserCreate()
+        parser.XmlDeclHandler = self.xml_declaration
+        parser.StartElementHandler = self.start_element
+        parser.EndElementHandler = self.end_element
+        try:
+            for block in iter(lambda: input_source.read(self.BLOCK_SIZE), ''):
+                parser.Parse(block, False)
+            parser.Parse('', True)
+        except xml.parsers.expat.ExpatError as e:
+            try:
+                self.problem(
+                    xml.parsers.expat.ErrorString(e.code),
+                    parser.ErrorLineNumber,
+                    parser.ErrorByteIndex
+                )
+            except TooManyProblems:
+                pass
+        except TooManyProblems:
+            pass
+        return self.problems
 
 
 def make_directory(dir):
+    # called once per conversion: a process must not remember directories,
+    # they can be removed between its conversions (e.g. merged shards)
     try:
         os.mkdir(dir)
     except OSError:
@@ -209,36 +624,293 @@ def open_file(fname, mode='rb'):
     Whether to use compression is determined by the extension of the filename
     '''
     if fname.endswith('.gz'):
+        # deferred: gzip pulls in zlib and io, unused for plain files
+        import gzip
         return gzip.open(fname, mode)
     return open(fname, mode)
 
 
-def xml_to_csv_batches(input_fname, output_dir, schema_file_xls, maxrecords):
+def xml_to_csv_batches(
+        input_fname, tables, options, input_source=None, part=None,
+        sequence=0):
+    '''Convert input_fname, or input_source (a part of input_fname) if given
+
+    sequence is the place of the conversion in the run, see conversion_name.
+
+    Returns metrics of the conversion.
+    '''
+    metrics = Counter()
+    output_dir = options.output_dir
     make_directory(output_dir)
-    tables = complex_schema.read_tables(schema_file_xls)
-    for table in tables:
-        make_directory('{}/{}'.format(output_dir, table.name))
+    index = None
+    if options.index:
+        from ceg_index import CegIndexWriter
+
+        index = CegIndexWriter(output_dir)
+    quarantine = None
+    if options.recover:
+        from quarantine import Quarantine
+
+        quarantine = Quarantine(
+            os.path.join(
+                options.quarantine_dir,
+                output_base_name(input_fname, part) + '.xml'
+            ),
+            capacity=BATCH_SIZE
+        )
+    context = Context(
+        input_fname, output_dir, tables, options, index, quarantine, part,
+        sequence
+    )
+    try:
+        record_processor = build_pipeline(pipeline_stages(options), context)
+        reporter = None
+        if input_source is None and progress_interval(options):
+            import progress
+
+            record_processor = counter = (
+                CountingRecordProcessor(record_processor)
+            )
+            reporter = progress.ProgressReporter(
+                input_fname,
+                os.path.getsize(input_fname),
+                lambda: counter.count,
+                progress_interval(options),
+                options.status_file
+            )
+        parse_xml = ENGINES[options.engine]
+        if quarantine is None:
+            file_processor = FileProcessor(
+                record_processor, parse_xml, options.duplicates
+            )
+        else:
+            file_processor = RecoveringFileProcessor(
+                record_processor, quarantine, parse_xml, options.duplicates
+            )
+
+        if input_source is not None:
+            file_processor.process(input_source)
+        else:
+            log.info('Converting %s', input_fname)
+            input_source = open_file(input_fname)
+            if reporter is not None:
+                input_source = progress.ProgressFile(input_source, reporter)
+            try:
+                file_processor.process(input_source)
+            finally:
+                input_source.close()
+            if reporter is not None:
+                reporter.finish()
+        log_duplicates(input_fname, part, file_processor.counts, options)
+        metrics.update(file_processor.counts)
+    finally:
+        if quarantine is not None:
+            quarantine.close()
+            metrics['skipped_records'] += quarantine.count
+        context.close()
+        metrics.update(context.metrics)
+    return metrics
+
+
+def log_duplicates(input_fname, part, counts, options):
+    if counts['duplicate_rovats'] or counts['duplicate_mezos']:
+        log.warning(
+            '%s%s: %s duplicate rovats, %s duplicate mezos (%s)',
+            input_fname,
+            '' if part is None else ' part {0}'.format(part),
+            counts['duplicate_rovats'],
+            counts['duplicate_mezos'],
+            options.duplicates
+        )
 
-    record_processor = BatchMakerRecordProcessor(
-        batch_size=1000,
-        batch_processor=CsvSplitter(input_fname, output_dir, tables)
+
+def progress_interval(options):
+    '''Seconds between progress reports, 0 if there are none'''
+    if options.progress:
+        return options.progress
+    if options.status_file:
+        from progress import DEFAULT_INTERVAL
+
+        return DEFAULT_INTERVAL
+    return 0
+
+
+@register_stage('limit', RECORDS, RECORDS, parameters=dict(records=int))
+def limit_stage(context, record_processor, records=None):
+    return CountLimitingRecordProcessor(
+        record_processor=record_processor,
+        maxrecords=records or context.options.maxrecords
     )
 
-    if maxrecords:
-        record_processor = CountLimitingRecordProcessor(
-            record_processor=record_processor,
-            maxrecords=maxrecords
+
+@register_stage('changes', RECORDS, RECORDS)
+def changes_stage(context, record_processor):
+    import changes
+
+    database_fname = context.options.changes
+    previous_hashes = None
+    if os.path.exists(database_fname):
+        previous_hashes = changes.HashDatabase(database_fname)
+        context.on_close(previous_hashes.close)
+    collector = changes.HashCollector(
+        changes.part_name(
+            database_fname,
+            conversion_name(
+                context.input_fname, context.sequence, context.part
+            )
         )
+    )
+    context.on_close(collector.close)
+    processor = ChangeFilteringRecordProcessor(
+        previous_hashes, collector, record_processor
+    )
 
-    log.info('Converting %s', input_fname)
-    input_source = open_file(input_fname)
-    try:
-        FileProcessor(record_processor).process(input_source)
-    finally:
-        input_source.close()
+    def count_unchanged():
+        context.metrics['unchanged_records'] += processor.unchanged_count
+    context.on_close(count_unchanged)
+    return processor
+
+
+@register_stage('batch', RECORDS, BATCHES, parameters=dict(size=int))
+def batch_stage(context, batch_processor, size=None):
+    size = size or context.options.batch_size
+    if context.quarantine is not None:
+        # records are checked when their batch is written
+        context.quarantine.capacity = max(context.quarantine.capacity, size)
+    return BatchMakerRecordProcessor(
+        batch_size=size,
+        batch_processor=batch_processor
+    )
+
+
+@register_stage('transform', BATCHES, BATCHES)
+def transform_stage(context, batch_processor):
+    from transforms import ColumnTransforms
+
+    return TransformingBatchProcessor(
+        ColumnTransforms(context.options.transform or [], context.tables),
+        batch_processor
+    )
+
+
+@register_stage('sort', BATCHES, BATCHES)
+def sort_stage(context, batch_processor):
+    return SortingBatchProcessor(batch_processor)
+
+
+@register_stage('csv', BATCHES)
+def csv_stage(context, _):
+    for table in context.tables:
+        make_directory('{}/{}'.format(context.output_dir, table.name))
+    import manifests
+
+    publisher = None
+    if context.options.scratch_dir:
+        from scratch import Publisher
+
+        publisher = Publisher(
+            context.options.scratch_dir,
+            context.output_dir,
+            context.options.io_threads
+        )
+    csv_splitter = CsvSplitter(
+        context.input_fname, context.output_dir, context.tables,
+        context.index, context.quarantine, publisher,
+        encoding=context.options.output_encoding
+    )
+
+    def write_manifest():
+        manifests.write_manifest(
+            manifests.manifest_name(
+                context.output_dir,
+                conversion_name(
+                    context.input_fname, context.sequence, context.part
+                )
+            ),
+            [
+                (table, os.path.relpath(csv_name, context.output_dir),
+                 rows, size)
+                for table, csv_name, rows, size in csv_splitter.written
+            ]
+        )
+    # closed in reverse order: the files are in place when recorded
+    context.on_close(write_manifest)
+    if publisher is not None:
+        context.on_close(publisher.close)
+    return csv_splitter
+
+
+@register_stage('append', BATCHES)
+def append_stage(context, _):
+    return CsvAppender(
+        context.input_fname, context.output_dir, context.tables,
+        context.index, context.quarantine,
+        encoding=context.options.output_encoding
+    )
+
+
+@register_stage('partition', BATCHES, parameters=dict(count=int))
+def partition_stage(context, _, count=None):
+    return PartitioningCsvAppender(
+        context.input_fname, context.output_dir, context.tables,
+        context.index, context.quarantine,
+        encoding=context.options.output_encoding,
+        partitions=count or context.options.partitions
+    )
+
+
+def pipeline_stages(options):
+    '''The stage specs given by the options, or the default pipeline'''
+    if options.stage:
+        return options.stage
+    stages = []
+    if options.maxrecords:
+        stages.append('limit')
+    if options.changes:
+        stages.append('changes')
+    stages.append('batch')
+    if options.transform:
+        stages.append('transform')
+    if options.sort_batches:
+        stages.append('sort')
+    if options.partitions:
+        stages.append('partition')
+    else:
+        stages.append('append' if options.direct else 'csv')
+    return stages
+
+
+def output_base_name(input_fname, part=None):
+    '''Base of the names of files written for input_fname (part)'''
+    base_fname = (
+        os.path.basename(input_fname)
+        .replace('.xml', '')
+        .replace('.gz', '')
+    )
+    if part is not None:
+        base_fname = '{0}.part{1:06d}'.format(base_fname, part)
+    return base_fname
+
+
+def conversion_name(input_fname, sequence, part=None):
+    '''Name of the files of a conversion, unique in the run: NNNNNN.base
+
+    Inputs of the same name (from different directories) do not overwrite
+    the manifest and hashes of each other, and the sequence keeps their
+    order.
+    '''
+    return '{0:06d}.{1}'.format(
+        sequence, output_base_name(input_fname, part)
+    )
+
+
+def megabytes(value):
+    return int(float(value) * MEGABYTE)
 
 
 def parse_args(args):
+    from progress import DEFAULT_INTERVAL
+
     parser = argparse.ArgumentParser(
         description="Convert Complex's XML"
     )
@@ -257,28 +929,950 @@ def parse_args(args):
     parser.add_argument(
         '--schema-file-xls',
         default='R_export.txt.xls',
-        help='xls file accompanying Complex\'s dump (default: %(default)s)'
+        help=(
+            'xls file accompanying Complex\'s dump'
+            ' or its precompiled .json form (default: %(default)s)'
+        )
+    )
+    parser.add_argument(
+        '--schema-cache-dir',
+        help=(
+            'cache compiled schemas under this directory'
+            ' (default: next to the xls)'
+        )
+    )
+    parser.add_argument(
+        '--direct',
+        action='store_true',
+        help=(
+            'append rows directly to OUTPUT_DIR/rovat_N.csv files'
+            ' instead of creating batch files under OUTPUT_DIR/rovat_N/'
+        )
+    )
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        default=1,
+        help='convert this many files in parallel (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--max-tasks-per-worker',
+        type=int,
+        default=0,
+        help=(
+            'replace worker processes after this many files/chunks,'
+            ' to bound leaks (default: never)'
+        )
+    )
+    parser.add_argument(
+        '--partitions',
+        type=int,
+        default=0,
+        metavar='K',
+        help=(
+            'with --direct: split the rows of every table into K'
+            ' OUTPUT_DIR/rovat_N.KKK.csv files by the crc32 of ceg_id'
+            ' modulo K, the rows of a ceg have the same KKK in all tables'
+        )
+    )
+    parser.add_argument(
+        '--max-memory',
+        type=megabytes,
+        default=0,
+        metavar='MB',
+        help=(
+            'with --jobs: start conversions only while the memory in use'
+            ' by the converter leaves room for them, make batches smaller'
+            ' near MB (default: no limit)'
+        )
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=BATCH_SIZE,
+        help='records per batch (file) (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--chunk-size',
+        type=megabytes,
+        default=0,
+        help=(
+            'with --direct and --jobs: convert the files in chunks of about'
+            ' CHUNK_SIZE megabytes of xml in parallel (default: whole files)'
+        )
+    )
+    parser.add_argument(
+        '--index',
+        action='store_true',
+        help=(
+            'write OUTPUT_DIR/rovat_N.idx files locating the rows of each'
+            ' ceg_id, for ceg-lookup'
+        )
+    )
+    parser.add_argument(
+        '--validate-only',
+        action='store_true',
+        help=(
+            'do not convert, only check the files against the schema'
+            ' and report problems; exit status is 1 if there were any'
+        )
+    )
+    parser.add_argument(
+        '--recover',
+        action='store_true',
+        help=(
+            'skip bad ceg records instead of stopping at them,'
+            ' collecting them into quarantine files'
+        )
+    )
+    parser.add_argument(
+        '--quarantine-dir',
+        help=(
+            'put the quarantine files with --recover into this directory'
+            ' (default: OUTPUT_DIR/quarantine)'
+        )
+    )
+    parser.add_argument(
+        '--transform',
+        action='append',
+        metavar='FIELD=TRANSFORM[,TRANSFORM...]',
+        help=(
+            'normalise the values of FIELD (like rovat_3.datum, datum or *)'
+            ' while converting; transforms: strip, lines, oneline, date,'
+            ' number (can be repeated)'
+        )
+    )
+    parser.add_argument(
+        '--engine',
+        choices=sorted(ENGINES),
+        default='sax',
+        help=(
+            'xml parser: sax, or expat, which passes the text on as utf-8'
+            ' bytes without decoding it to unicode (default: %(default)s)'
+        )
+    )
+    parser.add_argument(
+        '--duplicates',
+        choices=DUPLICATE_POLICIES,
+        default='last',
+        help=(
+            'a rovat repeated in a ceg, or a mezo in an alrovat: stop'
+            ' (error), keep the first or the last one, or concatenate them'
+            ' (concat: the rows of rovats, the text of mezos on separate'
+            ' lines); the duplicates are counted and logged'
+            ' (default: %(default)s)'
+        )
+    )
+    parser.add_argument(
+        '--output-encoding',
+        default='utf-8',
+        help=(
+            'encoding of the csv files; utf-8 output of the expat engine'
+            ' needs no encoding at all (default: %(default)s)'
+        )
+    )
+    parser.add_argument(
+        '--progress',
+        type=float,
+        default=0,
+        metavar='SECONDS',
+        help=(
+            'log the progress of file conversions (percent, records/s,'
+            ' MB/s, ETA) every SECONDS (default: no progress reports)'
+        )
+    )
+    parser.add_argument(
+        '--status-file',
+        help=(
+            'write the latest progress report to this file (json), every'
+            ' --progress seconds (default: {0}); worker processes of --jobs'
+            ' write STATUS_FILE.PID'.format(DEFAULT_INTERVAL)
+        )
+    )
+    parser.add_argument(
+        '--scratch-dir',
+        help=(
+            'write batch files (or the shards of --direct --jobs) to this'
+            ' local directory first, and move them to OUTPUT_DIR in'
+            ' background threads - for OUTPUT_DIR on NFS'
+        )
+    )
+    parser.add_argument(
+        '--io-threads',
+        type=int,
+        default=4,
+        help=(
+            'number of threads moving files from --scratch-dir'
+            ' (default: %(default)s)'
+        )
+    )
+    parser.add_argument(
+        '--stage',
+        action='append',
+        metavar='NAME[:PARAM=VALUE,...]',
+        help=(
+            'build the processing pipeline from these stages, from the'
+            ' parser to the writer, e.g. --stage batch:size=500 --stage csv'
+            ' (default: [limit] [changes] batch [transform] [sort]'
+            ' csv|append|partition)'
+        )
+    )
+    parser.add_argument(
+        '--pipeline-file',
+        help='read --stage specifications from this file, one per line'
+    )
+    parser.add_argument(
+        '--stage-module',
+        action='append',
+        default=[],
+        help='import this python module registering additional stages'
+    )
+    parser.add_argument(
+        '--sort-batches',
+        action='store_true',
+        help=(
+            'write the rows of batch files in ceg_id order, so they can be'
+            ' merged by rovat-dir-to-csv --sort'
+        )
+    )
+    parser.add_argument(
+        '--changes',
+        metavar='HASH_DB',
+        help=(
+            'convert only the cegs that are new or changed since the run'
+            ' that wrote the content hash database HASH_DB, list the ids of'
+            ' the cegs missing since then in OUTPUT_DIR/{0},'
+            ' and update HASH_DB (not with --recover)'.format(DELETED_FNAME)
+        )
+    )
+    parser.add_argument(
+        '--work-queue',
+        metavar='QUEUE_DIR',
+        help=(
+            'convert the files of this shared work queue (see complex-queue)'
+            ' until it is empty, instead of COMPLEX_XML_FILE'
+        )
+    )
+    parser.add_argument(
+        '--listen',
+        metavar='SOCKET',
+        help=(
+            'with --direct: serve on this local socket, converting the'
+            ' files and streams sent by complex-xml-send, instead of'
+            ' COMPLEX_XML_FILE'
+        )
     )
     parser.add_argument(
         'complex_xml_file',
-        help='file to process'
+        nargs='?',
+        help=(
+            'file to process, or "-" to keep reading file names to process'
+            ' from the standard input, one per line'
+        )
+    )
+
+    options = parser.parse_args(args)
+    if (options.complex_xml_file is None
+            and options.work_queue is None
+            and options.listen is None):
+        parser.error('too few arguments')
+    if options.complex_xml_file is not None and options.work_queue:
+        parser.error('COMPLEX_XML_FILE can not be given with --work-queue')
+    if options.complex_xml_file is not None and options.listen:
+        parser.error('COMPLEX_XML_FILE can not be given with --listen')
+    try:
+        codecs.lookup(options.output_encoding)
+    except LookupError:
+        parser.error(
+            'unknown --output-encoding {0}'.format(options.output_encoding)
+        )
+    if options.quarantine_dir is None:
+        options.quarantine_dir = os.path.join(options.output_dir, 'quarantine')
+    if options.pipeline_file:
+        options.stage = (
+            read_stage_file(options.pipeline_file) + (options.stage or [])
+        )
+    return options
+
+
+def read_fnames(input):
+    # not `for line in input`: that reads ahead and would wait for more names
+    for line in iter(input.readline, ''):
+        fname = line.strip()
+        if fname:
+            yield fname
+
+
+def convert(
+        input_fname, tables, options, input_source=None, part=None,
+        sequence=0):
+    '''Convert a file (part), return (success, metrics)'''
+    try:
+        metrics = xml_to_csv_batches(
+            input_fname, tables, options, input_source, part, sequence
+        )
+    except Exception:
+        log.exception('Error converting %s', input_fname)
+        return False, Counter()
+    return True, metrics
+
+
+# of a pool worker process, set up once by init_worker
+worker_state = None
+
+
+class WorkerState(object):
+
+    '''What the tasks of a worker process share: set up only once'''
+
+    def __init__(self, tables, options):
+        self.tables = tables
+        self.options = options
+
+
+def init_worker(tables, options):
+    global worker_state
+    if options.listen:
+        # stopping the service is up to the main process
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if options.status_file:
+        options = copy.copy(options)
+        options.status_file = '{0}.{1}'.format(
+            options.status_file, os.getpid()
+        )
+    worker_state = WorkerState(tables, options)
+
+
+def worker_pool(tables, options):
+    '''Pool of --jobs processes, the schema is sent to each only once'''
+    import multiprocessing
+
+    return multiprocessing.Pool(
+        options.jobs,
+        initializer=init_worker,
+        initargs=(tables, options),
+        maxtasksperchild=options.max_tasks_per_worker or None
+    )
+
+
+def convert_task(task):
+    # runs in a worker process, must not raise
+    sequence, input_fname, chunk, batch_size = task
+    started = time.time()
+    tables, options = worker_state.tables, worker_state.options
+    input_source = part = None
+    if chunk is not None:
+        input_source = StringIO(chunk)
+        part = sequence
+    if batch_size is not None:
+        options = copy.copy(options)
+        options.batch_size = batch_size
+    if options.direct:
+        import shards
+
+        options = copy.copy(options)
+        options.output_dir = shards.shard_dir(shards_root(options), sequence)
+    result = convert(
+        input_fname, tables, options, input_source, part, sequence
+    )
+    return sequence, result, (os.getpid(), time.time() - started)
+
+
+def parallel_tasks(fnames, chunk_size):
+    '''Generate (input_fname, chunk, is_last_chunk, failed) for all fnames
+
+    chunk is None when the whole file is to be converted.
+    '''
+    from chunks import ceg_chunks
+
+    for fname in fnames:
+        if not chunk_size:
+            yield fname, None, True, False
+            continue
+
+        log.info('Converting %s', fname)
+        try:
+            input_source = open_file(fname)
+            try:
+                chunks = ceg_chunks(input_source, chunk_size)
+                chunk = next(chunks, None)
+                for next_chunk in chunks:
+                    yield fname, chunk, False, False
+                    chunk = next_chunk
+                yield fname, chunk or b'', True, False
+            finally:
+                input_source.close()
+        except Exception:
+            log.exception('Error reading %s', fname)
+            yield fname, None, True, True
+
+
+def shards_root(options):
+    return options.scratch_dir or options.output_dir
+
+
+def convert_in_parallel(fnames, tables, options):
+    '''Convert files - or chunks of them - in a pool of processes
+
+    Results are committed through a reorder buffer, in input order: the output
+    is the same as that of a serial conversion.  With --max-memory the tasks
+    running at once (and their batch size) are decided by a Governor.
+    '''
+    import Queue
+    import shards
+
+    output_dir = options.output_dir
+    make_directory(output_dir)
+    if options.direct:
+        shards.make_shards_dir(shards_root(options))
+
+    # the reading of the input is limited to stay at most this much ahead
+    max_in_flight = 2 * options.jobs
+    governor = None
+    if options.max_memory:
+        from governor import Governor, SAMPLE_INTERVAL
+
+        governor = Governor(
+            options.jobs, options.max_memory, options.batch_size
+        )
+    # tasks submitted to the pool, not completed yet
+    running = [0]
+    completed = Queue.Queue()
+    reorder_buffer = shards.ReorderBuffer()
+    tasks = {}
+    # of the file being committed: success, metrics
+    file_results = [True, Counter()]
+    worker_metrics = defaultdict(Counter)
+
+    def commit_next(timeout=None):
+        try:
+            sequence, result, (pid, seconds) = completed.get(timeout=timeout)
+        except Queue.Empty:
+            return
+        if pid is not None:
+            running[0] -= 1
+            worker_metrics[pid].update(tasks=1, seconds=seconds)
+        reorder_buffer.add(sequence, result)
+        for sequence, (converted, metrics) in reorder_buffer.ready():
+            fname, is_last_chunk = tasks.pop(sequence)
+            if options.direct:
+                shards.merge_shard(
+                    shards.shard_dir(shards_root(options), sequence),
+                    output_dir
+                )
+            # chunks of a file are committed consecutively
+            file_results[0] = file_results[0] and converted
+            file_results[1].update(metrics)
+            if is_last_chunk:
+                yield fname, file_results[0], file_results[1]
+                file_results[:] = [True, Counter()]
+
+    pool = worker_pool(tables, options)
+    try:
+        task_list = parallel_tasks(fnames, options.chunk_size)
+        for sequence, (fname, chunk, is_last_chunk, failed) in enumerate(
+                task_list):
+            tasks[sequence] = fname, is_last_chunk
+            if failed:
+                completed.put((sequence, (False, Counter()), (None, 0)))
+            else:
+                while governor is not None and not governor.admit(running[0]):
+                    for result in commit_next(timeout=SAMPLE_INTERVAL):
+                        yield result
+                batch_size = governor and governor.batch_size
+                pool.apply_async(
+                    convert_task,
+                    [(sequence, fname, chunk, batch_size)],
+                    callback=completed.put
+                )
+                running[0] += 1
+            while len(tasks) >= max_in_flight:
+                for result in commit_next():
+                    yield result
+
+        while tasks:
+            for result in commit_next():
+                yield result
+    finally:
+        pool.close()
+        pool.join()
+        if options.direct:
+            shards.remove_shards_dir(shards_root(options))
+        log_worker_metrics(worker_metrics)
+        if governor is not None:
+            log.info(
+                'Peak memory use: %.0f MB',
+                float(governor.peak_memory) / MEGABYTE
+            )
+
+
+def convert_in_chunks(
+        pool, name, input_source, options, sequences, merge_lock):
+    '''Convert input_source in chunks in pool while it is read
+
+    The shards of the chunks are merged into --output-dir in input order,
+    under merge_lock, so streams converted in other threads do not mix
+    within a chunk.  Sequences of the chunks are taken from sequences, shared
+    by the threads.  Returns (success, metrics).
+    '''
+    import Queue
+    import shards
+    from chunks import ceg_chunks
+
+    completed = Queue.Queue()
+    reorder_buffer = shards.ReorderBuffer()
+    # sequence -> position of the chunk in input_source
+    positions = {}
+    results = [True, Counter()]
+
+    def commit_next():
+        sequence, (converted, metrics), _ = completed.get()
+        reorder_buffer.add(positions.pop(sequence), (sequence, converted))
+        results[0] = results[0] and converted
+        results[1].update(metrics)
+        for _, (sequence, converted) in reorder_buffer.ready():
+            with merge_lock:
+                shards.merge_shard(
+                    shards.shard_dir(shards_root(options), sequence),
+                    options.output_dir
+                )
+
+    log.info('Converting %s', name)
+    try:
+        chunks = ceg_chunks(
+            input_source, options.chunk_size or STREAM_CHUNK_SIZE
+        )
+        for position, chunk in enumerate(chunks):
+            sequence = next(sequences)
+            positions[sequence] = position
+            pool.apply_async(
+                convert_task,
+                [(sequence, name, chunk, None)],
+                callback=completed.put
+            )
+            while len(positions) + len(reorder_buffer) >= 2 * options.jobs:
+                commit_next()
+    except Exception:
+        log.exception('Error reading %s', name)
+        results[0] = False
+    finally:
+        while positions or len(reorder_buffer):
+            commit_next()
+    return tuple(results)
+
+
+def listen(tables, options):
+    '''Convert the streams sent to the --listen socket until stopped
+
+    On SIGTERM or SIGINT no new requests are accepted, the conversions in
+    progress are completed.  Returns the summed metrics of the conversions.
+    '''
+    import itertools
+    import threading
+    import service
+    import shards
+
+    make_directory(options.output_dir)
+    shards.make_shards_dir(shards_root(options))
+    pool = worker_pool(tables, options)
+    sequences = itertools.count()
+    merge_lock = threading.Lock()
+
+    def convert_stream(name, input_source):
+        return convert_in_chunks(
+            pool, name, input_source, options, sequences, merge_lock
+        )
+
+    server = service.ConversionServer(
+        options.listen, convert_stream, open_file
+    )
+    log.info('Listening on %s', options.listen)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log.info('Stopping, finishing the conversions in progress')
+    finally:
+        server.server_close()
+        server.wait_for_requests()
+        pool.close()
+        pool.join()
+        shards.remove_shards_dir(shards_root(options))
+        if options.index:
+            from ceg_index import merge_indexes
+
+            merge_indexes(options.output_dir)
+    return server.report
+
+
+def log_worker_metrics(worker_metrics):
+    for pid, metrics in sorted(worker_metrics.items()):
+        log.info(
+            'Worker %s: %s tasks in %.1f s',
+            pid, metrics['tasks'], metrics['seconds']
+        )
+
+
+def convert_serially(fnames, tables, options):
+    for sequence, fname in enumerate(fnames):
+        converted, metrics = convert(
+            fname, tables, options, sequence=sequence
+        )
+        yield fname, converted, metrics
+
+
+def remove_partial_output(input_fname, tables, options, sequence):
+    '''Remove what an interrupted conversion of input_fname has written
+
+    With --direct the shard of the conversion is emptied, otherwise its
+    batch files (also in the --scratch-dir) and its manifest are removed.
+    '''
+    import re
+    import shutil
+    import manifests
+
+    if options.direct:
+        shutil.rmtree(options.output_dir, ignore_errors=True)
+        os.mkdir(options.output_dir)
+        return
+    base_fname = output_base_name(input_fname)
+    batch_fname = re.compile(re.escape(base_fname) + r'_\d{4,}\.csv$')
+    for root_dir in filter(None, [options.output_dir, options.scratch_dir]):
+        for table in tables:
+            table_dir = os.path.join(root_dir, table.name)
+            if not os.path.isdir(table_dir):
+                continue
+            for fname in os.listdir(table_dir):
+                if batch_fname.match(fname):
+                    os.remove(os.path.join(table_dir, fname))
+    manifest_fname = manifests.manifest_name(
+        options.output_dir, conversion_name(input_fname, sequence)
+    )
+    if os.path.exists(manifest_fname):
+        os.remove(manifest_fname)
+
+
+def work_through_queue(queue, tables, options):
+    '''Convert items claimed from queue until there are none left
+
+    With --direct every item is converted to its own shard, merged when
+    all the items are finished.  Requeued items are converted again from
+    scratch: the output of their crashed worker is removed first.
+    '''
+    import shards
+    from work_queue import worker_name
+
+    worker = worker_name()
+    report = Counter()
+    while True:
+        item = queue.claim(worker)
+        if item is None:
+            return report
+        item_options = options
+        if options.direct:
+            item_options = copy.copy(options)
+            item_options.output_dir = shards.shard_dir(
+                options.output_dir, item.sequence
+            )
+        if item.requeued:
+            remove_partial_output(
+                item.fname, tables, item_options, item.sequence
+            )
+        converted, metrics = convert(
+            item.fname, tables, item_options, sequence=item.sequence
+        )
+        if not queue.finish(item, worker, converted):
+            log.warning(
+                '%s was requeued while being converted, left to its new'
+                ' worker', item.fname
+            )
+            continue
+        report.update(metrics)
+        report['converted_files' if converted else 'failed_files'] += 1
+
+
+def work_task(queue_dir):
+    # runs in a worker process
+    from work_queue import WorkQueue
+
+    return work_through_queue(
+        WorkQueue(queue_dir), worker_state.tables, worker_state.options
     )
 
-    return parser.parse_args(args)
+
+def merge_queue_shards(queue, output_dir):
+    import shards
+
+    for sequence in queue.finished_sequences():
+        shard_dir = shards.shard_dir(output_dir, sequence)
+        if os.path.isdir(shard_dir):
+            shards.merge_shard(shard_dir, output_dir)
+    shards.remove_shards_dir(output_dir)
+
+
+def work(queue, tables, options):
+    '''Work on queue with --jobs processes, return the summed report
+
+    The last worker to finish merges the shards of --direct conversions.
+    '''
+    import shards
+    from work_queue import FAILED
+
+    make_directory(options.output_dir)
+    if options.direct:
+        shards.make_shards_dir(options.output_dir)
+
+    if options.jobs > 1:
+        pool = worker_pool(tables, options)
+        try:
+            reports = pool.map(work_task, [queue.queue_dir] * options.jobs)
+        finally:
+            pool.close()
+            pool.join()
+        report = sum(reports, Counter())
+    else:
+        report = work_through_queue(queue, tables, options)
+
+    if ((options.direct or options.changes)
+            and queue.is_complete() and queue.start_merge()):
+        if options.direct:
+            log.info('Merging the shards of %s', queue.queue_dir)
+            merge_queue_shards(queue, options.output_dir)
+            if options.index:
+                from ceg_index import merge_indexes
+
+                merge_indexes(options.output_dir)
+        if options.changes:
+            update_changes(options, queue.counts()[FAILED], report)
+    return report
+
+
+def update_changes(options, failed_files, report):
+    '''Update the hash database and list the deleted cegs'''
+    import changes
+
+    if failed_files:
+        log.error(
+            'Not updating %s, as not all files were converted',
+            options.changes
+        )
+        return
+    report['deleted_cegs'] += changes.update_database(
+        options.changes,
+        os.path.join(options.output_dir, DELETED_FNAME)
+    )
+
+
+def validate_file(fname, tables):
+    try:
+        input_source = open_file(fname)
+        try:
+            return StructureValidator(tables).validate(input_source, fname)
+        finally:
+            input_source.close()
+    except Exception as e:
+        # can not be converted either
+        return [Problem(fname, 0, 0, None, 'could not read: {0}'.format(e))]
+
+
+def validate_task(fname):
+    # runs in a worker process
+    return validate_file(fname, worker_state.tables)
+
+
+def validate_files(fnames, tables, options, output):
+    '''Report problems of fnames to output, return the number of bad files'''
+    if options.jobs > 1:
+        pool = worker_pool(tables, options)
+        results = pool.imap(validate_task, fnames)
+    else:
+        pool = None
+        results = (validate_file(fname, tables) for fname in fnames)
+
+    bad_files = 0
+    try:
+        for problems in results:
+            for problem in problems:
+                output.write('{0}\n'.format(problem))
+            if problems:
+                bad_files += 1
+            output.flush()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return bad_files
+
+
+def serve(fnames, tables, options, output=None):
+    '''Convert files in this process, or in a pool of processes (--jobs).
+
+    The schema is loaded and the modules are imported only once, the start up
+    costs are not paid again for every file.  The name of each converted file
+    is written to output (if given) when its conversion is complete.
+
+    Returns the summed metrics of the conversions, including the number of
+    files that could not be converted (failed_files).
+    '''
+    if options.jobs > 1:
+        results = convert_in_parallel(fnames, tables, options)
+    else:
+        results = convert_serially(fnames, tables, options)
+
+    report = Counter()
+    for fname, converted, metrics in results:
+        report.update(metrics)
+        if not converted:
+            report['failed_files'] += 1
+            continue
+        report['converted_files'] += 1
+        if output is not None:
+            output.write('{0}\n'.format(fname))
+            output.flush()
+    return report
+
+
+def log_report(report):
+    log.info(
+        'Converted files: %s, failed: %s',
+        report['converted_files'],
+        report['failed_files']
+    )
+    if report['unchanged_records'] or report['deleted_cegs']:
+        log.info(
+            'Unchanged cegs: %s, deleted: %s',
+            report['unchanged_records'],
+            report['deleted_cegs']
+        )
+    if report['skipped_records']:
+        log.warning(
+            '%s bad ceg records skipped, see the quarantine files',
+            report['skipped_records']
+        )
+    if report['duplicate_rovats'] or report['duplicate_mezos']:
+        log.warning(
+            'Duplicate rovats: %s, mezos: %s',
+            report['duplicate_rovats'],
+            report['duplicate_mezos']
+        )
 
 
 def main():
+    import progress
+    import shards
+    from schema_cache import load_tables
+    from transforms import ColumnTransforms, InvalidTransformSpec
+    from ceg_index import merge_indexes
+
     logging.basicConfig()
     args = parse_args(sys.argv[1:])
+    if args.progress:
+        progress.log.setLevel(logging.INFO)
     if args.maxrecords != Handle_ceg.ALL_RECORDS:
         log.warning('Processing only %s "ceg"/file', args.maxrecords)
 
-    xml_to_csv_batches(
-        args.complex_xml_file,
-        args.output_dir,
-        args.schema_file_xls,
-        args.maxrecords
-    )
+    if args.sort_batches and args.direct:
+        log.error('--sort-batches sorts batch files, not --direct output')
+        sys.exit(1)
+    if args.chunk_size and not args.direct:
+        log.error('--chunk-size requires --direct')
+        sys.exit(1)
+    if args.chunk_size and args.maxrecords:
+        log.error('--maxrecords would apply to each chunk')
+        sys.exit(1)
+    if args.max_memory and (args.jobs < 2 or args.work_queue or args.listen):
+        log.error('--max-memory governs the workers of --jobs')
+        sys.exit(1)
+    if (args.direct
+            and os.path.isdir(args.output_dir)
+            and shards.final_csv_names(args.output_dir)):
+        log.error('%s already has rovat_N.csv files', args.output_dir)
+        sys.exit(1)
+
+    tables = load_tables(args.schema_file_xls, args.schema_cache_dir)
+    try:
+        ColumnTransforms(args.transform or [], tables)
+    except InvalidTransformSpec as e:
+        log.error('Invalid --transform %s', e)
+        sys.exit(1)
+    try:
+        import_stage_modules(args.stage_module)
+        names = stage_names(pipeline_stages(args))
+    except InvalidPipeline as e:
+        log.error('Invalid pipeline: %s', e)
+        sys.exit(1)
+    if ('changes' in names) != bool(args.changes):
+        log.error('Use the changes stage with --changes (only)')
+        sys.exit(1)
+    if args.changes and args.maxrecords:
+        log.error('--maxrecords would make the rest of the cegs deleted')
+        sys.exit(1)
+    if args.changes and args.recover:
+        # skipped cegs would be recorded as deleted, or as converted
+        log.error('--recover can not be used with --changes')
+        sys.exit(1)
+    if (names[-1] in ('append', 'partition')) != args.direct:
+        log.error(
+            'Use the append or partition writer stage with --direct (only)'
+        )
+        sys.exit(1)
+    if args.partitions and names[-1] != 'partition':
+        log.error('Use the partition writer stage with --partitions')
+        sys.exit(1)
+    if names[-1] == 'partition' and args.index:
+        # the index of a table refers to a single csv file
+        log.error('--partitions can not be used with --index')
+        sys.exit(1)
+
+    if args.listen:
+        if not args.direct or args.validate_only or args.changes:
+            log.error('--listen converts with --direct, without --changes')
+            sys.exit(1)
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        log_report(listen(tables, args))
+        return
+
+    if args.work_queue:
+        if args.chunk_size or args.validate_only:
+            log.error('--work-queue converts whole files')
+            sys.exit(1)
+        if args.index and not args.direct:
+            # appending to the index from several hosts is not safe
+            log.error('--work-queue --index requires --direct')
+            sys.exit(1)
+        from work_queue import WorkQueue
+
+        report = work(WorkQueue(args.work_queue), tables, args)
+        log_report(report)
+        if report['failed_files']:
+            sys.exit(1)
+        return
+
+    if args.complex_xml_file == '-':
+        fnames = read_fnames(sys.stdin)
+        output = sys.stdout
+    else:
+        fnames = [args.complex_xml_file]
+        output = None
+
+    if args.validate_only:
+        if validate_files(fnames, tables, args, sys.stdout):
+            sys.exit(1)
+        return
+
+    if args.changes:
+        import changes
+
+        # of an earlier, failed run
+        changes.remove_parts(args.changes)
+    report = serve(fnames, tables, args, output=output)
+    if args.index:
+        merge_indexes(args.output_dir)
+    if args.changes:
+        update_changes(args, report['failed_files'], report)
+    log_report(report)
+    if report['failed_files']:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
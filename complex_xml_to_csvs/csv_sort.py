@@ -0,0 +1,152 @@
+'''Merge csv files sorted by ceg_id into a single sorted csv file
+
+The batch files written with complex-xml-to-csvs --sort-batches are sorted
+by ceg_id, so any number of them can be merged in a streaming pass by a
+k-way heap merge.  Memory use is bounded by the read buffers of the files
+merged at once, and their number by the open files allowed (ulimit -n):
+when there are more files than fit, groups of them are merged into
+temporary files first.
+
+Rows are copied as they are, without encoding them again: only the
+ceg_id column is parsed.  Rows with the same ceg_id keep their order.
+'''
+
+import csv
+import heapq
+import os
+import shutil
+import tempfile
+
+
+SORT_COLUMN = 'ceg_id'
+BUFFER_SIZE = 256 * 1024
+MEGABYTE = 1 << 20
+# open files left for other purposes: the output, the standard streams...
+RESERVED_FILES = 16
+
+
+class MergeError(ValueError):
+    pass
+
+
+def raw_rows(f):
+    '''Generate (row, raw bytes of the row) of the csv file f
+
+    A row can span several lines, as field values may contain newlines.
+    '''
+    lines = []
+
+    def recorded_lines():
+        for line in f:
+            lines.append(line)
+            yield line
+
+    for row in csv.reader(recorded_lines()):
+        raw = ''.join(lines)
+        del lines[:]
+        yield row, raw
+
+
+def read_header(fname):
+    with open(fname, 'rb') as f:
+        for row, raw in raw_rows(f):
+            return raw
+    return ''
+
+
+def sorted_rows(fname, position, header):
+    '''Generate (ceg_id, position, raw row) of the sorted csv file fname'''
+    with open(fname, 'rb', BUFFER_SIZE) as f:
+        rows = raw_rows(f)
+        for columns, raw in rows:
+            if raw != header:
+                raise MergeError('{0}: different header'.format(fname))
+            key_index = columns.index(SORT_COLUMN)
+            break
+        else:
+            return
+
+        last_key = None
+        for row, raw in rows:
+            key = row[key_index]
+            if last_key is not None and key < last_key:
+                raise MergeError(
+                    '{0}: not sorted by {1} ({2} after {3})'.format(
+                        fname, SORT_COLUMN, key, last_key
+                    )
+                )
+            last_key = key
+            yield key, position, raw
+
+
+def merge(fnames, output):
+    '''Merge the sorted csv files to output, with a single header'''
+    header = read_header(fnames[0]) if fnames else ''
+    output.write(header)
+    merged = heapq.merge(
+        *[
+            sorted_rows(fname, position, header)
+            for position, fname in enumerate(fnames)
+        ]
+    )
+    for key, position, raw in merged:
+        output.write(raw)
+
+
+def open_file_limit():
+    '''Number of files the process can have open, None if unlimited'''
+    import resource
+
+    limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if limit == resource.RLIM_INFINITY:
+        return None
+    return limit
+
+
+def max_files(memory, file_limit=None):
+    '''Number of files merged at once within memory bytes and file_limit
+    open files (None: no limit)
+    '''
+    count = memory // BUFFER_SIZE
+    if file_limit is not None:
+        count = min(count, file_limit - RESERVED_FILES)
+    return max(2, count)
+
+
+def sort_merge(
+        fnames, output, memory=256 * MEGABYTE, tmp_dir=None,
+        file_limit=None):
+    '''Merge any number of sorted csv files to output within memory bytes
+
+    At most file_limit files are opened, by default the limit of the
+    process.
+    '''
+    fnames = list(fnames)
+    if file_limit is None:
+        file_limit = open_file_limit()
+    group_size = max_files(memory, file_limit)
+    runs_dir = None
+    run_count = 0
+    try:
+        while len(fnames) > group_size:
+            if runs_dir is None:
+                runs_dir = tempfile.mkdtemp(dir=tmp_dir)
+            runs = []
+            for start in range(0, len(fnames), group_size):
+                group = fnames[start:start + group_size]
+                run = os.path.join(
+                    runs_dir, 'run{0:06d}.csv'.format(run_count)
+                )
+                run_count += 1
+                with open(run, 'wb', BUFFER_SIZE) as run_file:
+                    merge(group, run_file)
+                for fname in group:
+                    # runs of the previous round
+                    if os.path.dirname(fname) == runs_dir:
+                        os.remove(fname)
+                runs.append(run)
+            fnames = runs
+        merge(fnames, output)
+    finally:
+        if runs_dir is not None:
+            shutil.rmtree(runs_dir, ignore_errors=True)
@@ -0,0 +1,121 @@
+'''Fast csv encoding of the rows of a batch
+
+The output is byte for byte the same as that of unicodecsv.DictWriter
+(excel dialect), but
+
+- the rows are written by the C csv writer as lists, into a memory buffer
+  that is written to the file in one call
+- the values of a whole batch are encoded in one call: joined by NUL, which
+  can not appear in XML text, encoded, then split again.  Values that are
+  not text (numbers, None) make the batch go the slow, value by value way.
+
+Values can also be utf-8 encoded str (as parsed by the expat engine): these
+are written as they are to utf-8 output, and transcoded batch by batch to
+other encodings.
+'''
+
+import codecs
+from cStringIO import StringIO
+
+
+SEPARATOR = u'\x00'
+# of str values
+BYTES_ENCODING = 'utf-8'
+
+
+def is_bytes_encoding(encoding):
+    return codecs.lookup(encoding).name == BYTES_ENCODING
+
+
+def stringify(value, encoding):
+    # as unicodecsv does
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode(encoding)
+    if isinstance(value, str):
+        if is_bytes_encoding(encoding):
+            return value
+        return value.decode(BYTES_ENCODING).encode(encoding)
+    if isinstance(value, (int, float)):
+        return value
+    return str(value)
+
+
+class BatchCsvWriter(object):
+
+    def __init__(self, fields, encoding='utf-8'):
+        self.fields = list(fields)
+        self.field_set = frozenset(self.fields)
+        self.encoding = encoding
+        self.separator = SEPARATOR.encode(encoding)
+        self.passes_bytes = is_bytes_encoding(encoding)
+
+    def cells(self, rows):
+        '''The values of rows, in field order, as a flat list'''
+        fields = self.fields
+        field_set = self.field_set
+        cells = []
+        extend = cells.extend
+        for row in rows:
+            if not field_set.issuperset(row):
+                raise ValueError(
+                    'dict contains fields not in fieldnames: {0}'.format(
+                        ', '.join(
+                            repr(field) for field in row
+                            if field not in field_set
+                        )
+                    )
+                )
+            get = row.get
+            extend([get(field, '') for field in fields])
+        return cells
+
+    def encode_cells(self, cells):
+        try:
+            # unicode if any of the cells is
+            joined = b'\x00'.join(cells)
+            if isinstance(joined, unicode):
+                encoded = joined.encode(self.encoding)
+            elif self.passes_bytes:
+                return cells
+            else:
+                encoded = (
+                    joined.decode(BYTES_ENCODING).encode(self.encoding)
+                )
+            encoded = encoded.split(self.separator)
+            if len(encoded) == len(cells):
+                return encoded
+        except (TypeError, UnicodeDecodeError):
+            # not only text, or both unicode and non-ascii str
+            pass
+        return [stringify(cell, self.encoding) for cell in cells]
+
+    def encode_rows(self, rows, row_ends=None):
+        '''csv bytes of rows (dicts)
+
+        The end offsets of the rows are appended to row_ends, if given.
+        '''
+        if not rows:
+            return ''
+        # deferred: not needed by --validate-only and --help
+        import csv
+
+        width = len(self.fields)
+        cells = self.encode_cells(self.cells(rows))
+        buffer = StringIO()
+        writer = csv.writer(buffer)
+        positional_rows = (
+            cells[start:start + width]
+            for start in xrange(0, len(cells), width)
+        )
+        if row_ends is None:
+            writer.writerows(positional_rows)
+        else:
+            for row in positional_rows:
+                writer.writerow(row)
+                row_ends.append(buffer.tell())
+        return buffer.getvalue()
+
+    def header(self):
+        return self.encode_rows([dict(zip(self.fields, self.fields))])
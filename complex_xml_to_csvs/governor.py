@@ -0,0 +1,188 @@
+'''Adaptive concurrency of parallel conversions within a memory budget
+
+The memory needed by a conversion depends on the size of the <ceg>
+records of its batches, so it is not known in advance.  The governor
+starts tasks one by one, and lets more run concurrently only while the
+memory in use (RSS of this process and its workers, from /proc) leaves room
+for another task as large as the largest worker seen so far.  Near the
+budget, new tasks get smaller batches.
+
+While the I/O of the host is under pressure (Linux pressure stall
+information, /proc/pressure/io) no more tasks are started: more writers
+would not write faster.
+
+Without /proc the memory in use is unknown, and the tasks are only limited
+by the number of workers.
+'''
+
+import os
+import time
+import logging
+from collections import namedtuple
+
+
+log = logging.getLogger(__name__)
+
+KILOBYTE = 1024
+MEGABYTE = 1 << 20
+# seconds between increases of concurrency
+SAMPLE_INTERVAL = 0.5
+# % of the time some tasks of the host waited for I/O (in the last 10 s)
+MAX_IO_PRESSURE = 50.0
+MIN_BATCH_SIZE = 10
+# batches are made smaller above, larger again below these parts of
+# the budget
+SHRINK_ABOVE = 0.8
+GROW_BELOW = 0.5
+
+
+def read_fields(fname):
+    '''Map the names to the values of "name: value" lines of a /proc file
+
+    None if the file can not be read.
+    '''
+    try:
+        with open(fname) as f:
+            return dict(
+                line.split(':', 1) for line in f if ':' in line
+            )
+    except (IOError, OSError):
+        return None
+
+
+def rss(pid):
+    '''Resident memory of process pid in bytes, 0 if unknown'''
+    fields = read_fields('/proc/{0}/status'.format(pid))
+    if not fields or 'VmRSS' not in fields:
+        return 0
+    return int(fields['VmRSS'].split()[0]) * KILOBYTE
+
+
+def written_bytes(pid):
+    '''Bytes written by process pid, 0 if unknown'''
+    fields = read_fields('/proc/{0}/io'.format(pid))
+    if not fields or 'write_bytes' not in fields:
+        return 0
+    return int(fields['write_bytes'])
+
+
+def io_pressure(fname='/proc/pressure/io'):
+    '''avg10 of "some" I/O pressure of the host, None if unknown'''
+    try:
+        with open(fname) as f:
+            for line in f:
+                if line.startswith('some '):
+                    for field in line.split()[1:]:
+                        name, value = field.split('=')
+                        if name == 'avg10':
+                            return float(value)
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+class Sample(
+        namedtuple(
+            'Sample', 'time memory worker_memory written io_pressure')):
+
+    '''Resource use at time: memory and worker_memory (the largest RSS of
+    the workers) in bytes, bytes written by the workers so far, I/O
+    pressure (or None)
+    '''
+
+
+def take_sample():
+    import multiprocessing
+
+    worker_pids = [
+        process.pid for process in multiprocessing.active_children()
+    ]
+    worker_rss = [rss(pid) for pid in worker_pids]
+    return Sample(
+        time=time.time(),
+        memory=rss(os.getpid()) + sum(worker_rss),
+        worker_memory=max(worker_rss or [0]),
+        written=sum(written_bytes(pid) for pid in worker_pids),
+        io_pressure=io_pressure(),
+    )
+
+
+class Governor(object):
+
+    '''Decide when a task can start, and the batch size of the tasks'''
+
+    def __init__(
+            self, max_tasks, max_memory, batch_size,
+            max_io_pressure=MAX_IO_PRESSURE, sample=take_sample):
+        self.max_tasks = max_tasks
+        self.max_memory = max_memory
+        self.full_batch_size = self.batch_size = batch_size
+        self.max_io_pressure = max_io_pressure
+        self.sample = sample
+        # concurrency found safe so far
+        self.reached = 1
+        self.task_memory = 0
+        self.last_sample = None
+        self.last_change = None
+        self.write_rate = 0.0
+        self.peak_memory = 0
+
+    def update(self):
+        sample = self.sample()
+        if self.last_sample is not None:
+            elapsed = sample.time - self.last_sample.time
+            if elapsed > 0:
+                self.write_rate = (
+                    max(0, sample.written - self.last_sample.written)
+                    / elapsed
+                )
+        self.last_sample = sample
+        self.task_memory = max(self.task_memory, sample.worker_memory)
+        self.peak_memory = max(self.peak_memory, sample.memory)
+        self.adapt_batch_size(sample)
+        return sample
+
+    def adapt_batch_size(self, sample):
+        batch_size = self.batch_size
+        if sample.memory > SHRINK_ABOVE * self.max_memory:
+            batch_size = max(MIN_BATCH_SIZE, batch_size // 2)
+        elif sample.memory < GROW_BELOW * self.max_memory:
+            batch_size = min(self.full_batch_size, batch_size * 2)
+        if batch_size != self.batch_size and self.is_time(sample):
+            log.info(
+                'Batch size %s -> %s (%.0f MB in use)',
+                self.batch_size, batch_size, sample.memory / MEGABYTE
+            )
+            self.batch_size = batch_size
+            self.last_change = sample.time
+
+    def is_time(self, sample):
+        return (
+            self.last_change is None
+            or sample.time - self.last_change >= SAMPLE_INTERVAL
+        )
+
+    def admit(self, running):
+        '''Can a new task start besides the running ones?'''
+        if running == 0:
+            return True
+        if running >= self.max_tasks:
+            return False
+        sample = self.update()
+        if sample.memory + self.task_memory > self.max_memory:
+            return False
+        if running < self.reached:
+            return True
+        if (sample.io_pressure is not None
+                and sample.io_pressure > self.max_io_pressure):
+            return False
+        if not self.is_time(sample):
+            return False
+        self.reached = running + 1
+        self.last_change = sample.time
+        log.info(
+            '%s tasks (%.0f MB in use, %.1f MB/s written)',
+            self.reached, sample.memory / MEGABYTE,
+            self.write_rate / MEGABYTE
+        )
+        return True
@@ -0,0 +1,114 @@
+'''Records of the batch files written, to verify their merge
+
+Every conversion writes OUTPUT_DIR/_manifests/NNNNNN.BASE.tsv, NNNNNN
+being its sequence in the run, with a line per batch file written:
+
+    table    csv file (relative to OUTPUT_DIR)    rows    bytes
+
+rows does not include the header, bytes does.  A manifest is written by a
+single conversion, so it is safe on shared file systems too.
+
+The rows are counted by the converter: a field value can contain a quoted
+\\r\\n (from &#13;&#10;), the rows of a csv file can not be counted by its
+line ends.  A merge compares the bytes, and takes the rows from here.
+'''
+
+import os
+
+
+MANIFESTS_DIR = '_manifests'
+# ends the header
+ROW_END = b'\r\n'
+
+
+def manifest_name(output_dir, base_name):
+    return os.path.join(output_dir, MANIFESTS_DIR, base_name + '.tsv')
+
+
+def write_manifest(fname, entries):
+    dirname = os.path.dirname(fname)
+    if not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            # created by a parallel conversion
+            pass
+    with open(fname + '.tmp', 'wb') as f:
+        for table, path, rows, size in entries:
+            f.write('{0}\t{1}\t{2}\t{3}\n'.format(table, path, rows, size))
+    os.rename(fname + '.tmp', fname)
+
+
+def manifest_fnames(output_dir):
+    manifests_dir = os.path.join(output_dir, MANIFESTS_DIR)
+    return [
+        os.path.join(manifests_dir, fname)
+        for fname in sorted(os.listdir(manifests_dir))
+        if fname.endswith('.tsv')
+    ]
+
+
+def read_manifest(fname):
+    with open(fname, 'rb') as f:
+        for line in f:
+            table, path, rows, size = line.rstrip('\n').split('\t')
+            yield table, path, int(rows), int(size)
+
+
+def recorded_files(output_dir, table):
+    '''Map csv paths of table to (rows, bytes) recorded by the converters
+
+    None if there are no manifests (the output of an older converter).
+    '''
+    if not os.path.isdir(os.path.join(output_dir, MANIFESTS_DIR)):
+        return None
+    files = {}
+    for fname in manifest_fnames(output_dir):
+        for entry_table, path, rows, size in read_manifest(fname):
+            if entry_table == table:
+                files[path] = rows, size
+    return files
+
+
+def remove_merged_manifests(output_dir):
+    '''Remove the manifests of which all tables are merged
+
+    The tables are merged when their directories are removed.  The
+    manifests directory is removed too, once empty.
+    '''
+    if not os.path.isdir(os.path.join(output_dir, MANIFESTS_DIR)):
+        return
+    for fname in manifest_fnames(output_dir):
+        tables = set(table for table, _, _, _ in read_manifest(fname))
+        if any(os.path.isdir(os.path.join(output_dir, table))
+               for table in tables):
+            continue
+        try:
+            os.remove(fname)
+        except OSError:
+            # removed by a parallel merge
+            pass
+    try:
+        os.rmdir(os.path.join(output_dir, MANIFESTS_DIR))
+    except OSError:
+        # manifests of tables not merged yet
+        pass
+
+
+class StreamStats(object):
+
+    '''Bytes and checksum of a csv stream, updated chunk by chunk'''
+
+    def __init__(self):
+        # deferred: only rovat-dir-to-csv checksums the csv files
+        import hashlib
+
+        self.bytes = 0
+        self.sha1 = hashlib.sha1()
+
+    def update(self, data):
+        self.bytes += len(data)
+        self.sha1.update(data)
+
+    def hexdigest(self):
+        return self.sha1.hexdigest()
@@ -0,0 +1,163 @@
+'''Record processor pipelines composed of registered stages
+
+A pipeline is a list of stage specifications, from the parser towards the
+output, like
+
+    limit:records=100       stop after 100 records
+    batch:size=500          collect the records into batches of 500
+    transform               apply the --transform column transforms
+    csv                     write the batches to batch csv files
+
+A stage is registered by name with the kind of items it takes and passes
+on (records or batches - writers pass on nothing) and the types of its
+parameters.  It is built by its factory from a Context, the processor of
+the next stage and the parameters given.
+'''
+
+from collections import namedtuple, Counter
+
+
+RECORDS = 'records'
+BATCHES = 'batches'
+
+Stage = namedtuple('Stage', 'name consumes produces parameters factory')
+
+STAGES = {}
+
+
+class InvalidPipeline(ValueError):
+    pass
+
+
+def register_stage(name, consumes, produces=None, parameters=None):
+    '''Decorator registering a stage factory under name
+
+    parameters maps parameter names to types (functions converting the
+    string values).
+    '''
+    def register(factory):
+        STAGES[name] = Stage(
+            name, consumes, produces, parameters or {}, factory
+        )
+        return factory
+    return register
+
+
+def import_stage_modules(module_names):
+    '''Import modules registering their own stages'''
+    import importlib
+
+    for module_name in module_names:
+        try:
+            importlib.import_module(module_name)
+        except ImportError as e:
+            raise InvalidPipeline(
+                'stage module {0}: {1}'.format(module_name, e)
+            )
+
+
+class Context(object):
+
+    '''What stages are built from, and cleanup after the conversion'''
+
+    def __init__(
+            self, input_fname, output_dir, tables, options,
+            index=None, quarantine=None, part=None, sequence=0):
+        self.input_fname = input_fname
+        # of a file converted in parts (chunks)
+        self.part = part
+        # of the conversion in the run, names its files in input order
+        self.sequence = sequence
+        self.output_dir = output_dir
+        self.tables = tables
+        self.options = options
+        self.index = index
+        self.quarantine = quarantine
+        # metrics of the stages, added to the metrics of the conversion
+        self.metrics = Counter()
+        self.closers = []
+
+    def on_close(self, close):
+        self.closers.append(close)
+
+    def close(self):
+        while self.closers:
+            self.closers.pop()()
+
+
+def parse_stage(spec):
+    '''name:param=value,... -> (stage, parameters)'''
+    name, _, params_spec = spec.strip().partition(':')
+    stage = STAGES.get(name)
+    if stage is None:
+        raise InvalidPipeline(
+            '{0}: unknown stage {1}, known ones: {2}'.format(
+                spec, name, ', '.join(sorted(STAGES))
+            )
+        )
+    params = {}
+    for param in params_spec.split(',') if params_spec else []:
+        key, equals, value = param.partition('=')
+        if not equals or key not in stage.parameters:
+            raise InvalidPipeline(
+                '{0}: expected parameters {1}'.format(
+                    spec,
+                    ', '.join(p + '=VALUE' for p in sorted(stage.parameters))
+                    or 'none'
+                )
+            )
+        try:
+            params[key] = stage.parameters[key](value)
+        except ValueError:
+            raise InvalidPipeline(
+                '{0}: invalid value for {1}'.format(spec, key)
+            )
+    return stage, params
+
+
+def parse_pipeline(specs):
+    '''Parse and check the stage specs, return a list of (stage, params)'''
+    stages = [parse_stage(spec) for spec in specs]
+    if not stages:
+        raise InvalidPipeline('empty pipeline')
+
+    items = RECORDS
+    for stage, params in stages:
+        if items is None:
+            raise InvalidPipeline(
+                'stage {0} follows a writer'.format(stage.name)
+            )
+        if stage.consumes != items:
+            raise InvalidPipeline(
+                'stage {0} needs {1}, gets {2}'.format(
+                    stage.name, stage.consumes, items
+                )
+            )
+        items = stage.produces
+    if items is not None:
+        raise InvalidPipeline(
+            'pipeline ends in {0}, not in a writer'.format(items)
+        )
+    return stages
+
+
+def stage_names(specs):
+    return [stage.name for stage, params in parse_pipeline(specs)]
+
+
+def build_pipeline(specs, context):
+    '''Build the processors of specs, return the first one'''
+    processor = None
+    for stage, params in reversed(parse_pipeline(specs)):
+        processor = stage.factory(context, processor, **params)
+    return processor
+
+
+def read_stage_file(fname):
+    '''Stage specs of a pipeline file: one per line, # starts a comment'''
+    with open(fname) as f:
+        return [
+            line.split('#', 1)[0].strip()
+            for line in f
+            if line.split('#', 1)[0].strip()
+        ]
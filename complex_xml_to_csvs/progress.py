@@ -0,0 +1,130 @@
+'''Progress of the conversion of a file
+
+Progress is measured by the position in the input file as stored: for gzip
+files the position of the compressed data, so the size of the file is the
+total work.  The position is checked only when the parser reads a block of
+the input (tens of kilobytes), and reported only at an interval, so the
+per record cost is a counter increment.
+
+The latest report can be written to a status file as json, for monitoring.
+'''
+
+import logging
+import os
+import time
+
+
+log = logging.getLogger(__name__)
+
+MEGABYTE = 1 << 20
+DEFAULT_INTERVAL = 10
+
+
+def raw_file(f):
+    '''The file of f as stored: the compressed file of gzip files'''
+    # gzip.GzipFile keeps the file it reads in fileobj
+    return getattr(f, 'fileobj', None) or f
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{0}:{1:02d}:{2:02d}'.format(hours, minutes, seconds)
+
+
+def write_status(fname, status):
+    # deferred: only --status-file writes json
+    import json
+
+    with open(fname + '.tmp', 'wb') as f:
+        json.dump(status, f, sort_keys=True)
+        f.write('\n')
+    os.rename(fname + '.tmp', fname)
+
+
+class ProgressReporter(object):
+
+    '''Report the progress of a conversion every interval seconds
+
+    count_records gives the number of records converted so far.
+    '''
+
+    def __init__(
+            self, fname, size, count_records, interval=DEFAULT_INTERVAL,
+            status_fname=None, clock=time.time):
+        self.fname = fname
+        self.size = size
+        self.count_records = count_records
+        self.interval = interval
+        self.status_fname = status_fname
+        self.clock = clock
+        self.start = clock()
+        self.next_report = self.start + interval
+        self.position = 0
+
+    def status(self, now, done=False):
+        elapsed = max(now - self.start, 1e-6)
+        records = self.count_records()
+        position = self.size if done else self.position
+        fraction = float(position) / self.size if self.size else 1.0
+        eta = (
+            elapsed * (1 - fraction) / fraction if fraction else None
+        )
+        return dict(
+            fname=self.fname,
+            done=done,
+            percent=round(100 * fraction, 1),
+            records=records,
+            records_per_second=round(records / elapsed, 1),
+            mb_per_second=round(position / elapsed / MEGABYTE, 2),
+            elapsed_seconds=round(elapsed, 1),
+            eta_seconds=None if eta is None else round(eta, 1),
+        )
+
+    def update(self, position):
+        '''The input is read up to position: report if it is time'''
+        self.position = position
+        now = self.clock()
+        if now >= self.next_report:
+            self.next_report = now + self.interval
+            self.report(self.status(now))
+
+    def report(self, status):
+        log.info(
+            '%s: %.1f%%, %s records (%.0f records/s, %.2f MB/s), ETA %s',
+            status['fname'],
+            status['percent'],
+            status['records'],
+            status['records_per_second'],
+            status['mb_per_second'],
+            'unknown' if status['eta_seconds'] is None
+            else format_duration(status['eta_seconds'])
+        )
+        if self.status_fname:
+            write_status(self.status_fname, status)
+
+    def finish(self):
+        if self.status_fname:
+            write_status(self.status_fname, self.status(self.clock(), True))
+
+
+class ProgressFile(object):
+
+    '''Input file reporting the position of its raw file after reads'''
+
+    def __init__(self, f, reporter):
+        self.file = f
+        self.raw = raw_file(f)
+        self.reporter = reporter
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.reporter.update(self.raw.tell())
+        return data
+
+    def close(self):
+        self.file.close()
+
+    def __getattr__(self, name):
+        # name and the rest, e.g. for the locations of parse errors
+        return getattr(self.file, name)
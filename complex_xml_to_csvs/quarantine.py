@@ -0,0 +1,68 @@
+'''Quarantine for <ceg> records that can not be converted
+
+Bad records are collected, as they were in the input, into an xml file
+having the original declaration, so it can be checked and converted again
+when fixed.  Every record is preceded by a comment with the reason.
+'''
+
+from collections import OrderedDict
+import logging
+import os
+
+from chunks import EXPORT_END
+
+
+log = logging.getLogger(__name__)
+
+
+class Quarantine(object):
+
+    def __init__(self, fname, capacity):
+        '''Keep the raw form of the last capacity records for quarantining'''
+        self.fname = fname
+        self.capacity = capacity
+        self.head = None
+        self.records = OrderedDict()
+        self.file = None
+        self.count = 0
+
+    def remember(self, head, ceg_id, offset, record):
+        self.head = head
+        self.records[ceg_id] = offset, record
+        if len(self.records) > self.capacity:
+            self.records.popitem(last=False)
+
+    def open(self):
+        dirname = os.path.dirname(self.fname)
+        if dirname and not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # created in parallel
+                pass
+        self.file = open(self.fname, 'wb')
+        self.file.write(self.head or b'')
+
+    def add(self, ceg_id, reason):
+        offset, record = self.records.get(ceg_id, (None, None))
+        log.warning(
+            'ceg %s (byte %s) put into quarantine: %s', ceg_id, offset, reason
+        )
+        if self.file is None:
+            self.open()
+        self.file.write(
+            '<!-- ceg {0} at byte {1}: {2} -->\n'.format(
+                ceg_id, offset, str(reason).replace('--', '- -')
+            )
+        )
+        if record is None:
+            self.file.write('<!-- raw record is not available -->\n')
+        else:
+            self.file.write(record)
+        self.count += 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.write(EXPORT_END)
+            self.file.close()
+            self.file = None
@@ -1,9 +1,14 @@
 import os
+import itertools
+import operator
 import xml.sax
-import unicodecsv
+import zlib
+from collections import defaultdict
 
 import logging
 
+from csv_writer import BatchCsvWriter
+
 
 log = logging.getLogger(__name__)
 
@@ -12,6 +17,12 @@ class RequiredNumberOfRecordsRead(xml.sax.SAXException):
     pass
 
 
+def table_name(rovat):
+    if rovat.startswith('0') and rovat != '0':
+        rovat = rovat.lstrip('0')
+    return 'rovat_{}'.format(rovat)
+
+
 class RecordProcessor(object):
 
     def process(self, document):
@@ -40,6 +51,61 @@ class CountLimitingRecordProcessor(RecordProcessor):
         self.record_processor.flush()
 
 
+class CollectingRecordProcessor(RecordProcessor):
+
+    def __init__(self):
+        self.records = []
+
+    def process(self, document):
+        self.records.append(document)
+
+
+class CountingRecordProcessor(RecordProcessor):
+
+    def __init__(self, record_processor):
+        self.record_processor = record_processor
+        self.count = 0
+
+    def process(self, document):
+        self.count += 1
+        self.record_processor.process(document)
+
+    def flush(self):
+        self.record_processor.flush()
+
+
+class ChangeFilteringRecordProcessor(RecordProcessor):
+
+    '''Pass on only the records that are new or changed
+
+    The content hash of every record is added to collector, records having
+    the same hash in previous_hashes (if given) are dropped.
+    '''
+
+    def __init__(self, previous_hashes, collector, record_processor):
+        # deferred: hashlib is needed only with --changes
+        from changes import content_hash
+
+        self.content_hash = content_hash
+        self.previous_hashes = previous_hashes
+        self.collector = collector
+        self.record_processor = record_processor
+        self.unchanged_count = 0
+
+    def process(self, document):
+        ceg_id = document['ceg_id']
+        digest = self.content_hash(document)
+        self.collector.add(ceg_id, digest)
+        if (self.previous_hashes is not None
+                and self.previous_hashes.get(ceg_id) == digest):
+            self.unchanged_count += 1
+            return
+        self.record_processor.process(document)
+
+    def flush(self):
+        self.record_processor.flush()
+
+
 class BatchMakerRecordProcessor(RecordProcessor):
 
     def __init__(self, batch_size, batch_processor):
@@ -64,9 +130,73 @@ class BatchProcessor(object):
         pass
 
 
+class TransformingBatchProcessor(BatchProcessor):
+
+    '''Apply column transforms to the field values of a batch, pass it on
+
+    column_transforms.for_column(table_name, field_name) gives the list of
+    transforms of a column, each is called once per batch with all the values
+    of the column in the batch.
+    '''
+
+    def __init__(self, column_transforms, batch_processor):
+        self.column_transforms = column_transforms
+        self.batch_processor = batch_processor
+
+    def columns(self, batch):
+        '''Map (table name, field name) to the alrovats having the field'''
+        columns = {}
+        for record in batch:
+            for rovat, alrovats in record.iteritems():
+                if rovat == 'ceg_id':
+                    continue
+                rovat_table_name = table_name(rovat)
+                for alrovat in alrovats:
+                    for field_name in alrovat:
+                        column = rovat_table_name, field_name
+                        cells = columns.get(column)
+                        if cells is None:
+                            cells = columns[column] = []
+                        cells.append(alrovat)
+        return columns
+
+    def process(self, batch):
+        for (rovat_table_name, field_name), alrovats in (
+                self.columns(batch).iteritems()):
+            transforms = self.column_transforms.for_column(
+                rovat_table_name, field_name
+            )
+            if not transforms:
+                continue
+            values = [alrovat[field_name] for alrovat in alrovats]
+            for transform in transforms:
+                values = transform(values)
+            for alrovat, value in itertools.izip(alrovats, values):
+                alrovat[field_name] = value
+
+        self.batch_processor.process(batch)
+
+
+class SortingBatchProcessor(BatchProcessor):
+
+    '''Pass on the records of a batch in ceg_id order
+
+    The sort is stable: records with the same ceg_id keep their order.
+    '''
+
+    def __init__(self, batch_processor):
+        self.batch_processor = batch_processor
+
+    def process(self, batch):
+        batch.sort(key=operator.itemgetter('ceg_id'))
+        self.batch_processor.process(batch)
+
+
 class CsvSplitter(BatchProcessor):
 
-    def __init__(self, input_fname, output_dir, tables):
+    def __init__(
+            self, input_fname, output_dir, tables, index=None,
+            quarantine=None, publisher=None, encoding='utf-8'):
         self.rows_per_tables = {}
         self.rovat_to_table = {
             table.name: table
@@ -79,6 +209,13 @@ class CsvSplitter(BatchProcessor):
             .replace('.gz', '')
         )
         self.output_dir = output_dir
+        self.index = index
+        self.quarantine = quarantine
+        self.publisher = publisher
+        self.encoding = encoding
+        self.field_sets = {}
+        # (table name, csv name, rows, bytes) of the files written
+        self.written = []
 
     @property
     def tables(self):
@@ -94,10 +231,27 @@ class CsvSplitter(BatchProcessor):
             for alrovat in js[rovat]:
                 rows.append(dict(alrovat, ceg_id=ceg_id))
 
+    def record_problem(self, js):
+        '''Why the record can not be written - None if it can'''
+        for rovat, alrovats in js.iteritems():
+            if rovat == 'ceg_id':
+                continue
+            table_name = self.get_table_name(rovat)
+            fields = self.field_sets.get(table_name)
+            if fields is None:
+                if table_name not in self.rovat_to_table:
+                    return 'unknown rovat {0}'.format(rovat)
+                fields = self.field_sets[table_name] = set(
+                    self.get_fields(rovat)
+                )
+            for alrovat in alrovats:
+                if not fields.issuperset(alrovat):
+                    return 'unknown mezo {0} in rovat {1}'.format(
+                        ', '.join(sorted(set(alrovat) - fields)), rovat
+                    )
+
     def get_table_name(self, rovat):
-        if rovat.startswith('0') and rovat != '0':
-            rovat = rovat.lstrip('0')
-        return 'rovat_{}'.format(rovat)
+        return table_name(rovat)
 
     def get_fields(self, rovat):
         table = self.rovat_to_table[self.get_table_name(rovat)]
@@ -116,20 +270,37 @@ class CsvSplitter(BatchProcessor):
 
     def batch_csv_file(self, rovat):
         batch_csv_name = self.batch_csv_name(rovat)
+        if self.publisher is not None:
+            batch_csv_name = self.publisher.local_name(batch_csv_name)
 
         assert not os.path.exists(batch_csv_name)
         return open(batch_csv_name, 'w')
 
+    def needs_header(self, f):
+        return True
+
     def flush_table(self, rovat):
         log.debug('CsvSplitter.flush_table START: %s', rovat)
         table_fields = self.get_fields(rovat)
         rows = self.rows_per_tables[rovat]
 
         with self.batch_csv_file(rovat) as f:
-            writer = unicodecsv.DictWriter(f, table_fields)
-            writer.writeheader()
+            writer = BatchCsvWriter(table_fields, self.encoding)
+            if self.needs_header(f):
+                f.write(writer.header())
             try:
-                writer.writerows(rows)
+                if self.index is None:
+                    f.write(writer.encode_rows(rows))
+                else:
+                    self.write_indexed_rows(rovat, f, writer, rows)
+                self.written.append(
+                    (
+                        self.get_table_name(rovat),
+                        self.batch_csv_name(rovat),
+                        len(rows),
+                        f.tell()
+                    )
+                )
             except:
                 log.exception(
                     '%s: rovat_%s batch #%s',
@@ -143,11 +314,37 @@ class CsvSplitter(BatchProcessor):
                     rows[-1]['ceg_id']
                 )
                 raise
+        if self.publisher is not None:
+            self.publisher.publish(self.batch_csv_name(rovat))
         log.debug('CsvSplitter.flush_table END: %s', rovat)
 
+    def write_indexed_rows(self, rovat, f, writer, rows):
+        row_ends = []
+        offset = f.tell()
+        f.write(writer.encode_rows(rows, row_ends))
+        entries = []
+        start = end = 0
+        row_count = 0
+        for ceg_id, ceg_rows in itertools.groupby(
+                rows, operator.itemgetter('ceg_id')):
+            row_count += sum(1 for _ in ceg_rows)
+            end = row_ends[row_count - 1]
+            entries.append((ceg_id, offset + start, end - start))
+            start = end
+        self.index.write(
+            self.get_table_name(rovat),
+            self.batch_csv_name(rovat),
+            entries
+        )
+
     def process(self, batch):
         log.debug('CsvSplitter.process START')
         for record in batch:
+            if self.quarantine is not None:
+                problem = self.record_problem(record)
+                if problem is not None:
+                    self.quarantine.add(record['ceg_id'], problem)
+                    continue
             self.spread_record(record)
 
         for table in self.tables:
@@ -156,3 +353,81 @@ class CsvSplitter(BatchProcessor):
         self.rows_per_tables = {}
         self.batch_number += 1
         log.debug('CsvSplitter.process END')
+
+
+class CsvAppender(CsvSplitter):
+
+    '''Append the rows directly to the final {output_dir}/rovat_N.csv files
+
+    The header is written only into empty files, so the files can be shared
+    by all input files of a run.
+    '''
+
+    def batch_csv_name(self, rovat):
+        return '{output_dir}/{table}.csv'.format(
+            output_dir=self.output_dir,
+            table=self.get_table_name(rovat),
+        )
+
+    def batch_csv_file(self, rovat):
+        return open(self.batch_csv_name(rovat), 'ab')
+
+    def needs_header(self, f):
+        f.seek(0, os.SEEK_END)
+        return f.tell() == 0
+
+
+def crc32_partition(key, partitions):
+    '''Partition of the bytes key: its crc32 modulo partitions'''
+    return (zlib.crc32(key) & 0xffffffff) % partitions
+
+
+def partition_of(ceg_id, partitions):
+    '''Partition of ceg_id: crc32 of its (utf-8) bytes modulo partitions'''
+    from changes import as_bytes
+
+    return crc32_partition(as_bytes(ceg_id), partitions)
+
+
+class PartitioningCsvAppender(CsvAppender):
+
+    '''Append the rows to {output_dir}/{table}.{partition}.csv files
+
+    The rows of a ceg are in the same partition in all tables, so the
+    tables can be joined partition by partition.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        partitions = kwargs.pop('partitions')
+        if partitions < 1:
+            raise ValueError(
+                'number of partitions must be positive: {0}'
+                .format(partitions)
+            )
+        CsvAppender.__init__(self, *args, **kwargs)
+        # deferred: changes pulls in hashlib, bound once for the records
+        from changes import as_bytes
+
+        self.as_bytes = as_bytes
+        self.partitions = partitions
+        self.partition_width = max(3, len(str(partitions - 1)))
+        self.partition = None
+
+    def batch_csv_name(self, rovat):
+        return '{output_dir}/{table}.{partition:0{width}d}.csv'.format(
+            output_dir=self.output_dir,
+            table=self.get_table_name(rovat),
+            partition=self.partition,
+            width=self.partition_width,
+        )
+
+    def process(self, batch):
+        partition_batches = defaultdict(list)
+        for record in batch:
+            partition_batches[
+                crc32_partition(
+                    self.as_bytes(record['ceg_id']), self.partitions
+                )
+            ].append(record)
+        for self.partition, records in sorted(partition_batches.items()):
+            CsvAppender.process(self, records)
@@ -1,20 +1,33 @@
-__doc__ = '''\
-Concatenate csv files under a ROVAT_DIR directory to a ROVAT_DIR.csv
-and remove the directory.
+'''\
+Concatenate csv files under ROVAT_DIR directories to ROVAT_DIR.csv files,
+with a single header, and remove the directories.
 
-Usage:
-    {} ROVAT_DIR
+The bytes of the csv files are counted while they are copied, and are
+checked against the manifests written by complex-xml-to-csvs: a directory
+is removed only if all the files recorded were merged completely (the
+manifests too, once all their tables are merged).  ROVAT_DIR.csv.sha1
+lists the files merged and ROVAT_DIR.csv, with their rows (as recorded, -
+without manifests), bytes and sha1 checksum.
 
-Where ROVAT_DIR is the directory
-'''.format(__file__)
-
-USAGE = __doc__
+With --sort the csv files are merged by ceg_id instead - they are to be
+sorted (see complex-xml-to-csvs --sort-batches).
+'''
 
 
+import argparse
 import os
 import sys
-import subprocess
 import shutil
+import threading
+import Queue
+
+import csv_sort
+import manifests
+
+
+BUFFER_SIZE = 4 * 1024 * 1024
+# chunks read ahead of the writing
+READ_AHEAD = 4
 
 
 def die_with(message):
@@ -22,32 +35,270 @@ def die_with(message):
     sys.exit(1)
 
 
-def main():
+def csv_fnames(rovat_dir):
+    return [
+        os.path.join(rovat_dir, fname)
+        for fname in sorted(os.listdir(rovat_dir))
+        if fname.endswith('.csv')
+    ]
+
+
+def read_chunks(fnames, chunks):
+    '''Put (fname, chunk) of fnames into the chunks queue
+
+    A None chunk marks the end of a file, a None fname the end of all files
+    or an error (as chunk).
+    '''
     try:
-        rovat_dir, = sys.argv[1:]
-        rovat_dir = os.path.abspath(rovat_dir)
-    except:
-        die_with(USAGE)
+        for fname in fnames:
+            with open(fname, 'rb') as f:
+                for chunk in iter(lambda: f.read(BUFFER_SIZE), b''):
+                    chunks.put((fname, chunk))
+            chunks.put((fname, None))
+    except Exception as e:
+        chunks.put((None, e))
+        return
+    chunks.put((None, None))
+
+
+def concatenate(fnames, output):
+    '''Copy fnames to output with a single header, return their stats
+
+    Files are read in a separate thread, while the previous chunks are
+    written.
+    '''
+    chunks = Queue.Queue(READ_AHEAD)
+    reader = threading.Thread(target=read_chunks, args=(fnames, chunks))
+    reader.daemon = True
+    reader.start()
+
+    header = None
+    file_stats = []
+    stats = None
+    while True:
+        fname, chunk = chunks.get()
+        if fname is None:
+            if chunk is not None:
+                raise chunk
+            break
+        if chunk is None:
+            file_stats.append((fname, stats or manifests.StreamStats()))
+            stats = None
+            continue
+
+        if stats is None:
+            stats = manifests.StreamStats()
+            header_end = (
+                chunk.find(manifests.ROW_END) + len(manifests.ROW_END)
+            )
+            if header is None:
+                header = chunk[:header_end]
+            elif chunk[:header_end] != header:
+                raise csv_sort.MergeError(
+                    '{0}: different header'.format(fname)
+                )
+            else:
+                stats.update(header)
+                chunk = chunk[header_end:]
+        stats.update(chunk)
+        output.write(chunk)
+
+    reader.join()
+    return file_stats
+
+
+class StatsWriter(object):
+
+    def __init__(self, output):
+        self.output = output
+        self.stats = manifests.StreamStats()
+
+    def write(self, data):
+        self.stats.update(data)
+        self.output.write(data)
+
+
+def verify(
+        rovat_dir, recorded, fnames, file_stats, output_stats, header_size):
+    '''Compare the merge with the recorded files, return the problems found
+
+    file_stats are the stats of the fnames merged - if they were counted.
+    '''
+    output_dir, table = os.path.split(rovat_dir)
+    if recorded is None:
+        sys.stderr.write(
+            'WARNING: no manifests in {0}, the merge of {1} is not checked\n'
+            .format(output_dir, table)
+        )
+        return []
+
+    problems = []
+    paths = [os.path.relpath(fname, output_dir) for fname in fnames]
+    for path in paths:
+        if path not in recorded:
+            problems.append('{0}: not recorded'.format(path))
+    for path in sorted(set(recorded) - set(paths)):
+        problems.append('{0}: missing'.format(path))
+    for fname, stats in file_stats:
+        path = os.path.relpath(fname, output_dir)
+        if path in recorded and stats.bytes != recorded[path][1]:
+            problems.append(
+                '{0}: {1} bytes instead of {2} bytes'
+                .format(path, stats.bytes, recorded[path][1])
+            )
+
+    expected_bytes = (
+        sum(size for rows, size in recorded.values())
+        - max(0, len(recorded) - 1) * header_size
+    )
+    if output_stats.bytes != expected_bytes:
+        problems.append(
+            '{0}.csv: {1} bytes instead of {2} bytes'
+            .format(table, output_stats.bytes, expected_bytes)
+        )
+    return problems
+
+
+def write_checksums(csv_name, recorded, file_stats, output_stats):
+    output_dir = os.path.dirname(csv_name)
+    rows = {}
+    if recorded is not None:
+        rows = dict((path, count) for path, (count, _) in recorded.items())
+        rows[os.path.basename(csv_name)] = sum(rows.values())
+    with open(csv_name + '.sha1', 'wb') as f:
+        for fname, stats in file_stats + [(csv_name, output_stats)]:
+            f.write(
+                '{0}\t{1}\t{2}\t{3}\n'.format(
+                    stats.hexdigest(),
+                    os.path.basename(fname),
+                    rows.get(os.path.relpath(fname, output_dir), '-'),
+                    stats.bytes
+                )
+            )
 
-    if not os.path.isdir(rovat_dir):
-        die_with('{} is not a directory'.format(rovat_dir))
 
-    files = sorted(os.listdir(rovat_dir))
-    if not files:
+def merge_rovat_dir(rovat_dir, sort=False, memory=256, file_limit=None):
+    '''Merge rovat_dir into rovat_dir.csv, return the problems found
+
+    A partial rovat_dir.csv is removed.  file_limit is the number of files
+    a sorted merge can open, see csv_sort.sort_merge.
+    '''
+    fnames = csv_fnames(rovat_dir)
+    if not fnames:
         os.rmdir(rovat_dir)
+        manifests.remove_merged_manifests(os.path.dirname(rovat_dir))
         print('WARNING: {} was empty'.format(rovat_dir))
-        return
+        return []
 
     csv_name = '{}.csv'.format(rovat_dir)
-    with open(csv_name, 'w') as csv_file:
-        subprocess.check_call(
-            ['csv_cat'] + files,
-            stdout=csv_file,
-            close_fds=True,
-            cwd=rovat_dir
+    try:
+        with open(csv_name, 'wb', BUFFER_SIZE) as csv_file:
+            output = StatsWriter(csv_file)
+            if sort:
+                # the files are checked only by the totals
+                file_stats = []
+                csv_sort.sort_merge(
+                    fnames,
+                    output,
+                    memory=memory * csv_sort.MEGABYTE,
+                    tmp_dir=os.path.dirname(rovat_dir),
+                    file_limit=file_limit
+                )
+            else:
+                file_stats = concatenate(fnames, output)
+    except BaseException as e:
+        if os.path.exists(csv_name):
+            os.remove(csv_name)
+        if isinstance(e, csv_sort.MergeError):
+            return [str(e)]
+        raise
+
+    output_dir, table = os.path.split(rovat_dir)
+    recorded = manifests.recorded_files(output_dir, table)
+    header_size = len(csv_sort.read_header(fnames[0]))
+    problems = verify(
+        rovat_dir, recorded, fnames, file_stats, output.stats, header_size
+    )
+    if problems:
+        return problems
+
+    write_checksums(csv_name, recorded, file_stats, output.stats)
+    # actively ignore errors as shutil.rmtree has problems on NFS
+    shutil.rmtree(rovat_dir, ignore_errors=True)
+    manifests.remove_merged_manifests(output_dir)
+    return []
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        '--sort',
+        action='store_true',
+        help='merge the sorted csv files to a csv sorted by ceg_id'
+    )
+    parser.add_argument(
+        '--memory',
+        type=int,
+        default=256,
+        metavar='MB',
+        help=(
+            'memory for the read buffers of --sort (default: %(default)s),'
+            ' with more files than fit they are merged in more passes'
         )
-        # actively ignore errors as shutil.rmtree has problems on NFS
-        shutil.rmtree(rovat_dir, ignore_errors=True)
+    )
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        default=1,
+        help='merge this many directories at once (default: %(default)s)'
+    )
+    parser.add_argument(
+        'rovat_dirs',
+        nargs='+',
+        metavar='rovat_dir',
+        help='the directory'
+    )
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    rovat_dirs = [os.path.abspath(rovat_dir) for rovat_dir in args.rovat_dirs]
+
+    for rovat_dir in rovat_dirs:
+        if not os.path.isdir(rovat_dir):
+            die_with('{} is not a directory'.format(rovat_dir))
+
+    # shared by the merges running at once
+    file_limit = csv_sort.open_file_limit()
+    if file_limit is not None:
+        file_limit //= args.jobs
+
+    def merge(rovat_dir):
+        return merge_rovat_dir(rovat_dir, args.sort, args.memory, file_limit)
+
+    if args.jobs > 1:
+        from multiprocessing.pool import ThreadPool
+
+        pool = ThreadPool(args.jobs)
+        try:
+            results = pool.map(merge, rovat_dirs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [merge(rovat_dir) for rovat_dir in rovat_dirs]
+
+    failed = False
+    for rovat_dir, problems in zip(rovat_dirs, results):
+        for problem in problems:
+            sys.stderr.write('{0}: {1}\n'.format(rovat_dir, problem))
+        failed = failed or bool(problems)
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
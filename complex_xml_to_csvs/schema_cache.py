@@ -0,0 +1,146 @@
+'''Precompiled Complex schema
+
+Reading the schema xls with `complex_schema` (and `xlrd`) takes noticeable
+time, which is paid again by every conversion job.  The tables are stored
+as JSON instead, either explicitly (complex-schema-compile) or implicitly in a
+cache keyed by the hash of the xls.
+'''
+
+import argparse
+import json
+import logging
+import os
+import sys
+
+
+log = logging.getLogger(__name__)
+
+COMPILED_SUFFIX = '.json'
+
+
+class Compiled(object):
+
+    '''Plain attribute holder standing in for complex_schema's Table/Field'''
+
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+    def __repr__(self):
+        return '<{0} {1}>'.format(self.__class__.__name__, self.name)
+
+
+class CompiledField(Compiled):
+    pass
+
+
+class CompiledTable(Compiled):
+
+    def __init__(self, fields, **attributes):
+        super(CompiledTable, self).__init__(**attributes)
+        self.fields = [CompiledField(**field) for field in fields]
+
+
+def table_as_dict(table):
+    attributes = dict(vars(table))
+    attributes['fields'] = [dict(vars(field)) for field in table.fields]
+    return attributes
+
+
+def compile_schema(schema_file_xls):
+    # xlrd is only needed here
+    import complex_schema
+    return complex_schema.read_tables(schema_file_xls)
+
+
+def compiled_tables(tables):
+    # the same kind of objects whether the schema came from the cache or not
+    return [CompiledTable(**table_as_dict(table)) for table in tables]
+
+
+def write_compiled(tables, fname):
+    tmp_fname = '{0}.{1}.tmp'.format(fname, os.getpid())
+    with open(tmp_fname, 'wb') as f:
+        json.dump([table_as_dict(table) for table in tables], f)
+    # concurrent jobs may compile the same schema: make it visible atomically
+    os.rename(tmp_fname, fname)
+
+
+def read_compiled(fname):
+    with open(fname, 'rb') as f:
+        return [CompiledTable(**table) for table in json.load(f)]
+
+
+def file_hash(fname):
+    import hashlib
+    digest = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cached_name(schema_file_xls, cache_dir=None):
+    return os.path.join(
+        cache_dir or os.path.dirname(os.path.abspath(schema_file_xls)),
+        '{0}.{1}{2}'.format(
+            os.path.basename(schema_file_xls),
+            file_hash(schema_file_xls)[:16],
+            COMPILED_SUFFIX
+        )
+    )
+
+
+def load_tables(schema_file, cache_dir=None):
+    '''Tables of a schema xls (cached) or of a precompiled schema file'''
+    if schema_file.endswith(COMPILED_SUFFIX):
+        return read_compiled(schema_file)
+
+    compiled_fname = cached_name(schema_file, cache_dir)
+    if os.path.exists(compiled_fname):
+        log.debug('Using compiled schema %s', compiled_fname)
+        return read_compiled(compiled_fname)
+
+    tables = compile_schema(schema_file)
+    try:
+        write_compiled(tables, compiled_fname)
+    except (IOError, OSError):
+        log.warning('Could not cache schema as %s', compiled_fname)
+    return compiled_tables(tables)
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description='Precompile the schema xls of a Complex dump'
+    )
+
+    parser.add_argument(
+        '--output',
+        help=(
+            'write the compiled schema to OUTPUT'
+            ' (default: cache it next to the xls or under --cache-dir)'
+        )
+    )
+    parser.add_argument(
+        '--cache-dir',
+        help='cache directory for compiled schemas'
+    )
+    parser.add_argument(
+        'schema_file_xls',
+        help='xls file accompanying Complex\'s dump'
+    )
+
+    return parser.parse_args(args)
+
+
+def main():
+    logging.basicConfig()
+    args = parse_args(sys.argv[1:])
+
+    tables = compile_schema(args.schema_file_xls)
+    output = args.output or cached_name(args.schema_file_xls, args.cache_dir)
+    write_compiled(tables, output)
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+'''Writing output files through a local scratch directory
+
+On network file systems every open, close, existence check and mkdir is a
+round trip, so writing many small batch files is latency bound.  Files
+are written to a local scratch directory instead and are moved to their
+destination by a pool of threads, concurrently.
+'''
+
+import logging
+import os
+import threading
+
+
+log = logging.getLogger(__name__)
+
+COPY_BUFFER_SIZE = 1 << 20
+
+
+class Publisher(object):
+
+    def __init__(self, scratch_dir, destination_dir, threads=4):
+        # deferred: only needed with a scratch directory
+        from multiprocessing.pool import ThreadPool
+
+        self.scratch_dir = scratch_dir
+        self.destination_dir = destination_dir
+        self.pool = ThreadPool(threads)
+        self.directories = set()
+        self.directories_lock = threading.Lock()
+        self.errors = []
+
+    def ensure_directory(self, dirname):
+        # mkdir is not cheap on NFS, do it only once
+        with self.directories_lock:
+            if dirname in self.directories:
+                return
+            if not os.path.isdir(dirname):
+                try:
+                    os.makedirs(dirname)
+                except OSError:
+                    # created by a parallel conversion
+                    if not os.path.isdir(dirname):
+                        raise
+            self.directories.add(dirname)
+
+    def local_name(self, fname):
+        '''Name in the scratch directory for the destination fname'''
+        local_fname = os.path.join(
+            self.scratch_dir,
+            os.path.relpath(fname, self.destination_dir)
+        )
+        self.ensure_directory(os.path.dirname(local_fname))
+        return local_fname
+
+    def move(self, fname):
+        import shutil
+
+        local_fname = self.local_name(fname)
+        try:
+            self.ensure_directory(os.path.dirname(fname))
+            with open(local_fname, 'rb') as local_file:
+                with open(fname, 'wb') as destination_file:
+                    shutil.copyfileobj(
+                        local_file, destination_file, COPY_BUFFER_SIZE
+                    )
+            os.unlink(local_fname)
+        except Exception as e:
+            log.exception('Could not move %s to %s', local_fname, fname)
+            self.errors.append(e)
+
+    def publish(self, fname):
+        '''Move the completed local version of fname to fname in background
+        '''
+        self.pool.apply_async(self.move, [fname])
+
+    def close(self):
+        '''Wait for all files to be moved'''
+        self.pool.close()
+        self.pool.join()
+        if self.errors:
+            raise IOError(
+                '{0} files could not be moved from {1}'.format(
+                    len(self.errors), self.scratch_dir
+                )
+            )
@@ -0,0 +1,213 @@
+'''\
+Send xml files to a complex-xml-to-csvs --listen SOCKET service.
+
+The service converts many input streams in a single long lived process: the
+schema is loaded and the worker processes are started only once.  A client
+connects to the local (unix) SOCKET and sends a request line:
+
+    FILE PATH               convert the local file (or named pipe) PATH
+    STREAM NAME             convert the xml following the line, up to the
+                            end of the sending side of the connection, as
+                            the file NAME
+
+and gets a line back when the conversion is complete:
+
+    converted<TAB>NAME   or   failed<TAB>NAME
+
+Streams are converted while they arrive: they are cut into chunks of ceg
+records, converted by the shared pool of worker processes, and appended to
+the OUTPUT_DIR/rovat_N.csv files of the service in stream order.
+'''
+
+import argparse
+import logging
+import os
+import socket
+import stat
+import sys
+import threading
+import SocketServer
+from collections import Counter
+
+
+log = logging.getLogger(__name__)
+
+BUFFER_SIZE = 1 << 20
+
+
+class ConversionRequestHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        self.server.start_request()
+        try:
+            self.handle_request()
+        finally:
+            self.server.end_request()
+
+    def handle_request(self):
+        request = self.rfile.readline().rstrip('\n')
+        kind, _, name = request.partition(' ')
+        converted, metrics = False, Counter()
+        if kind == 'FILE':
+            converted, metrics = self.convert_file(name)
+        elif kind == 'STREAM':
+            converted, metrics = self.server.convert(name, self.rfile)
+        else:
+            log.error('Unknown request: %r', request)
+        self.server.add_result(converted, metrics)
+        self.wfile.write(
+            '{0}\t{1}\n'.format('converted' if converted else 'failed', name)
+        )
+
+    def convert_file(self, fname):
+        try:
+            input_source = self.server.open_file(fname)
+        except IOError:
+            log.exception('Error opening %s', fname)
+            return False, Counter()
+        try:
+            return self.server.convert(fname, input_source)
+        finally:
+            input_source.close()
+
+
+class ConversionServer(
+        SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+
+    '''Serve every connection in its own thread by convert
+
+    convert(name, input_source) converts a stream, returns (success,
+    metrics).  report sums the metrics of the conversions.  After
+    server_close, wait_for_requests waits for the requests being served.
+    '''
+
+    def __init__(self, socket_path, convert, open_file=open):
+        remove_stale_socket(socket_path)
+        SocketServer.UnixStreamServer.__init__(
+            self, socket_path, ConversionRequestHandler
+        )
+        self.socket_path = socket_path
+        self.convert = convert
+        self.open_file = open_file
+        self.report = Counter()
+        self.report_lock = threading.Lock()
+        self.active_requests = 0
+        self.requests_done = threading.Condition()
+
+    def start_request(self):
+        with self.requests_done:
+            self.active_requests += 1
+
+    def end_request(self):
+        with self.requests_done:
+            self.active_requests -= 1
+            self.requests_done.notify_all()
+
+    def wait_for_requests(self):
+        with self.requests_done:
+            while self.active_requests:
+                self.requests_done.wait()
+
+    def add_result(self, converted, metrics):
+        with self.report_lock:
+            self.report.update(metrics)
+            if converted:
+                self.report['converted_files'] += 1
+            else:
+                self.report['failed_files'] += 1
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        remove_stale_socket(self.socket_path)
+
+
+def remove_stale_socket(socket_path):
+    try:
+        if stat.S_ISSOCK(os.stat(socket_path).st_mode):
+            os.remove(socket_path)
+    except OSError:
+        pass
+
+
+def connect(socket_path):
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(socket_path)
+    return connection
+
+
+def read_reply(connection):
+    reply = connection.makefile('rb').readline().rstrip('\n')
+    status, _, name = reply.partition('\t')
+    return status == 'converted'
+
+
+def convert_file(socket_path, fname):
+    '''Ask the service to convert its local file fname, return success'''
+    connection = connect(socket_path)
+    try:
+        connection.sendall('FILE {0}\n'.format(os.path.abspath(fname)))
+        return read_reply(connection)
+    finally:
+        connection.close()
+
+
+def convert_stream(socket_path, name, input_file):
+    '''Send input_file to the service to convert as name, return success'''
+    connection = connect(socket_path)
+    try:
+        connection.sendall('STREAM {0}\n'.format(name))
+        for block in iter(lambda: input_file.read(BUFFER_SIZE), ''):
+            connection.sendall(block)
+        connection.shutdown(socket.SHUT_WR)
+        return read_reply(connection)
+    finally:
+        connection.close()
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        '--stream',
+        action='store_true',
+        help=(
+            'send the content of the files instead of their names, for'
+            ' files the service can not read; - is the standard input'
+        )
+    )
+    parser.add_argument(
+        '--name',
+        default='stdin.xml',
+        help='file name of the standard input (default: %(default)s)'
+    )
+    parser.add_argument('socket', help='the socket of the service')
+    parser.add_argument('fnames', nargs='+', metavar='fname')
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    failed = False
+    for fname in args.fnames:
+        if fname == '-':
+            converted = convert_stream(args.socket, args.name, sys.stdin)
+        elif args.stream:
+            with open(fname, 'rb') as f:
+                converted = convert_stream(
+                    args.socket, os.path.basename(fname), f
+                )
+        else:
+            converted = convert_file(args.socket, fname)
+        if converted:
+            print(fname)
+        else:
+            sys.stderr.write('{0}: conversion failed\n'.format(fname))
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+'''Shards of the final rovat_N.csv files
+
+When input files are converted in parallel directly to the final csv files,
+every input file is written to its own shard directory.  The shards are
+appended to the final files in input order, which is a byte level
+concatenation: only the header of the shard files is dropped.
+
+Files can also be cut into chunks converted in parallel, every chunk having
+its own shard, tagged with a sequence number, so that the output of the
+parallel run is the same as that of a serial run.
+'''
+
+import os
+
+import ceg_index
+
+
+SHARDS_DIR = '_shards'
+COPY_BUFFER_SIZE = 1 << 20
+
+
+def shard_dir(root_dir, sequence):
+    return os.path.join(root_dir, SHARDS_DIR, '{0:06d}'.format(sequence))
+
+
+def make_shards_dir(root_dir):
+    try:
+        os.makedirs(os.path.join(root_dir, SHARDS_DIR))
+    except OSError:
+        pass
+
+
+class ReorderBuffer(object):
+
+    '''Release items added in any order by their consecutive sequence number
+    '''
+
+    def __init__(self, first_sequence=0):
+        self.next_sequence = first_sequence
+        self.waiting = {}
+
+    def __len__(self):
+        return len(self.waiting)
+
+    def add(self, sequence, item):
+        assert sequence >= self.next_sequence, sequence
+        assert sequence not in self.waiting, sequence
+        self.waiting[sequence] = item
+
+    def ready(self):
+        while self.next_sequence in self.waiting:
+            yield self.next_sequence, self.waiting.pop(self.next_sequence)
+            self.next_sequence += 1
+
+
+def final_csv_names(output_dir):
+    return sorted(
+        fname
+        for fname in os.listdir(output_dir)
+        if fname.startswith('rovat_') and fname.endswith('.csv')
+    )
+
+
+def append_csv(shard_csv, final_csv):
+    '''Append shard_csv to final_csv, return the shift of shard offsets'''
+    import shutil
+
+    with open(shard_csv, 'rb') as shard:
+        with open(final_csv, 'ab') as final:
+            final.seek(0, os.SEEK_END)
+            shift = final.tell()
+            if shift != 0:
+                # skip header
+                shift -= len(shard.readline())
+            shutil.copyfileobj(shard, final, COPY_BUFFER_SIZE)
+    return shift
+
+
+def merge_shard(shard_dir, output_dir):
+    import shutil
+
+    for fname in final_csv_names(shard_dir):
+        shift = append_csv(
+            os.path.join(shard_dir, fname),
+            os.path.join(output_dir, fname)
+        )
+        table_name = fname[:-len('.csv')]
+        shard_index = ceg_index.log_name(shard_dir, table_name)
+        if os.path.exists(shard_index):
+            ceg_index.append_shifted_index(
+                shard_index,
+                ceg_index.log_name(output_dir, table_name),
+                shift
+            )
+    shutil.rmtree(shard_dir)
+
+
+def remove_shards_dir(root_dir):
+    try:
+        os.rmdir(os.path.join(root_dir, SHARDS_DIR))
+    except OSError:
+        # left over shards of failed conversions
+        pass
@@ -0,0 +1,170 @@
+'''Normalisation of field values while converting
+
+Transforms work on columns: they get all the values of a field in a batch
+as a list and return the list of the transformed values.
+
+They are declared against the field names of the schema, by
+specifications like
+
+    rovat_3.datum=date      the datum field of rovat_3
+    nev=strip,lines         the nev field of any table
+    *=strip                 every field (but alrovat_id)
+
+Values are unicode, or utf-8 encoded str with the expat engine: the
+transforms give the same results for both.
+'''
+
+import re
+
+
+DATE = re.compile(r'^\s*(\d{4})[-./ ]?(\d{2})[-./ ]?(\d{2})\.?\s*$')
+NUMBER = re.compile(r'^\s*[-+]?[\d ]*(?:[.,]\d+)?\s*$')
+
+
+class InvalidTransformSpec(ValueError):
+    pass
+
+
+def strip_value(value):
+    '''value.strip(), also stripping the non-ascii (unicode) whitespace,
+    e.g. no-break space, of utf-8 encoded str values
+    '''
+    stripped = value.strip()
+    if isinstance(stripped, str) and (
+            stripped[:1] >= '\x80' or stripped[-1:] >= '\x80'):
+        return stripped.decode('utf-8').strip().encode('utf-8')
+    return stripped
+
+
+def strip(values):
+    return [strip_value(value) for value in values]
+
+
+def stripped_lines(value):
+    '''The stripped, non-empty lines (from ujsor elements) of value'''
+    return [
+        line for line in (strip_value(line) for line in value.split('\n'))
+        if line
+    ]
+
+
+def lines(values):
+    '''Strip the lines (from ujsor elements), drop the empty ones'''
+    return ['\n'.join(stripped_lines(value)) for value in values]
+
+
+def oneline(values):
+    '''Join the stripped, non-empty lines (from ujsor elements) by a space'''
+    return [' '.join(stripped_lines(value)) for value in values]
+
+
+def date(values):
+    '''1999.12.31 -> 1999-12-31, values that are not dates are kept'''
+    dates = []
+    for value in values:
+        match = DATE.match(value)
+        if match:
+            value = '-'.join(match.groups())
+        dates.append(value)
+    return dates
+
+
+def number(values):
+    '''1 234,5 -> 1234.5, values that are not numbers are kept'''
+    numbers = []
+    for value in values:
+        if NUMBER.match(value) and value.strip():
+            value = value.replace(' ', '').replace(',', '.')
+        numbers.append(value)
+    return numbers
+
+
+TRANSFORMS = dict(
+    strip=strip,
+    lines=lines,
+    oneline=oneline,
+    date=date,
+    number=number,
+)
+
+ALL_FIELDS = '*'
+
+
+class ColumnTransforms(object):
+
+    '''Transforms for the columns (table name, field name) of a schema'''
+
+    def __init__(self, specs, tables):
+        self.fields_per_tables = dict(
+            (table.name, set(field.name for field in table.fields))
+            for table in tables
+        )
+        self.declarations = [self.parse(spec) for spec in specs]
+        self.columns = {}
+
+    def parse(self, spec):
+        try:
+            column, transform_names = spec.split('=')
+        except ValueError:
+            raise InvalidTransformSpec(
+                '{0}: expected FIELD=TRANSFORM[,TRANSFORM...]'.format(spec)
+            )
+
+        if '.' in column:
+            table_name, field_name = column.split('.', 1)
+        else:
+            table_name, field_name = None, column
+        self.check_field(spec, table_name, field_name)
+
+        transforms = []
+        for name in transform_names.split(','):
+            if name not in TRANSFORMS:
+                raise InvalidTransformSpec(
+                    '{0}: unknown transform {1}, known ones: {2}'.format(
+                        spec, name, ', '.join(sorted(TRANSFORMS))
+                    )
+                )
+            transforms.append(TRANSFORMS[name])
+        return table_name, field_name, transforms
+
+    def check_field(self, spec, table_name, field_name):
+        if table_name is None:
+            known = (
+                field_name == ALL_FIELDS
+                or any(
+                    field_name in fields
+                    for fields in self.fields_per_tables.values()
+                )
+            )
+        else:
+            fields = self.fields_per_tables.get(table_name)
+            if fields is None:
+                raise InvalidTransformSpec(
+                    '{0}: unknown table {1}'.format(spec, table_name)
+                )
+            known = field_name == ALL_FIELDS or field_name in fields
+        if not known:
+            raise InvalidTransformSpec(
+                '{0}: unknown field {1}'.format(spec, field_name)
+            )
+
+    def __nonzero__(self):
+        return bool(self.declarations)
+
+    def for_column(self, table_name, field_name):
+        '''The list of transforms for the column, in declaration order'''
+        column = table_name, field_name
+        if column not in self.columns:
+            self.columns[column] = [
+                transform
+                for declared_table, declared_field, transforms
+                in self.declarations
+                if declared_table in (None, table_name)
+                and (
+                    declared_field == field_name
+                    or (declared_field == ALL_FIELDS
+                        and field_name != 'alrovat_id')
+                )
+                for transform in transforms
+            ]
+        return self.columns[column]
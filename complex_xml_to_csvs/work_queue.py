@@ -0,0 +1,244 @@
+'''Work queue in a shared directory, for converting on several hosts
+
+The input files are added to the queue, then converter workers started on
+any number of hosts (complex-xml-to-csvs --work-queue QUEUE_DIR) claim and
+convert them until the queue is empty.  An item is a file in one of the
+state directories:
+
+    QUEUE_DIR/todo/NNNNNNNN             the item: the input file name
+    QUEUE_DIR/todo/NNNNNNNN.requeued    requeued after a crashed worker
+    QUEUE_DIR/claimed/NNNNNNNN.WORKER   being converted by WORKER
+    QUEUE_DIR/done/NNNNNNNN
+    QUEUE_DIR/failed/NNNNNNNN
+
+Items move between states by rename, which is atomic on a shared file
+system too: of the workers claiming an item only one succeeds.  Creating a
+directory is atomic as well, so QUEUE_DIR/merging is created by the single
+worker that merges the output when all the items are finished.
+'''
+
+import argparse
+import os
+import socket
+import sys
+import time
+from collections import namedtuple
+
+
+TODO = 'todo'
+CLAIMED = 'claimed'
+DONE = 'done'
+FAILED = 'failed'
+STATES = (TODO, CLAIMED, DONE, FAILED)
+MERGING = 'merging'
+# the output left by the crashed worker of a requeued item is to be removed
+REQUEUED_SUFFIX = '.requeued'
+
+
+def worker_name():
+    return '{0}.{1}'.format(socket.gethostname(), os.getpid())
+
+
+def item_name(sequence):
+    return '{0:08d}'.format(sequence)
+
+
+def sequence_of(name):
+    return int(name.split('.', 1)[0])
+
+
+class Item(namedtuple('Item', 'sequence fname requeued')):
+
+    @property
+    def name(self):
+        '''Name of the item in the todo directory'''
+        if self.requeued:
+            return item_name(self.sequence) + REQUEUED_SUFFIX
+        return item_name(self.sequence)
+
+
+class WorkQueue(object):
+
+    def __init__(self, queue_dir):
+        self.queue_dir = queue_dir
+
+    def path(self, state, name=''):
+        return os.path.join(self.queue_dir, state, name)
+
+    def names(self, state):
+        return sorted(
+            name
+            for name in os.listdir(self.path(state))
+            if not name.startswith('.')
+        )
+
+    def create(self):
+        for state in STATES:
+            if not os.path.isdir(self.path(state)):
+                os.makedirs(self.path(state))
+
+    def add(self, fnames):
+        '''Add input files as new items, return the number added'''
+        self.create()
+        sequence = 1 + max(
+            [-1] + [
+                sequence_of(name)
+                for state in STATES
+                for name in self.names(state)
+            ]
+        )
+        added = 0
+        for fname in fnames:
+            # written under a hidden name: workers must not claim it half done
+            tmp_name = self.path(TODO, '.' + item_name(sequence))
+            with open(tmp_name, 'wb') as f:
+                f.write(fname)
+            os.rename(tmp_name, self.path(TODO, item_name(sequence)))
+            sequence += 1
+            added += 1
+        return added
+
+    def claim(self, worker):
+        '''Take the next item to do, None if there are no more'''
+        for name in self.names(TODO):
+            claimed_name = self.path(CLAIMED, '{0}.{1}'.format(name, worker))
+            try:
+                os.rename(self.path(TODO, name), claimed_name)
+            except OSError:
+                # claimed by another worker
+                continue
+            # the age of the claim, for requeueing stale ones
+            os.utime(claimed_name, None)
+            with open(claimed_name, 'rb') as f:
+                return Item(
+                    sequence_of(name),
+                    f.read(),
+                    name.endswith(REQUEUED_SUFFIX)
+                )
+        return None
+
+    def finish(self, item, worker, success):
+        '''Record the result of item, False if its claim was taken back
+
+        An item requeued while its worker was still converting it belongs
+        to its new claimer: its result is not recorded.
+        '''
+        try:
+            os.rename(
+                self.path(CLAIMED, '{0}.{1}'.format(item.name, worker)),
+                self.path(
+                    DONE if success else FAILED, item_name(item.sequence)
+                )
+            )
+        except OSError:
+            return False
+        return True
+
+    def counts(self):
+        return dict((state, len(self.names(state))) for state in STATES)
+
+    def is_complete(self):
+        return not self.names(TODO) and not self.names(CLAIMED)
+
+    def finished_sequences(self):
+        return sorted(
+            sequence_of(name)
+            for state in (DONE, FAILED)
+            for name in self.names(state)
+        )
+
+    def start_merge(self):
+        '''True for exactly one caller: the one to merge the output'''
+        try:
+            os.mkdir(os.path.join(self.queue_dir, MERGING))
+        except OSError:
+            return False
+        return True
+
+    def requeue(self, older_than):
+        '''Put back the items claimed at least older_than seconds ago (by
+        crashed workers), return their number
+        '''
+        requeued = 0
+        now = time.time()
+        for name in self.names(CLAIMED):
+            claimed_name = self.path(CLAIMED, name)
+            if now - os.path.getmtime(claimed_name) < older_than:
+                continue
+            try:
+                os.rename(
+                    claimed_name,
+                    self.path(
+                        TODO, item_name(sequence_of(name)) + REQUEUED_SUFFIX
+                    )
+                )
+            except OSError:
+                # finished meanwhile
+                continue
+            requeued += 1
+        return requeued
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description=(
+            'Manage the shared work queue of complex-xml-to-csvs'
+            ' --work-queue workers'
+        )
+    )
+    subparsers = parser.add_subparsers(dest='command')
+
+    add = subparsers.add_parser(
+        'add',
+        help='add input files, by default read from stdin, one per line'
+    )
+    add.add_argument('queue_dir')
+    add.add_argument('complex_xml_files', nargs='*')
+
+    status = subparsers.add_parser(
+        'status', help='print the number of items in each state'
+    )
+    status.add_argument('queue_dir')
+
+    requeue = subparsers.add_parser(
+        'requeue', help='put back items claimed by crashed workers'
+    )
+    requeue.add_argument('queue_dir')
+    requeue.add_argument(
+        '--older-than',
+        type=float,
+        required=True,
+        metavar='MINUTES',
+        help=(
+            'only items claimed at least this long ago: longer than the'
+            ' conversion of a file takes, as the items of live workers would'
+            ' be converted twice (0: all)'
+        )
+    )
+
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    queue = WorkQueue(args.queue_dir)
+
+    if args.command == 'add':
+        fnames = args.complex_xml_files or (
+            line.strip() for line in sys.stdin if line.strip()
+        )
+        print('{0} items added'.format(queue.add(fnames)))
+    elif args.command == 'status':
+        counts = queue.counts()
+        for state in STATES:
+            print('{0}\t{1}'.format(state, counts[state]))
+    elif args.command == 'requeue':
+        print(
+            '{0} items requeued'.format(
+                queue.requeue(older_than=args.older_than * 60)
+            )
+        )
+
+
+if __name__ == '__main__':
+    main()
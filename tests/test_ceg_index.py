@@ -0,0 +1,138 @@
+from unittest import TestCase
+import os
+import shutil
+import StringIO
+import tempfile
+from complex_xml_to_csvs import ceg_index as module
+
+
+class TestCegIndex(TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.output_dir, 'rovat_1'))
+        self.csv_name = os.path.join(self.output_dir, 'rovat_1', 'a_0000.csv')
+        with open(self.csv_name, 'wb') as f:
+            f.write('ceg_id,x\r\n1,a\r\n1,b\r\n2,"c\nc"\r\n')
+        module.CegIndexWriter(self.output_dir).write(
+            'rovat_1',
+            self.csv_name,
+            [('1', 10, 10), ('2', 20, 10)]
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_paths_are_relative_to_output_dir(self):
+        self.assertEqual(
+            [
+                ('1', 'rovat_1/a_0000.csv', 10, 10),
+                ('2', 'rovat_1/a_0000.csv', 20, 10),
+            ],
+            list(module.read_entries(
+                module.log_name(self.output_dir, 'rovat_1')
+            ))
+        )
+
+    def test_lookup(self):
+        self.assertEqual(
+            [('rovat_1/a_0000.csv', '2,"c\nc"\r\n')],
+            list(module.lookup(self.output_dir, 'rovat_1', ['2']))
+        )
+
+    def test_lookup_in_the_merged_index(self):
+        module.merge_indexes(self.output_dir)
+        self.assertFalse(
+            os.path.exists(module.log_name(self.output_dir, 'rovat_1'))
+        )
+        self.assertEqual(
+            [('rovat_1/a_0000.csv', '2,"c\nc"\r\n')],
+            list(module.lookup(self.output_dir, 'rovat_1', ['2']))
+        )
+
+    def test_merge_keeps_the_index_sorted(self):
+        writer = module.CegIndexWriter(self.output_dir)
+        module.merge_indexes(self.output_dir)
+        writer.write('rovat_1', self.csv_name, [('3', 0, 1), ('0', 1, 1)])
+        writer.write('rovat_1', self.csv_name, [('1', 2, 1)])
+        module.merge_indexes(self.output_dir)
+        self.assertEqual(
+            [('0', 1), ('1', 10), ('1', 2), ('2', 20), ('3', 0)],
+            [
+                (ceg_id, offset)
+                for ceg_id, _, offset, _ in module.read_entries(
+                    module.index_name(self.output_dir, 'rovat_1')
+                )
+            ]
+        )
+
+    def test_entries_of_merged_and_appended_index(self):
+        writer = module.CegIndexWriter(self.output_dir)
+        module.merge_indexes(self.output_dir)
+        writer.write('rovat_1', self.csv_name, [('2', 30, 1)])
+        self.assertEqual(
+            [20, 30],
+            [
+                offset
+                for _, _, offset, _ in module.index_entries(
+                    self.output_dir, 'rovat_1', set(['2'])
+                )
+            ]
+        )
+        self.assertEqual(
+            ['rovat_1'], module.index_table_names(self.output_dir)
+        )
+
+    def test_sorted_index_is_bisected(self):
+        writer = module.CegIndexWriter(self.output_dir)
+        ceg_ids = ['{0:010d}'.format(i * 7 % 1000) for i in range(1000)]
+        writer.write(
+            'rovat_2', self.csv_name,
+            [(ceg_id, int(ceg_id), len(ceg_id)) for ceg_id in ceg_ids]
+        )
+        module.merge_indexes(self.output_dir)
+        index = module.SortedIndex(
+            module.index_name(self.output_dir, 'rovat_2')
+        )
+        try:
+            for ceg_id in ['0000000000', '0000000500', '0000000999']:
+                self.assertEqual(
+                    [int(ceg_id)],
+                    [offset for _, _, offset, _ in index.entries(ceg_id)]
+                )
+            for ceg_id in ['', '0000000500x', '1']:
+                self.assertEqual([], list(index.entries(ceg_id)))
+        finally:
+            index.close()
+
+    def test_empty_index(self):
+        open(module.index_name(self.output_dir, 'rovat_2'), 'wb').close()
+        self.assertEqual(
+            [], list(module.lookup(self.output_dir, 'rovat_2', ['1']))
+        )
+
+    def test_write_rows_starts_with_the_header(self):
+        output = StringIO.StringIO()
+        self.assertTrue(
+            module.write_rows(self.output_dir, 'rovat_1', ['1'], output)
+        )
+        self.assertEqual('ceg_id,x\r\n1,a\r\n1,b\r\n', output.getvalue())
+
+    def test_unknown_ceg(self):
+        output = StringIO.StringIO()
+        self.assertFalse(
+            module.write_rows(self.output_dir, 'rovat_1', ['3'], output)
+        )
+        self.assertEqual('', output.getvalue())
+
+    def test_append_shifted_index(self):
+        final_index = os.path.join(self.output_dir, 'final.idx')
+        module.append_shifted_index(
+            module.log_name(self.output_dir, 'rovat_1'),
+            final_index,
+            100
+        )
+        self.assertEqual(
+            [110, 120],
+            [offset for _, _, offset, _ in module.read_entries(final_index)]
+        )
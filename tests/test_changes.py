@@ -0,0 +1,122 @@
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+from complex_xml_to_csvs import changes as module
+
+
+class Test_content_hash(TestCase):
+
+    def document(self, **rovats):
+        return dict(rovats, ceg_id=u'0000000001')
+
+    def test_order_of_rovats_and_mezos_does_not_matter(self):
+        self.assertEquals(
+            module.content_hash(
+                self.document(r1=[dict(a=u'x', b=u'y')], r2=[dict(c=u'z')])
+            ),
+            module.content_hash(
+                self.document(r2=[dict(c=u'z')], r1=[dict(b=u'y', a=u'x')])
+            )
+        )
+
+    def test_values_and_their_place_matter(self):
+        hashes = set(
+            module.content_hash(self.document(**rovats))
+            for rovats in (
+                dict(r1=[dict(a=u'x')]),
+                dict(r1=[dict(a=u'\xe1')]),
+                dict(r1=[dict(b=u'x')]),
+                dict(r2=[dict(a=u'x')]),
+                dict(r1=[dict(a=u'x'), dict(a=u'x')]),
+                dict(r1=[dict(a=u'x', b=u'')]),
+            )
+        )
+        self.assertEquals(6, len(hashes))
+
+
+class TestHashDatabase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.database_fname = os.path.join(self.tmpdir, 'hashes.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def collect(self, sequence, hashes):
+        collector = module.HashCollector(
+            module.part_name(
+                self.database_fname, '{0:06d}.complex'.format(sequence)
+            )
+        )
+        for ceg_id, digest in hashes:
+            collector.add(ceg_id, digest.ljust(module.DIGEST_SIZE))
+        collector.close()
+
+    def update(self):
+        deleted_fname = os.path.join(self.tmpdir, 'deleted')
+        deleted = module.update_database(self.database_fname, deleted_fname)
+        with open(deleted_fname) as f:
+            self.assertEquals(deleted, len(f.read().split()))
+            f.seek(0)
+            return f.read().split()
+
+    def test_parts_are_merged_into_the_database(self):
+        self.collect(1, [(u'3', 'c'), (u'1', 'a')])
+        self.collect(0, [(u'2', 'b'), (u'4', 'd')])
+
+        self.assertEquals([], self.update())
+
+        database = module.HashDatabase(self.database_fname)
+        try:
+            self.assertEquals(4, len(database))
+            for ceg_id, digest in zip('1234', 'abcd'):
+                self.assertEquals(
+                    digest.ljust(module.DIGEST_SIZE), database.get(ceg_id)
+                )
+            self.assertIsNone(database.get(u'0'))
+            self.assertIsNone(database.get(u'5'))
+        finally:
+            database.close()
+        self.assertFalse(
+            os.path.exists(module.parts_dir(self.database_fname))
+        )
+
+    def test_missing_cegs_are_deleted(self):
+        self.collect(0, [(u'1', 'a'), (u'2', 'b'), (u'3', 'c')])
+        self.update()
+
+        self.collect(0, [(u'2', 'b'), (u'4', 'd')])
+
+        self.assertEquals(['1', '3'], self.update())
+
+    def test_the_first_record_of_a_ceg_is_kept(self):
+        self.collect(0, [(u'1', 'z'), (u'2', 'y'), (u'1', 'a')])
+        self.collect(2, [(u'3', 'a')])
+        self.collect(10, [(u'3', 'b'), (u'2', 'a')])
+        self.update()
+
+        database = module.HashDatabase(self.database_fname)
+        try:
+            self.assertEquals(3, len(database))
+            for ceg_id, digest in zip('123', 'zya'):
+                self.assertEquals(
+                    digest.ljust(module.DIGEST_SIZE), database.get(ceg_id)
+                )
+        finally:
+            database.close()
+
+    def test_empty_database(self):
+        self.update()
+
+        database = module.HashDatabase(self.database_fname)
+        try:
+            self.assertEquals(0, len(database))
+            self.assertIsNone(database.get(u'1'))
+        finally:
+            database.close()
+
+    def test_too_long_ceg_id(self):
+        with self.assertRaises(ValueError):
+            module.record_key(u'1' * (module.ID_WIDTH + 1))
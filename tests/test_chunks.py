@@ -0,0 +1,99 @@
+from unittest import TestCase
+import StringIO
+import xml.dom.minidom
+from complex_xml_to_csvs import chunks as module
+
+
+def complex_xml(ceg_ids):
+    return (
+        '<?xml version="1.0" encoding="ISO8859-2" ?>\n<export>\n'
+        + ''.join(
+            '<ceg id="{0}">\n<rovat id="1"><alrovat id="1">'
+            '<mezo id="a">&lt;ceg {0}</mezo>'
+            '</alrovat></rovat>\n</ceg>\n'.format(ceg_id)
+            for ceg_id in ceg_ids
+        )
+        + '</export>\n'
+    )
+
+
+def ceg_ids(document):
+    return [
+        ceg.getAttribute('id')
+        for ceg in xml.dom.minidom.parseString(document)
+        .getElementsByTagName('ceg')
+    ]
+
+
+class TestCegChunks(TestCase):
+
+    def chunks(self, document, chunk_size):
+        return list(
+            module.ceg_chunks(StringIO.StringIO(document), chunk_size)
+        )
+
+    def test_chunks_are_documents_with_all_the_cegs_in_order(self):
+        ids = [str(i) for i in range(20)]
+        chunks = self.chunks(complex_xml(ids), 150)
+
+        self.assertLess(1, len(chunks))
+        self.assertEqual(
+            ids,
+            sum((ceg_ids(chunk) for chunk in chunks), [])
+        )
+
+    def test_chunks_keep_the_xml_declaration(self):
+        for chunk in self.chunks(complex_xml(['1', '2', '3']), 10):
+            self.assertTrue(
+                chunk.startswith('<?xml version="1.0" encoding="ISO8859-2" ?>')
+            )
+
+    def test_large_chunk_size_gives_the_input(self):
+        document = complex_xml(['1', '2'])
+        self.assertEqual([document], self.chunks(document, 1 << 20))
+
+    def test_no_ceg(self):
+        document = complex_xml([])
+        self.assertEqual([document], self.chunks(document, 5))
+
+    def test_similar_element_names_do_not_split(self):
+        self.assertEqual(-1, module.find_ceg_start('<cegx id="1">'))
+        self.assertEqual(3, module.find_ceg_start('<a><ceg id="1">'))
+        self.assertEqual(3, module.rfind_ceg_start('<a><ceg>x<cegx>'))
+
+
+class TestCegRecords(TestCase):
+
+    def records(self, document, block_size):
+        return list(
+            module.ceg_records(StringIO.StringIO(document), block_size)
+        )
+
+    def test_records_are_the_cegs_with_their_offsets(self):
+        document = complex_xml([str(i) for i in range(10)])
+        for block_size in (7, 100, 1 << 20):
+            records = self.records(document, block_size)
+
+            self.assertEqual(
+                [str(i) for i in range(10)],
+                [module.ceg_id_of(record) for _, _, record in records]
+            )
+            for head, offset, record in records:
+                self.assertEqual(document[:document.index('<ceg')], head)
+                self.assertEqual(
+                    record,
+                    document[offset:offset + len(record)]
+                )
+                self.assertTrue(record.startswith('<ceg id='))
+                self.assertTrue(record.endswith('</ceg>\n'))
+
+    def test_malformed_record_does_not_affect_the_others(self):
+        document = complex_xml(['1', '2', '3']).replace('</ceg>', '</c>', 1)
+        records = self.records(document, 16)
+
+        self.assertEqual(['1', '2', '3'], [
+            module.ceg_id_of(record) for _, _, record in records
+        ])
+        self.assertIn('</c>', records[0][2])
+        for head, _, record in records[1:]:
+            ceg_ids(head + record + module.EXPORT_END)
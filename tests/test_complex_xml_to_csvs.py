@@ -1,11 +1,22 @@
 # -*- encoding: utf-8 -*-
 import sys
+import itertools
 from unittest import TestCase
 from complex_xml_to_csvs import complex_xml_to_csvs as module
 from complex_xml_to_csvs import record_processors
 import xml.sax
 import StringIO
 import mock
+import os
+import json
+import copy
+import shutil
+import tempfile
+import threading
+from complex_xml_to_csvs.schema_cache import CompiledTable
+from complex_xml_to_csvs import ceg_index
+from complex_xml_to_csvs import shards
+from complex_xml_to_csvs.work_queue import WorkQueue
 
 
 VALID_COMPLEX_XML = '''<?xml version="1.0" encoding="ISO8859-2" ?>
@@ -299,6 +310,70 @@ class TestState(TestCase):
             s.document
         )
 
+    def repeated_mezo(self, duplicates):
+        s = module.State(duplicates=duplicates)
+        s.start_ceg('a ceg_id')
+        s.start_rovat('a rovat')
+        s.start_alrovat('alrovat')
+        for value in ('first', 'second'):
+            s.start_mezo('mezo')
+            s.append_mezo(value)
+        return s
+
+    def test_repeated_mezo_is_replaced_by_default(self):
+        s = self.repeated_mezo('last')
+        self.assertEquals('second', s.alrovat['mezo'])
+        self.assertEquals(1, s.counts['duplicate_mezos'])
+
+    def test_repeated_mezo_is_ignored(self):
+        s = self.repeated_mezo('first')
+        self.assertEquals('first', s.alrovat['mezo'])
+        self.assertEquals(1, s.counts['duplicate_mezos'])
+
+    def test_repeated_mezo_is_concatenated(self):
+        s = self.repeated_mezo('concat')
+        self.assertEquals('first\nsecond', s.alrovat['mezo'])
+
+    def test_repeated_mezo_is_an_error(self):
+        with self.assertRaises(module.DuplicateId):
+            self.repeated_mezo('error')
+
+    def repeated_rovat(self, duplicates):
+        s = module.State(duplicates=duplicates)
+        s.start_ceg('a ceg_id')
+        for alrovat_id in ('1', '2'):
+            s.start_rovat('a rovat')
+            s.start_alrovat(alrovat_id)
+        return s
+
+    def alrovat_ids(self, state):
+        return [
+            alrovat['alrovat_id'] for alrovat in state.document['a rovat']
+        ]
+
+    def test_repeated_rovat(self):
+        self.assertEquals(['2'], self.alrovat_ids(self.repeated_rovat('last')))
+        self.assertEquals(
+            ['1'], self.alrovat_ids(self.repeated_rovat('first'))
+        )
+        self.assertEquals(
+            ['1', '2'], self.alrovat_ids(self.repeated_rovat('concat'))
+        )
+        with self.assertRaises(module.DuplicateId):
+            self.repeated_rovat('error')
+
+    def test_duplicates_are_counted(self):
+        s = self.repeated_rovat('first')
+        s.start_ceg('another ceg_id')
+        s.start_rovat('a rovat')
+        self.assertEquals(
+            dict(duplicate_rovats=1, duplicate_mezos=0),
+            dict(
+                duplicate_rovats=s.counts['duplicate_rovats'],
+                duplicate_mezos=s.counts['duplicate_mezos']
+            )
+        )
+
     def test_complete_record_calls_record_processor_with_the_record(self):
         rp = record_processors.RecordProcessor()
         rp.process = mock.Mock(rp.process)
@@ -461,6 +536,158 @@ class TestFileProcessor(TestCase):
         self.assertEquals(['process', 'flush'], calls)
 
 
+class Test_expat_parse(TestCase):
+
+    def parse(self, document):
+        rp = record_processors.RecordProcessor()
+        rp.process = mock.Mock(rp.process)
+        module.expat_parse(
+            StringIO.StringIO(document),
+            no_output_xml_processor(state=module.State(rp)),
+            block_size=16
+        )
+        return rp.process
+
+    def test_records_are_the_same_as_parsed_by_sax(self):
+        self.parse(VALID_COMPLEX_XML).assert_called_once_with(
+            VALID_COMPLEX_XML_AS_JSON
+        )
+
+    def test_text_is_utf8_encoded_str(self):
+        process = self.parse(
+            VALID_COMPLEX_XML.replace('>10<', '>\xe1\xf5<ujsor/>x<')
+        )
+
+        value = process.call_args[0][0]['0'][0]['plus']
+        self.assertEquals(str, type(value))
+        self.assertEquals(u'\xe1\u0151\nx'.encode('utf-8'), value)
+
+    def test_errors_are_sax_parse_exceptions(self):
+        with self.assertRaises(xml.sax.SAXParseException) as context:
+            self.parse(VALID_COMPLEX_XML.replace('</alrovat>', '</alrov>'))
+        self.assertEquals(10, context.exception.getLineNumber())
+
+        with self.assertRaises(module.InvalidHierarchy) as context:
+            self.parse(VALID_COMPLEX_XML.replace('<ceg ', '<rovat '))
+        self.assertEquals(3, context.exception.getLineNumber())
+
+    def test_errors_are_located_in_the_file(self):
+        f = StringIO.StringIO(VALID_COMPLEX_XML.replace('</alrovat>', ''))
+        f.name = 'complex.xml'
+        with self.assertRaises(xml.sax.SAXParseException) as context:
+            module.expat_parse(f, no_output_xml_processor())
+        self.assertEquals('complex.xml', context.exception.getSystemId())
+
+
+class Test_iter_records(TestCase):
+
+    def setUp(self):
+        self.document = synthetic_complex_xml(1, 40)
+        self.records = self.processed_records('sax')
+
+    def processed_records(self, engine):
+        rp = record_processors.RecordProcessor()
+        rp.process = mock.Mock(rp.process)
+        module.FileProcessor(rp, module.ENGINES[engine]).process(
+            StringIO.StringIO(self.document)
+        )
+        return [args[0] for args, _ in rp.process.call_args_list]
+
+    def test_records_are_the_same_as_processed(self):
+        for engine in 'sax', 'expat':
+            self.assertEquals(
+                self.processed_records(engine),
+                list(
+                    module.iter_records(
+                        StringIO.StringIO(self.document), engine,
+                        block_size=100
+                    )
+                )
+            )
+
+    def test_records_are_generated_while_reading(self):
+        f = TrackedFile(self.document)
+        records = module.iter_records(f, block_size=100)
+
+        self.assertEquals(self.records[0], next(records))
+        self.assertTrue(f.tell() < len(self.document) / 4)
+
+    def test_early_termination_closes_the_file(self):
+        f = TrackedFile(self.document)
+        with mock.patch.object(module, 'open_file', return_value=f):
+            first = list(
+                itertools.islice(module.iter_records('complex.xml'), 3)
+            )
+
+        self.assertEquals(self.records[:3], first)
+        self.assertTrue(f.closed)
+
+    def test_file_objects_are_not_closed(self):
+        f = TrackedFile(self.document)
+        list(module.iter_records(f))
+        self.assertFalse(f.closed)
+
+    def test_parse_errors_are_raised(self):
+        records = module.iter_records(
+            StringIO.StringIO(self.document.replace('</rovat>', '', 1)),
+            'expat'
+        )
+        with self.assertRaises(xml.sax.SAXParseException):
+            list(records)
+
+
+class TrackedFile(StringIO.StringIO):
+
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class Test_make_directory(TestCase):
+
+    def test_removed_directory_is_made_again(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            dirname = os.path.join(tmpdir, 'shard')
+            module.make_directory(dirname)
+            os.rmdir(dirname)
+            module.make_directory(dirname)
+            self.assertTrue(os.path.isdir(dirname))
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class TestImports(TestCase):
+
+    def test_heavy_modules_are_imported_only_when_needed(self):
+        import subprocess
+
+        imported = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys, complex_xml_to_csvs.complex_xml_to_csvs;'
+            ' print(" ".join(sorted(sys.modules)))'
+        ]).split()
+
+        for name in [
+                'SocketServer', 'socket', 'hashlib', 'mmap', 'shutil',
+                'gzip', 'csv', 'json', 'importlib',
+                'complex_xml_to_csvs.service',
+                'complex_xml_to_csvs.work_queue',
+                'complex_xml_to_csvs.changes',
+                'complex_xml_to_csvs.schema_cache',
+                'complex_xml_to_csvs.shards',
+                'complex_xml_to_csvs.chunks',
+                'complex_xml_to_csvs.quarantine',
+                'complex_xml_to_csvs.transforms',
+                'complex_xml_to_csvs.scratch',
+                'complex_xml_to_csvs.manifests',
+                'complex_xml_to_csvs.progress',
+                'complex_xml_to_csvs.ceg_index',
+                'complex_xml_to_csvs.governor']:
+            self.assertNotIn(name, imported)
+
+
 class Test_parse_args(TestCase):
 
     def test_arguments_are_stored_into_files(self):
@@ -484,3 +711,749 @@ class Test_parse_args(TestCase):
     def test_optional_maxrecords_argument_defaults_to_all(self):
         args = module.parse_args('complex421.xml.gz'.split())
         self.assertEquals(module.Handle_ceg.ALL_RECORDS, args.maxrecords)
+
+
+class Test_serve(TestCase):
+
+    def setUp(self):
+        self.options = module.parse_args(['-'])
+
+    def test_read_fnames_skips_empty_lines(self):
+        input = StringIO.StringIO('a.xml.gz\n\n  b.xml  \n')
+        self.assertEquals(
+            ['a.xml.gz', 'b.xml'],
+            list(module.read_fnames(input))
+        )
+
+    def test_converted_fnames_are_reported(self):
+        output = StringIO.StringIO()
+        with mock.patch.object(
+                module, 'xml_to_csv_batches', return_value={}
+        ) as convert:
+            report = module.serve(
+                ['a.xml', 'b.xml'],
+                mock.sentinel.tables,
+                self.options,
+                output=output
+            )
+
+        self.assertEquals(0, report['failed_files'])
+        self.assertEquals('a.xml\nb.xml\n', output.getvalue())
+        convert.assert_called_with(
+            'b.xml', mock.sentinel.tables, self.options, None, None, 1)
+
+    def test_failing_file_does_not_stop_serving(self):
+        output = StringIO.StringIO()
+        with mock.patch.object(
+                module, 'xml_to_csv_batches', side_effect=[IOError, {}]
+        ):
+            report = module.serve(
+                ['a.xml', 'b.xml'],
+                mock.sentinel.tables,
+                self.options,
+                output=output
+            )
+
+        self.assertEquals(1, report['failed_files'])
+        self.assertEquals('b.xml\n', output.getvalue())
+
+
+def synthetic_complex_xml(first_ceg_id, ceg_count):
+    cegs = []
+    for ceg_id in range(first_ceg_id, first_ceg_id + ceg_count):
+        rovats = []
+        for rovat_id in ('0', '01', '2')[:1 + ceg_id % 3]:
+            alrovats = [
+                '<alrovat id="{0}">'
+                '<mezo id="a">{1} &amp; "\xe1"<ujsor/>{0}</mezo>'
+                '<mezo id="b">{2}</mezo>'
+                '</alrovat>'.format(alrovat_id, ceg_id, rovat_id)
+                for alrovat_id in range(1 + ceg_id % 4)
+            ]
+            rovats.append(
+                '<rovat id="{0}">{1}</rovat>'
+                .format(rovat_id, ''.join(alrovats))
+            )
+        cegs.append(
+            '<ceg id="{0:010d}">\n{1}\n</ceg>\n'
+            .format(ceg_id, ''.join(rovats))
+        )
+    return (
+        '<?xml version="1.0" encoding="ISO8859-2" ?>\n<export>\n'
+        + ''.join(cegs)
+        + '</export>\n'
+    )
+
+
+def synthetic_tables():
+    return [
+        CompiledTable(
+            name=name,
+            fields=[
+                dict(name='ceg_id'),
+                dict(name='alrovat_id'),
+                dict(name='a'),
+                dict(name='b'),
+            ]
+        )
+        for name in ('rovat_0', 'rovat_1', 'rovat_2')
+    ]
+
+
+class TestParallelConversion(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fnames = []
+        for i in range(4):
+            fname = os.path.join(self.tmpdir, 'complex{0}.xml'.format(i))
+            with module.open_file(fname, 'wb') as f:
+                f.write(synthetic_complex_xml(i * 1000, 150 + 50 * i))
+            self.fnames.append(fname)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def convert(self, output_dir, *args):
+        output_dir = os.path.join(self.tmpdir, output_dir)
+        options = module.parse_args(
+            ['--direct', '--output-dir', output_dir] + list(args) + ['-']
+        )
+        report = module.serve(self.fnames, synthetic_tables(), options)
+        self.assertEquals(0, report['failed_files'])
+        if options.changes:
+            module.update_changes(options, 0, report)
+        return dict(
+            (fname, open(os.path.join(output_dir, fname), 'rb').read())
+            for fname in sorted(os.listdir(output_dir))
+        )
+
+    def test_parallel_output_is_the_same_as_serial(self):
+        serial = self.convert('serial')
+        self.assertEquals(
+            ['rovat_0.csv', 'rovat_1.csv', 'rovat_2.csv'],
+            sorted(serial)
+        )
+
+        self.assertEquals(serial, self.convert('by_file', '--jobs=3'))
+        self.assertEquals(
+            serial,
+            self.convert('by_chunk', '--jobs=3', '--chunk-size=0.002')
+        )
+
+    def test_governed_workers_write_the_same_output(self):
+        serial = self.convert('serial')
+
+        self.assertEquals(
+            serial,
+            self.convert(
+                'governed', '--jobs=3', '--chunk-size=0.01',
+                '--max-memory=4000'
+            )
+        )
+        self.assertEquals(
+            serial,
+            self.convert(
+                'squeezed', '--jobs=3', '--chunk-size=0.01',
+                '--max-memory=1'
+            )
+        )
+
+    def test_replaced_workers_write_the_same_output(self):
+        self.assertEquals(
+            self.convert('serial'),
+            self.convert('replaced', '--jobs=2', '--max-tasks-per-worker=1')
+        )
+
+    def test_streams_of_the_service_are_converted_in_order(self):
+        output_dir = os.path.join(self.tmpdir, 'service')
+        options = module.parse_args([
+            '--direct', '--jobs=3', '--chunk-size=0.002',
+            '--output-dir', output_dir,
+            '--listen', os.path.join(self.tmpdir, 'sock')
+        ])
+        module.make_directory(output_dir)
+        shards.make_shards_dir(module.shards_root(options))
+        pool = module.worker_pool(synthetic_tables(), options)
+        try:
+            sequences = itertools.count()
+            merge_lock = threading.Lock()
+            for fname in self.fnames:
+                with open(fname, 'rb') as f:
+                    converted, metrics = module.convert_in_chunks(
+                        pool, fname, f, options, sequences, merge_lock
+                    )
+                self.assertTrue(converted)
+        finally:
+            pool.close()
+            pool.join()
+        shards.remove_shards_dir(module.shards_root(options))
+
+        self.assertEquals(
+            self.convert('serial'),
+            dict(
+                (fname, open(os.path.join(output_dir, fname), 'rb').read())
+                for fname in sorted(os.listdir(output_dir))
+            )
+        )
+
+    def test_tasks_use_the_worker_state(self):
+        options = module.parse_args(
+            ['--output-dir', os.path.join(self.tmpdir, 'task'), '-']
+        )
+        module.init_worker(synthetic_tables(), options)
+        try:
+            sequence, (converted, metrics), (pid, seconds) = (
+                module.convert_task((3, self.fnames[0], None, None))
+            )
+        finally:
+            module.worker_state = None
+
+        self.assertEquals((3, True, os.getpid()), (sequence, converted, pid))
+        self.assertTrue(
+            os.path.exists(
+                os.path.join(self.tmpdir, 'task/rovat_0/complex0_0000.csv')
+            )
+        )
+
+    def test_expat_engine_writes_the_same_output(self):
+        serial = self.convert('serial')
+
+        self.assertEquals(serial, self.convert('expat', '--engine=expat'))
+        self.assertEquals(
+            serial,
+            self.convert(
+                'expat_by_chunk', '--engine=expat', '--jobs=3',
+                '--chunk-size=0.002'
+            )
+        )
+
+    def test_transforms_give_the_same_output_for_both_engines(self):
+        for fname in self.fnames:
+            with module.open_file(fname, 'rb') as f:
+                document = f.read()
+            with module.open_file(fname, 'wb') as f:
+                # no-break spaces (0xa0 in ISO8859-2) around the values
+                f.write(
+                    document
+                    .replace('<mezo id="a">', '<mezo id="a">\xa0 ')
+                    .replace('</mezo>', ' \xa0</mezo>')
+                )
+        transforms = ['--transform=a=strip', '--transform=b=oneline']
+        sax = self.convert('sax', *transforms)
+        expat = self.convert('expat', '--engine=expat', *transforms)
+
+        self.assertNotIn('\xc2\xa0', sax['rovat_0.csv'])
+        self.assertNotIn('\xc2\xa0', expat['rovat_0.csv'])
+        self.assertEquals(sax, expat)
+
+    def test_output_encoding(self):
+        utf8 = self.convert('utf8')
+
+        for engine in 'sax', 'expat':
+            latin2 = self.convert(
+                engine, '--engine', engine, '--output-encoding=ISO8859-2'
+            )
+            self.assertEquals(
+                utf8,
+                dict(
+                    (fname, csv.decode('iso8859-2').encode('utf-8'))
+                    for fname, csv in latin2.items()
+                )
+            )
+            self.assertIn('\xe1', latin2['rovat_0.csv'])
+
+    def test_partitions(self):
+        serial = self.convert('serial')
+        partitioned = self.convert('partitioned', '--partitions=4')
+        self.assertEquals(
+            partitioned,
+            self.convert(
+                'partitioned_by_chunk', '--partitions=4', '--jobs=3',
+                '--chunk-size=0.002'
+            )
+        )
+
+        for table_csv, csv in serial.items():
+            header, rows = csv.split('\r\n', 1)
+            partition_rows = []
+            for partition in range(4):
+                partition_csv = partitioned.pop(
+                    '{0}.{1:03d}.csv'.format(table_csv[:-4], partition)
+                )
+                self.assertTrue(partition_csv.startswith(header + '\r\n'))
+                for row in partition_csv.split('\r\n')[1:-1]:
+                    self.assertEquals(
+                        partition,
+                        record_processors.partition_of(row[:10], 4)
+                    )
+                partition_rows.append(partition_csv[len(header) + 2:])
+            self.assertEquals(
+                sorted(rows.split('\r\n')),
+                sorted(''.join(partition_rows).split('\r\n'))
+            )
+        self.assertEquals({}, partitioned)
+
+    def test_progress_status_file(self):
+        status_fname = os.path.join(self.tmpdir, 'status.json')
+        self.assertEquals(
+            self.convert('serial'),
+            self.convert('progress', '--status-file', status_fname)
+        )
+
+        with open(status_fname) as f:
+            status = json.load(f)
+        self.assertEquals(self.fnames[-1], status['fname'])
+        self.assertEquals(300, status['records'])
+        self.assertTrue(status['done'])
+
+    def test_configured_pipeline_writes_the_same_output(self):
+        self.assertEquals(
+            self.convert('serial'),
+            self.convert(
+                'configured', '--stage=batch:size=7', '--stage=append'
+            )
+        )
+
+    def test_work_queue_output_is_the_same_as_serial(self):
+        queue = WorkQueue(os.path.join(self.tmpdir, 'queue'))
+        queue.add(self.fnames)
+        output_dir = os.path.join(self.tmpdir, 'queued')
+        options = module.parse_args(
+            [
+                '--direct', '--output-dir', output_dir,
+                '--jobs=3', '--work-queue', queue.queue_dir
+            ]
+        )
+
+        report = module.work(queue, synthetic_tables(), options)
+
+        self.assertEquals(4, report['converted_files'])
+        self.assertEquals(
+            self.convert('serial'),
+            dict(
+                (fname, open(os.path.join(output_dir, fname), 'rb').read())
+                for fname in sorted(os.listdir(output_dir))
+            )
+        )
+
+    def test_worker_survives_the_requeue_of_its_item(self):
+        queue = WorkQueue(os.path.join(self.tmpdir, 'queue'))
+        queue.add(self.fnames[:2])
+        options = module.parse_args(
+            ['--output-dir', os.path.join(self.tmpdir, 'queued'), '-']
+        )
+        requeued = []
+
+        def convert_and_requeue(fname, *args, **kwargs):
+            if not requeued:
+                requeued.append(queue.requeue(older_than=0))
+            return True, module.Counter(records=1)
+
+        with mock.patch.object(module, 'convert', convert_and_requeue):
+            report = module.work_through_queue(
+                queue, synthetic_tables(), options
+            )
+
+        # the first file is taken back, then claimed and converted again
+        self.assertEquals([1], requeued)
+        self.assertEquals(2, report['converted_files'])
+        self.assertEquals(2, report['records'])
+        self.assertEquals(
+            dict(todo=0, claimed=0, done=2, failed=0), queue.counts()
+        )
+
+    def queued_output(self, name, *args, **kwargs):
+        '''Output of converting the files through a work queue
+
+        With crash=True a worker first converts the first item and dies
+        before finishing it, then the item is requeued.
+        '''
+        queue = WorkQueue(os.path.join(self.tmpdir, name + '_queue'))
+        queue.add(self.fnames)
+        output_dir = os.path.join(self.tmpdir, name)
+        options = module.parse_args(
+            ['--output-dir', output_dir] + list(args) +
+            ['--work-queue', queue.queue_dir]
+        )
+        if kwargs.get('crash'):
+            item = queue.claim('crashed')
+            crashed_options = copy.copy(options)
+            if options.direct:
+                shards.make_shards_dir(output_dir)
+                crashed_options.output_dir = shards.shard_dir(
+                    output_dir, item.sequence
+                )
+            module.convert(
+                item.fname, synthetic_tables(), crashed_options,
+                sequence=item.sequence
+            )
+            self.assertEquals(1, queue.requeue(older_than=0))
+
+        report = module.work(queue, synthetic_tables(), options)
+        self.assertEquals(0, report['failed_files'])
+        output = {}
+        for dirpath, _, fnames in os.walk(output_dir):
+            for fname in fnames:
+                path = os.path.join(dirpath, fname)
+                with open(path, 'rb') as f:
+                    output[os.path.relpath(path, output_dir)] = f.read()
+        return output
+
+    def test_requeued_item_is_converted_from_scratch(self):
+        for args in [['--direct'], []]:
+            clean = self.queued_output('clean' + str(len(args)), *args)
+            requeued = self.queued_output(
+                'requeued' + str(len(args)), *args, crash=True
+            )
+            self.assertEquals(sorted(clean), sorted(requeued))
+            for fname in sorted(clean):
+                self.assertTrue(clean[fname] == requeued[fname], fname)
+
+    def test_changes_are_converted_only(self):
+        hash_db = os.path.join(self.tmpdir, 'hashes.db')
+        first = self.convert('first', '--jobs=3', '--changes', hash_db)
+        self.assertEquals('', first.pop('deleted_ceg_ids.txt'))
+        self.assertEquals(self.convert('serial'), first)
+
+        self.fnames = self.fnames[:2]
+        with module.open_file(self.fnames[1], 'wb') as f:
+            f.write(
+                synthetic_complex_xml(1000, 200)
+                .replace('<mezo id="a">1000 ', '<mezo id="a">changed ')
+            )
+        second = self.convert('second', '--changes', hash_db)
+
+        self.assertEquals(
+            ['0000001000', 'ceg_id'],
+            sorted(set(
+                row.split(',')[0]
+                for row in second['rovat_0.csv'].split('\r\n')[:-1]
+            ))
+        )
+        deleted = second['deleted_ceg_ids.txt'].split()
+        self.assertEquals(250 + 300, len(deleted))
+        self.assertEquals(
+            ['0000002000', '0000003299'], [deleted[0], deleted[-1]]
+        )
+
+    def test_changes_are_not_updated_after_a_parse_error(self):
+        hash_db = os.path.join(self.tmpdir, 'hashes.db')
+        self.convert('first', '--changes', hash_db)
+        with open(hash_db, 'rb') as f:
+            hashes = f.read()
+
+        with module.open_file(self.fnames[1], 'wb') as f:
+            f.write(
+                synthetic_complex_xml(1000, 200)
+                .replace('<ceg id="0000001100">', '<ceg id="0000001100"><ceg>')
+            )
+        for args in [], ['--jobs=3', '--chunk-size=0.002']:
+            output_dir = os.path.join(self.tmpdir, 'broken')
+            options = module.parse_args(
+                ['--direct', '--output-dir', output_dir, '--changes', hash_db]
+                + args + ['-']
+            )
+            report = module.serve(self.fnames, synthetic_tables(), options)
+            self.assertEquals(1, report['failed_files'])
+            module.update_changes(options, report['failed_files'], report)
+
+            self.assertEquals(0, report['deleted_cegs'])
+            with open(hash_db, 'rb') as f:
+                self.assertEquals(hashes, f.read())
+            shutil.rmtree(output_dir)
+
+    def test_first_hashes_of_inputs_of_the_same_name_are_kept(self):
+        first, second = [
+            os.path.join(self.tmpdir, directory, 'complex.xml')
+            for directory in ('b', 'a')
+        ]
+        for fname, document in [
+                (first, synthetic_complex_xml(0, 100)),
+                (second,
+                 synthetic_complex_xml(50, 100)
+                 .replace('<mezo id="a">', '<mezo id="a">changed '))]:
+            os.mkdir(os.path.dirname(fname))
+            with open(fname, 'wb') as f:
+                f.write(document)
+
+        for args in [], ['--jobs=3'], ['--jobs=3', '--chunk-size=0.002']:
+            hash_db = os.path.join(self.tmpdir, 'hashes.db')
+            self.fnames = [first, second]
+            self.convert('both', '--changes', hash_db, *args)
+            self.fnames = [first]
+            output = self.convert('first', '--changes', hash_db)
+
+            self.assertEquals(
+                [str(ceg_id).zfill(10) for ceg_id in range(100, 150)],
+                output.pop('deleted_ceg_ids.txt').split()
+            )
+            for csv in output.values():
+                self.assertEquals(1, csv.count('\r\n'))
+            for name in 'both', 'first', 'hashes.db':
+                path = os.path.join(self.tmpdir, name)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+
+    def test_index_locates_the_rows_of_cegs(self):
+        output_dir = os.path.join(self.tmpdir, 'indexed')
+        self.convert('indexed', '--index', '--jobs=3', '--chunk-size=0.002')
+
+        # rows end in \r\n, field values may contain \n
+        rovat_0 = self.convert('serial')['rovat_0.csv'].split('\r\n')
+        ceg_rows = ''.join(
+            row + '\r\n' for row in rovat_0 if row.startswith('0000001042,')
+        )
+        self.assertEquals(
+            [('rovat_0.csv', ceg_rows)],
+            list(ceg_index.lookup(output_dir, 'rovat_0', ['0000001042']))
+        )
+
+        ceg_index.merge_indexes(output_dir)
+        self.assertEquals(
+            [('rovat_0.csv', ceg_rows)],
+            list(ceg_index.lookup(output_dir, 'rovat_0', ['0000001042']))
+        )
+
+
+class TestStructureValidator(TestCase):
+
+    def problems(self, document):
+        validator = module.StructureValidator(synthetic_tables())
+        return validator.validate(StringIO.StringIO(document), 'x.xml')
+
+    def test_valid_file_has_no_problems(self):
+        self.assertEquals([], self.problems(synthetic_complex_xml(1, 20)))
+
+    def test_hierarchy_problem_is_located(self):
+        document = synthetic_complex_xml(1, 3).replace(
+            '<rovat id="0">', '<alrovat id="0">', 1
+        ).replace('</rovat>', '</alrovat>', 1)
+
+        problem = self.problems(document)[0]
+
+        self.assertEquals('0000000001', problem.ceg_id)
+        self.assertEquals(4, problem.line)
+        self.assertEquals(document.index('<alrovat id="0">'),
+                          problem.byte_offset)
+        self.assertIn('unexpected start-element alrovat', problem.message)
+
+    def test_schema_problems(self):
+        document = synthetic_complex_xml(1, 3).replace(
+            '<rovat id="2">', '<rovat id="7">'
+        ).replace('<mezo id="b">', '<mezo id="c">', 1)
+
+        self.assertEquals(
+            [
+                ('0000000001', 'unknown mezo c in rovat_0'),
+                ('0000000002', 'unknown rovat 7'),
+            ],
+            [(p.ceg_id, p.message) for p in self.problems(document)]
+        )
+
+    def test_duplicates(self):
+        document = synthetic_complex_xml(1, 3).replace(
+            '<mezo id="b">', '<mezo id="a">', 1
+        ).replace('<rovat id="01">', '<rovat id="0">', 1)
+
+        self.assertEquals(
+            [
+                ('0000000001', 'duplicate mezo a'),
+                ('0000000001', 'duplicate rovat 0'),
+            ],
+            [(p.ceg_id, p.message) for p in self.problems(document)]
+        )
+
+    def test_missing_id(self):
+        problem, = self.problems(
+            synthetic_complex_xml(1, 1).replace('<ceg id=', '<ceg x=')
+        )
+        self.assertEquals('ceg without id', problem.message)
+
+    def test_encoding(self):
+        problem, = self.problems(
+            synthetic_complex_xml(1, 1).replace('ISO8859-2', 'ISO8859-1')
+        )
+        self.assertEquals(
+            'encoding ISO8859-1 instead of ISO8859-2', problem.message
+        )
+
+    def test_malformed_xml(self):
+        document = synthetic_complex_xml(1, 2)
+        document = document.replace('</ceg>', '</cegg>', 1)
+
+        problem, = self.problems(document)
+        self.assertEquals('mismatched tag', problem.message)
+        self.assertEquals(5, problem.line)
+        # within the bad tag
+        self.assertLessEqual(document.index('</cegg>'), problem.byte_offset)
+        self.assertLess(
+            problem.byte_offset,
+            document.index('</cegg>') + len('</cegg>')
+        )
+
+
+class TestRecovery(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def convert(self, document, output_dir, *args):
+        fname = os.path.join(self.tmpdir, 'complex.xml')
+        with open(fname, 'wb') as f:
+            f.write(document)
+        output_dir = os.path.join(self.tmpdir, output_dir)
+        options = module.parse_args(
+            ['--direct', '--output-dir', output_dir] + list(args) + ['-']
+        )
+        report = module.serve([fname], synthetic_tables(), options)
+        csvs = dict(
+            (fname, open(os.path.join(output_dir, fname), 'rb').read())
+            for fname in os.listdir(output_dir)
+            if fname.endswith('.csv')
+        )
+        return report, csvs
+
+    def test_parse_errors_name_the_file_with_progress_reports(self):
+        fname = os.path.join(self.tmpdir, 'complex.xml')
+        with open(fname, 'wb') as f:
+            f.write(synthetic_complex_xml(1, 3).replace('</ceg>', '', 1))
+        for engine in 'sax', 'expat':
+            options = module.parse_args([
+                '--output-dir', os.path.join(self.tmpdir, engine),
+                '--engine', engine, '--progress', '60', fname
+            ])
+            with self.assertRaises(xml.sax.SAXParseException) as context:
+                module.xml_to_csv_batches(fname, synthetic_tables(), options)
+            self.assertTrue(str(context.exception).startswith(fname + ':'))
+
+    def test_quarantined_cegs_are_located_in_the_input(self):
+        document = synthetic_complex_xml(1, 10)
+        bad_start = document.index('<ceg id="0000000006"')
+        self.check_quarantined_ceg_is_located(
+            document[:bad_start]
+            + document[bad_start:].replace('</mezo>', '</mez>', 1)
+        )
+        # on the first line of an indented ceg
+        self.check_quarantined_ceg_is_located(
+            document.replace('<ceg ', '  <ceg ')
+            .replace('"0000000006">', '"0000000006" a="1" a="2">')
+        )
+
+    def check_quarantined_ceg_is_located(self, document):
+        fname = os.path.join(self.tmpdir, 'complex.xml')
+        with open(fname, 'wb') as f:
+            f.write(document)
+        # as located by a parse of the whole file
+        with self.assertRaises(xml.sax.SAXParseException) as context:
+            xml.sax.parse(fname, xml.sax.handler.ContentHandler())
+        expected = str(context.exception)
+        self.assertTrue(expected.startswith(fname + ':'))
+
+        for engine in 'sax', 'expat':
+            output_dir = os.path.join(self.tmpdir, engine)
+            shutil.rmtree(output_dir, ignore_errors=True)
+            report, _ = self.convert(
+                document, engine, '--recover', '--engine', engine
+            )
+            self.assertEquals(1, report['skipped_records'])
+            quarantine = open(
+                os.path.join(output_dir, 'quarantine',
+                             'complex.xml'),
+                'rb'
+            ).read()
+            self.assertIn(expected, quarantine)
+
+    def test_bad_cegs_are_skipped(self):
+        self.check_bad_cegs_are_skipped()
+
+    def test_bad_cegs_are_skipped_by_the_expat_engine(self):
+        self.check_bad_cegs_are_skipped('--engine=expat')
+
+    def check_bad_cegs_are_skipped(self, *args):
+        cegs = synthetic_complex_xml(1, 30).split('<ceg ')
+        good = '<ceg '.join(
+            ceg for i, ceg in enumerate(cegs) if i not in (3, 7, 8)
+        )
+        bad_cegs = [
+            # hierarchy
+            cegs[3].replace('<rovat id="0">', '<rovat id="0"><rovat id="0">')
+            .replace('</rovat>', '</rovat></rovat>', 1),
+            # not well formed
+            cegs[7].replace('</mezo>', '</mez>', 1),
+            # unknown mezo
+            cegs[8].replace('<mezo id="a">', '<mezo id="x">', 1),
+        ]
+        bad = '<ceg '.join(
+            cegs[:3] + bad_cegs[:1] + cegs[4:7] + bad_cegs[1:] + cegs[9:]
+        )
+
+        report, csvs = self.convert(bad, 'recovered', '--recover', *args)
+
+        self.assertEquals(3, report['skipped_records'])
+        self.assertEquals(0, report['failed_files'])
+        self.assertEquals(self.convert(good, 'good', *args)[1], csvs)
+
+        quarantine = open(
+            os.path.join(self.tmpdir, 'recovered', 'quarantine',
+                         'complex.xml'),
+            'rb'
+        ).read()
+        for bad_ceg in bad_cegs:
+            self.assertIn('<ceg ' + bad_ceg, quarantine)
+        self.assertTrue(quarantine.startswith('<?xml'))
+        self.assertTrue(quarantine.endswith('</export>\n'))
+
+    def test_duplicates_are_counted(self):
+        good = synthetic_complex_xml(1, 30)
+        repeated = good.replace(
+            '<mezo id="b">', '<mezo id="a">x</mezo><mezo id="b">'
+        )
+
+        report, csvs = self.convert(repeated, 'first', '--duplicates=first')
+
+        self.assertEquals(0, report['duplicate_rovats'])
+        self.assertEquals(
+            good.count('<mezo id="b">'), report['duplicate_mezos']
+        )
+        self.assertEquals(self.convert(good, 'good')[1], csvs)
+
+    def test_duplicate_cegs_are_skipped_as_errors(self):
+        cegs = synthetic_complex_xml(1, 30).split('<ceg ')
+        good = '<ceg '.join(cegs[:5] + cegs[6:])
+        cegs[5] = cegs[5].replace('<mezo id="b">', '<mezo id="a">', 1)
+
+        report, csvs = self.convert(
+            '<ceg '.join(cegs), 'recovered', '--recover',
+            '--duplicates=error'
+        )
+
+        self.assertEquals(1, report['skipped_records'])
+        self.assertEquals(1, report['duplicate_mezos'])
+        self.assertEquals(self.convert(good, 'good')[1], csvs)
+
+    def test_duplicate_error_fails_the_file(self):
+        document = synthetic_complex_xml(1, 30).replace(
+            '<ceg id="0000000005">\n<rovat id="0">',
+            '<ceg id="0000000005">\n<rovat id="0"></rovat><rovat id="0">'
+        )
+
+        report, csvs = self.convert(document, 'error', '--duplicates=error')
+
+        self.assertEquals(1, report['failed_files'])
+        self.assertNotIn('0000000005', csvs['rovat_0.csv'])
+
+    def test_without_recover_parsing_stops_at_the_bad_ceg(self):
+        document = synthetic_complex_xml(1, 30).replace(
+            '<ceg id="0000000005">', '<ceg id="0000000005"><ceg>'
+        )
+        report, csvs = self.convert(document, 'stopped')
+
+        self.assertEquals(1, report['failed_files'])
+        self.assertEquals(0, report['skipped_records'])
+        self.assertNotIn('0000000006', csvs['rovat_0.csv'])
@@ -0,0 +1,118 @@
+from unittest import TestCase
+import os
+import shutil
+import StringIO
+import tempfile
+import mock
+from complex_xml_to_csvs import csv_sort as module
+
+
+HEADER = 'x,ceg_id,a\r\n'
+
+
+class TestSortMerge(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fnames = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, *rows):
+        fname = os.path.join(
+            self.tmpdir, '{0:04d}.csv'.format(len(self.fnames))
+        )
+        with open(fname, 'wb') as f:
+            f.write(HEADER + ''.join(rows))
+        self.fnames.append(fname)
+
+    def sort_merge(self, **kwargs):
+        output = StringIO.StringIO()
+        module.sort_merge(self.fnames, output, tmp_dir=self.tmpdir, **kwargs)
+        return output.getvalue()
+
+    def test_rows_are_merged_by_ceg_id_with_a_single_header(self):
+        self.write('1,02,"multi\nline"\r\n', '2,05,b\r\n')
+        self.write('3,01,c\r\n', '4,03,"x,""y"""\r\n', '5,05,d\r\n')
+
+        self.assertEquals(
+            HEADER
+            + '3,01,c\r\n'
+            + '1,02,"multi\nline"\r\n'
+            + '4,03,"x,""y"""\r\n'
+            + '2,05,b\r\n'
+            + '5,05,d\r\n',
+            self.sort_merge()
+        )
+
+    def test_many_files_are_merged_in_more_passes(self):
+        for i in range(11):
+            self.write(
+                '{0},{1:03d},a\r\n'.format(i, 50 - i),
+                '{0},{1:03d},b\r\n'.format(i, 50 + i),
+            )
+
+        merged = self.sort_merge(memory=3 * module.BUFFER_SIZE)
+
+        rows = merged.split('\r\n')[1:-1]
+        self.assertEquals(22, len(rows))
+        self.assertEquals(
+            sorted(rows, key=lambda row: row.split(',')[1]),
+            rows
+        )
+        # only the inputs are left
+        self.assertEquals(
+            sorted(os.path.basename(fname) for fname in self.fnames),
+            sorted(os.listdir(self.tmpdir))
+        )
+
+    def test_open_files_are_limited(self):
+        self.assertEquals(1024, module.max_files(256 * module.MEGABYTE))
+        self.assertEquals(
+            1024 - module.RESERVED_FILES,
+            module.max_files(256 * module.MEGABYTE, 1024)
+        )
+        self.assertEquals(2, module.max_files(256 * module.MEGABYTE, 10))
+
+    def test_many_files_are_merged_within_the_open_file_limit(self):
+        for i in range(11):
+            self.write('{0},{1:03d},a\r\n'.format(i, 50 - i))
+
+        with mock.patch.object(
+                module, 'merge', side_effect=module.merge) as merge:
+            merged = self.sort_merge(file_limit=module.RESERVED_FILES + 3)
+
+        # groups of 3 files, then of the 4 runs, then the 2 runs
+        self.assertEquals(4 + 2 + 1, merge.call_count)
+        self.assertTrue(
+            all(len(args[0]) <= 3 for args, _ in merge.call_args_list)
+        )
+
+        rows = merged.split('\r\n')[1:-1]
+        self.assertEquals(
+            ['{0},{1:03d},a'.format(i, 50 - i) for i in reversed(range(11))],
+            rows
+        )
+
+    def test_files_without_rows(self):
+        self.write()
+        self.write('1,01,a\r\n')
+
+        self.assertEquals(HEADER + '1,01,a\r\n', self.sort_merge())
+
+    def test_unsorted_file_is_an_error(self):
+        self.write('1,02,a\r\n', '2,01,b\r\n')
+
+        with self.assertRaises(module.MergeError):
+            self.sort_merge()
+
+    def test_different_header_is_an_error(self):
+        self.write('1,01,a\r\n')
+        fname = os.path.join(self.tmpdir, 'other.csv')
+        with open(fname, 'wb') as f:
+            f.write('ceg_id,a\r\n01,a\r\n')
+        self.fnames.append(fname)
+
+        with self.assertRaises(module.MergeError):
+            self.sort_merge()
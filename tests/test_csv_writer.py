@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+from unittest import TestCase
+from cStringIO import StringIO
+import unicodecsv
+from complex_xml_to_csvs import csv_writer as module
+
+
+FIELDS = ['ceg_id', 'name', 'note']
+
+
+def unicodecsv_output(fields, rows):
+    f = StringIO()
+    writer = unicodecsv.DictWriter(f, fields)
+    writer.writeheader()
+    writer.writerows(rows)
+    return f.getvalue()
+
+
+def batch_output(fields, rows):
+    writer = module.BatchCsvWriter(fields)
+    return writer.header() + writer.encode_rows(rows)
+
+
+class TestBatchCsvWriter(TestCase):
+
+    def assert_same_as_unicodecsv(self, rows, fields=FIELDS):
+        self.assertEquals(
+            unicodecsv_output(fields, rows),
+            batch_output(fields, rows)
+        )
+
+    def test_accented_text(self):
+        self.assert_same_as_unicodecsv([
+            {'ceg_id': u'1', 'name': u'Árvíztűrő tükörfúrógép Kft.'},
+            {'ceg_id': u'2', 'name': u'őŐűŰ', 'note': u''},
+        ])
+
+    def test_quotes_separators_and_newlines(self):
+        self.assert_same_as_unicodecsv([
+            {'ceg_id': u'1', 'name': u'"Quoted" name', 'note': u'a,b'},
+            {'ceg_id': u'2', 'name': u'line\nbreak', 'note': u' spaces '},
+            {'ceg_id': u'3', 'name': u'\r\n', 'note': u"'"},
+        ])
+
+    def test_values_that_are_not_text(self):
+        self.assert_same_as_unicodecsv([
+            {'ceg_id': 1, 'name': None, 'note': 1.5},
+            {'ceg_id': u'2', 'name': 'bytes', 'note': u'é'},
+        ])
+
+    def test_missing_fields_are_empty(self):
+        self.assert_same_as_unicodecsv([{'ceg_id': u'1'}, {}])
+
+    def test_no_rows(self):
+        self.assertEquals('', module.BatchCsvWriter(FIELDS).encode_rows([]))
+
+    def test_extra_field_is_an_error(self):
+        writer = module.BatchCsvWriter(FIELDS)
+
+        with self.assertRaises(ValueError) as context:
+            writer.encode_rows([{'ceg_id': u'1', 'extra': u'x'}])
+
+        self.assertIn("'extra'", str(context.exception))
+
+    def test_row_ends(self):
+        writer = module.BatchCsvWriter(['a'])
+        row_ends = []
+
+        output = writer.encode_rows(
+            [{'a': u'1'}, {'a': u'x\ny'}, {'a': u'é'}], row_ends
+        )
+
+        self.assertEquals('1\r\n"x\ny"\r\n\xc3\xa9\r\n', output)
+        self.assertEquals([3, 10, 14], row_ends)
+
+    def test_other_encoding(self):
+        writer = module.BatchCsvWriter(['a'], encoding='latin-1')
+
+        self.assertEquals('\xe1\r\n', writer.encode_rows([{'a': u'á'}]))
+
+    def test_utf8_str_is_written_as_it_is(self):
+        writer = module.BatchCsvWriter(['a', 'b'])
+        cells = ['\xc3\xa1', 'x']
+
+        self.assertIs(cells, writer.encode_cells(cells))
+        self.assertEquals(
+            '\xc3\xa1,"x\ny"\r\n',
+            writer.encode_rows([{'a': '\xc3\xa1', 'b': 'x\ny'}])
+        )
+
+    def test_utf8_str_is_transcoded(self):
+        writer = module.BatchCsvWriter(['a', 'b'], encoding='iso8859-2')
+
+        self.assertEquals(
+            '\xe1,\xf5\r\n',
+            writer.encode_rows([{'a': '\xc3\xa1', 'b': u'\u0151'}])
+        )
+        self.assertEquals(
+            '\xe1,1\r\n',
+            writer.encode_rows([{'a': '\xc3\xa1', 'b': 1}])
+        )
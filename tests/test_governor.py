@@ -0,0 +1,120 @@
+from unittest import TestCase
+import os
+import tempfile
+from complex_xml_to_csvs import governor as module
+
+
+MB = module.MEGABYTE
+
+
+class Samples(object):
+
+    '''Samples of a fake host, time goes by step seconds per sample'''
+
+    def __init__(self):
+        self.time = 0.0
+        self.step = module.SAMPLE_INTERVAL
+        self.memory = 10 * MB
+        self.worker_memory = 5 * MB
+        self.io_pressure = None
+
+    def __call__(self):
+        self.time += self.step
+        return module.Sample(
+            self.time, self.memory, self.worker_memory, 0, self.io_pressure
+        )
+
+
+class TestGovernor(TestCase):
+
+    def setUp(self):
+        self.samples = Samples()
+        self.governor = module.Governor(
+            max_tasks=4, max_memory=100 * MB, batch_size=1000,
+            sample=self.samples
+        )
+
+    def test_first_task_is_always_admitted(self):
+        self.samples.memory = 200 * MB
+        self.assertTrue(self.governor.admit(0))
+
+    def test_concurrency_grows_a_task_per_sample_interval(self):
+        self.assertTrue(self.governor.admit(1))
+        self.samples.time -= module.SAMPLE_INTERVAL / 2
+        self.assertFalse(self.governor.admit(2))
+        self.assertTrue(self.governor.admit(2))
+        self.assertEquals(3, self.governor.reached)
+
+    def test_no_more_than_max_tasks(self):
+        for running in range(1, 4):
+            self.assertTrue(self.governor.admit(running))
+        self.assertFalse(self.governor.admit(4))
+
+    def test_reached_concurrency_is_admitted_at_once(self):
+        self.governor.admit(1)
+        self.governor.admit(2)
+        self.samples.step = 0
+
+        self.assertTrue(self.governor.admit(1))
+        self.assertTrue(self.governor.admit(2))
+        self.assertFalse(self.governor.admit(3))
+
+    def test_memory_must_leave_room_for_the_largest_task(self):
+        self.samples.worker_memory = 40 * MB
+        self.samples.memory = 50 * MB
+        self.assertTrue(self.governor.admit(1))
+
+        self.samples.worker_memory = 10 * MB
+        self.samples.memory = 70 * MB
+        self.assertFalse(self.governor.admit(1))
+        self.assertEquals(40 * MB, self.governor.task_memory)
+
+    def test_io_pressure_stops_growth(self):
+        self.samples.io_pressure = 80.0
+        self.assertFalse(self.governor.admit(1))
+
+        self.samples.io_pressure = 5.0
+        self.assertTrue(self.governor.admit(1))
+
+    def test_batch_size_shrinks_near_the_budget_and_grows_back(self):
+        self.samples.memory = 90 * MB
+        self.governor.update()
+        self.governor.update()
+        self.assertEquals(250, self.governor.batch_size)
+
+        self.samples.memory = 60 * MB
+        self.governor.update()
+        self.assertEquals(250, self.governor.batch_size)
+
+        for _ in range(5):
+            self.samples.memory = 20 * MB
+            self.governor.update()
+        self.assertEquals(1000, self.governor.batch_size)
+
+    def test_batch_size_has_a_minimum(self):
+        self.samples.memory = 90 * MB
+        for _ in range(20):
+            self.governor.update()
+        self.assertEquals(module.MIN_BATCH_SIZE, self.governor.batch_size)
+
+
+class TestProc(TestCase):
+
+    def test_rss_of_this_process(self):
+        if not os.path.exists('/proc/self/status'):
+            self.skipTest('no /proc')
+        self.assertTrue(module.rss(os.getpid()) > MB)
+
+    def test_unknown_process(self):
+        self.assertEquals(0, module.rss(-1))
+        self.assertEquals(0, module.written_bytes(-1))
+
+    def test_io_pressure(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(
+                'some avg10=12.50 avg60=3.00 avg300=1.00 total=100\n'
+                'full avg10=2.00 avg60=1.00 avg300=0.50 total=50\n'
+            )
+            f.flush()
+            self.assertEquals(12.5, module.io_pressure(f.name))
+        self.assertIsNone(module.io_pressure('/nonexistent/pressure'))
@@ -0,0 +1,85 @@
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+from complex_xml_to_csvs import manifests as module
+
+
+class TestStreamStats(TestCase):
+
+    def stats(self, *chunks):
+        stats = module.StreamStats()
+        for chunk in chunks:
+            stats.update(chunk)
+        return stats
+
+    def test_bytes_are_counted(self):
+        stats = self.stats('a,b\r\n1,"x\r\ny"\r\n', '', '2,z\r\n')
+
+        self.assertEquals(20, stats.bytes)
+
+    def test_checksum_does_not_depend_on_chunking(self):
+        self.assertEquals(
+            self.stats('a,b\r\n1,2\r\n').hexdigest(),
+            self.stats('a,b\r', '\n1,', '2\r\n').hexdigest()
+        )
+
+
+class TestManifests(TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_recorded_files_of_a_table(self):
+        module.write_manifest(
+            module.manifest_name(self.output_dir, 'complex1'),
+            [
+                ('rovat_1', 'rovat_1/complex1_0000.csv', 10, 100),
+                ('rovat_2', 'rovat_2/complex1_0000.csv', 20, 200),
+            ]
+        )
+        module.write_manifest(
+            module.manifest_name(self.output_dir, 'complex2'),
+            [('rovat_1', 'rovat_1/complex2_0000.csv', 30, 300)]
+        )
+
+        self.assertEquals(
+            {
+                'rovat_1/complex1_0000.csv': (10, 100),
+                'rovat_1/complex2_0000.csv': (30, 300),
+            },
+            module.recorded_files(self.output_dir, 'rovat_1')
+        )
+
+    def test_manifests_of_merged_tables_are_removed(self):
+        os.mkdir(os.path.join(self.output_dir, 'rovat_2'))
+        module.write_manifest(
+            module.manifest_name(self.output_dir, 'complex1'),
+            [('rovat_1', 'rovat_1/complex1_0000.csv', 10, 100)]
+        )
+        module.write_manifest(
+            module.manifest_name(self.output_dir, 'complex2'),
+            [
+                ('rovat_1', 'rovat_1/complex2_0000.csv', 30, 300),
+                ('rovat_2', 'rovat_2/complex2_0000.csv', 20, 200),
+            ]
+        )
+
+        module.remove_merged_manifests(self.output_dir)
+        self.assertEquals(
+            ['complex2.tsv'],
+            os.listdir(os.path.join(self.output_dir, '_manifests'))
+        )
+
+        os.rmdir(os.path.join(self.output_dir, 'rovat_2'))
+        module.remove_merged_manifests(self.output_dir)
+        self.assertEquals([], os.listdir(self.output_dir))
+
+    def test_no_manifests(self):
+        self.assertIsNone(module.recorded_files(self.output_dir, 'rovat_1'))
+        self.assertFalse(
+            os.path.exists(os.path.join(self.output_dir, '_manifests'))
+        )
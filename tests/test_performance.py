@@ -0,0 +1,216 @@
+'''Performance tests, skipped unless COMPLEX_PERFORMANCE_TESTS is set
+
+A generated corpus is converted (parsed, spread and written to csv files)
+by every engine and writer, each conversion in a fresh process.  The
+throughput and the peak memory of the conversions are checked against the
+baseline recorded in performance_baseline.json:
+
+    COMPLEX_PERFORMANCE_TESTS=1 nosetests tests/test_performance.py
+
+The throughput has to be at least COMPLEX_PERFORMANCE_MIN_SPEED (default:
+0.8) times, the peak memory at most COMPLEX_PERFORMANCE_MAX_MEMORY
+(default: 1.25) times the baseline.  Baselines depend on the machine:
+
+    COMPLEX_PERFORMANCE_TESTS=record nosetests tests/test_performance.py
+
+records the baseline (COMPLEX_PERFORMANCE_BASELINE names another file).
+The outputs of the engines and writers are checked to be the same.
+'''
+
+from unittest import TestCase, skipUnless
+import hashlib
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import tempfile
+import time
+from complex_xml_to_csvs import complex_xml_to_csvs as module
+from tests.test_complex_xml_to_csvs import (
+    synthetic_complex_xml, synthetic_tables
+)
+
+
+MODE = os.environ.get('COMPLEX_PERFORMANCE_TESTS')
+BASELINE = os.environ.get(
+    'COMPLEX_PERFORMANCE_BASELINE',
+    os.path.join(os.path.dirname(__file__), 'performance_baseline.json')
+)
+MIN_SPEED = float(os.environ.get('COMPLEX_PERFORMANCE_MIN_SPEED', 0.8))
+MAX_MEMORY = float(os.environ.get('COMPLEX_PERFORMANCE_MAX_MEMORY', 1.25))
+
+MEGABYTE = 1 << 20
+FILES = 4
+CEGS_PER_FILE = 5000
+# the fastest of the runs is taken
+RUNS = 3
+
+ENGINES = ['sax', 'expat']
+WRITERS = {
+    'csv': [],
+    'append': ['--direct'],
+    'partition': ['--direct', '--partitions=4'],
+}
+
+
+def convert(fnames, output_dir, args):
+    '''Convert fnames in this process, return (seconds, peak memory)'''
+    options = module.parse_args(
+        ['--output-dir', output_dir] + args + ['-']
+    )
+    started = time.time()
+    report = module.serve(fnames, synthetic_tables(), options)
+    seconds = time.time() - started
+    assert report['failed_files'] == 0
+    # kilobytes on Linux
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return seconds, peak_memory
+
+
+def measure(fnames, output_dir, args):
+    '''(seconds, peak memory) of the conversion in a new process'''
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(convert, (fnames, output_dir, args))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def csv_digests(output_dir):
+    '''table -> sha1 of the header and the sorted rows of the table
+
+    Batch files are in rovat_N/ directories, partitions are rovat_N.KKK.csv
+    files: the rows of all the files of a table are collected.  Only the
+    digests are kept, so that the processes forked later are not larger.
+    '''
+    tables = {}
+    for dirpath, dirnames, fnames in os.walk(output_dir):
+        dirnames[:] = [name for name in dirnames if not name.startswith('_')]
+        for fname in fnames:
+            if not fname.endswith('.csv'):
+                continue
+            if dirpath == output_dir:
+                table = fname.split('.')[0]
+            else:
+                table = os.path.basename(dirpath)
+            with open(os.path.join(dirpath, fname), 'rb') as f:
+                header, _, rows = f.read().partition('\r\n')
+            tables.setdefault(table, (header, []))[1].extend(
+                rows.split('\r\n')[:-1]
+            )
+    return dict(
+        (table, hashlib.sha1('\r\n'.join([header] + sorted(rows))).hexdigest())
+        for table, (header, rows) in tables.items()
+    )
+
+
+def read_baseline():
+    with open(BASELINE) as f:
+        return json.load(f)
+
+
+def write_baseline(baseline):
+    with open(BASELINE, 'wb') as f:
+        json.dump(
+            baseline, f, indent=4, separators=(',', ': '), sort_keys=True
+        )
+        f.write('\n')
+
+
+def measure_cases():
+    '''Convert the corpus by every engine and writer
+
+    Returns the results (throughput, peak memory) and the output digests of
+    the cases.
+    '''
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fnames = []
+        input_size = 0
+        for i in range(FILES):
+            fname = os.path.join(tmpdir, 'complex{0}.xml'.format(i))
+            xml = synthetic_complex_xml(i * CEGS_PER_FILE, CEGS_PER_FILE)
+            with open(fname, 'wb') as f:
+                f.write(xml)
+            fnames.append(fname)
+            input_size += len(xml)
+        results = {}
+        outputs = {}
+        for engine in ENGINES:
+            for writer, args in sorted(WRITERS.items()):
+                case = '{0}-{1}'.format(engine, writer)
+                output_dir = os.path.join(tmpdir, case)
+                runs = []
+                for run in range(RUNS):
+                    shutil.rmtree(output_dir, ignore_errors=True)
+                    runs.append(
+                        measure(
+                            fnames, output_dir, ['--engine', engine] + args
+                        )
+                    )
+                seconds = min(seconds for seconds, _ in runs)
+                results[case] = dict(
+                    cegs_per_second=int(FILES * CEGS_PER_FILE / seconds),
+                    mb_per_second=round(input_size / seconds / MEGABYTE, 2),
+                    peak_memory_mb=round(
+                        max(memory for _, memory in runs) / MEGABYTE, 1
+                    ),
+                )
+                outputs[case] = csv_digests(output_dir)
+                shutil.rmtree(output_dir)
+        return results, outputs
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+@skipUnless(MODE, 'COMPLEX_PERFORMANCE_TESTS is not set')
+class TestPerformance(TestCase):
+
+    # measured once for all the tests, when first needed
+    measurements = None
+
+    @classmethod
+    def measure(cls):
+        if cls.measurements is None:
+            cls.measurements = measure_cases()
+            if MODE == 'record':
+                write_baseline(cls.measurements[0])
+        return cls.measurements
+
+    def test_throughput(self):
+        results, _ = self.measure()
+        baseline = read_baseline()
+        slow = [
+            '{0}: {1} MB/s instead of {2} MB/s'.format(
+                case, result['mb_per_second'], baseline[case]['mb_per_second']
+            )
+            for case, result in sorted(results.items())
+            if result['mb_per_second']
+            < MIN_SPEED * baseline[case]['mb_per_second']
+        ]
+        self.assertEquals([], slow)
+
+    def test_peak_memory(self):
+        results, _ = self.measure()
+        baseline = read_baseline()
+        large = [
+            '{0}: {1} MB instead of {2} MB'.format(
+                case, result['peak_memory_mb'],
+                baseline[case]['peak_memory_mb']
+            )
+            for case, result in sorted(results.items())
+            if result['peak_memory_mb']
+            > MAX_MEMORY * baseline[case]['peak_memory_mb']
+        ]
+        self.assertEquals([], large)
+
+    def test_outputs_are_the_same(self):
+        _, outputs = self.measure()
+        expected = outputs['sax-csv']
+        self.assertEquals(
+            ['rovat_0', 'rovat_1', 'rovat_2'], sorted(expected)
+        )
+        for case, output in sorted(outputs.items()):
+            self.assertEquals(expected, output, case)
@@ -0,0 +1,98 @@
+from unittest import TestCase
+import os
+import tempfile
+from complex_xml_to_csvs import pipeline as module
+
+
+class Collector(object):
+
+    def __init__(self, items, next_processor=None, tag=None):
+        self.items = items
+        self.next_processor = next_processor
+        self.tag = tag
+
+    def process(self, item):
+        self.items.append((self.tag, item))
+        if self.next_processor is not None:
+            self.next_processor.process(item)
+
+
+class TestPipeline(TestCase):
+
+    def setUp(self):
+        self.registered = dict(module.STAGES)
+        self.items = []
+
+        @module.register_stage(
+            'x_tag', module.RECORDS, module.RECORDS, parameters=dict(tag=int)
+        )
+        def tag_stage(context, processor, tag=0):
+            return Collector(self.items, processor, tag)
+
+        @module.register_stage('x_batches', module.RECORDS, module.BATCHES)
+        def batches_stage(context, processor):
+            return processor
+
+        @module.register_stage('x_collect', module.RECORDS)
+        def collect_stage(context, processor):
+            return Collector(self.items, tag='end')
+
+    def tearDown(self):
+        module.STAGES.clear()
+        module.STAGES.update(self.registered)
+
+    def test_stages_are_built_in_order_with_parameters(self):
+        processor = module.build_pipeline(
+            ['x_tag:tag=1', 'x_tag:tag=2', 'x_collect'], context=None
+        )
+
+        processor.process('record')
+
+        self.assertEquals(
+            [(1, 'record'), (2, 'record'), ('end', 'record')],
+            self.items
+        )
+
+    def test_unknown_stage(self):
+        with self.assertRaises(module.InvalidPipeline):
+            module.parse_pipeline(['x_unknown', 'x_collect'])
+
+    def test_unknown_parameter(self):
+        with self.assertRaises(module.InvalidPipeline):
+            module.parse_pipeline(['x_tag:size=1', 'x_collect'])
+
+    def test_invalid_parameter_value(self):
+        with self.assertRaises(module.InvalidPipeline):
+            module.parse_pipeline(['x_tag:tag=x', 'x_collect'])
+
+    def test_item_kinds_must_match(self):
+        with self.assertRaises(module.InvalidPipeline):
+            module.parse_pipeline(['x_batches', 'x_collect'])
+
+    def test_pipeline_ends_in_a_writer(self):
+        with self.assertRaises(module.InvalidPipeline):
+            module.parse_pipeline(['x_tag'])
+        with self.assertRaises(module.InvalidPipeline):
+            module.parse_pipeline(['x_collect', 'x_tag'])
+
+    def test_read_stage_file(self):
+        fd, fname = tempfile.mkstemp()
+        try:
+            os.write(fd, '# small batches\nbatch:size=10\n\ncsv  # write\n')
+            os.close(fd)
+            self.assertEquals(
+                ['batch:size=10', 'csv'], module.read_stage_file(fname)
+            )
+        finally:
+            os.remove(fname)
+
+    def test_context_closes_in_reverse_order(self):
+        context = module.Context('x.xml', 'output', [], None)
+        closed = []
+        context.on_close(lambda: closed.append(1))
+        context.on_close(lambda: closed.append(2))
+
+        context.close()
+        context.close()
+
+        self.assertEquals([2, 1], closed)
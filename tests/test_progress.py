@@ -0,0 +1,114 @@
+from unittest import TestCase
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import mock
+from complex_xml_to_csvs import progress as module
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestProgressReporter(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.status_fname = os.path.join(self.tmpdir, 'status.json')
+        self.clock = Clock()
+        self.records = 0
+        self.reporter = module.ProgressReporter(
+            'complex.xml.gz', 4 * module.MEGABYTE, lambda: self.records,
+            interval=10, status_fname=self.status_fname, clock=self.clock
+        )
+        self.reporter.report = mock.Mock(side_effect=self.reporter.report)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def status(self):
+        with open(self.status_fname) as f:
+            return json.load(f)
+
+    def test_reports_are_throttled(self):
+        self.clock.now += 9
+        self.reporter.update(module.MEGABYTE)
+        self.assertFalse(self.reporter.report.called)
+
+        self.clock.now += 1
+        self.reporter.update(module.MEGABYTE)
+        self.clock.now += 5
+        self.reporter.update(module.MEGABYTE)
+        self.assertEquals(1, self.reporter.report.call_count)
+
+    def test_status(self):
+        self.records = 500
+        self.clock.now += 10
+        self.reporter.update(module.MEGABYTE)
+
+        self.assertEquals(
+            dict(
+                fname='complex.xml.gz',
+                done=False,
+                percent=25.0,
+                records=500,
+                records_per_second=50.0,
+                mb_per_second=0.1,
+                elapsed_seconds=10.0,
+                eta_seconds=30.0,
+            ),
+            self.status()
+        )
+
+    def test_finish_writes_the_final_status(self):
+        self.records = 2000
+        self.clock.now += 20
+        self.reporter.finish()
+
+        status = self.status()
+        self.assertTrue(status['done'])
+        self.assertEquals(100.0, status['percent'])
+        self.assertEquals(0, status['eta_seconds'])
+        self.assertEquals(2000, status['records'])
+
+    def test_eta_is_unknown_at_the_start(self):
+        self.clock.now += 10
+        self.reporter.update(0)
+
+        self.assertIsNone(self.status()['eta_seconds'])
+
+
+class TestProgressFile(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_position_of_the_compressed_file_is_reported(self):
+        fname = os.path.join(self.tmpdir, 'complex.xml.gz')
+        data = os.urandom(100000).encode('hex')
+        with gzip.open(fname, 'wb') as f:
+            f.write(data)
+        reporter = mock.Mock()
+
+        f = module.ProgressFile(gzip.open(fname, 'rb'), reporter)
+        read = ''.join(iter(lambda: f.read(16384), ''))
+        f.close()
+
+        self.assertEquals(data, read)
+        positions = [args[0] for args, _ in reporter.update.call_args_list]
+        self.assertEquals(sorted(positions), positions)
+        self.assertEquals(os.path.getsize(fname), positions[-1])
+        self.assertTrue(positions[0] < positions[-1])
+
+    def test_format_duration(self):
+        self.assertEquals('1:01:01', module.format_duration(3661.5))
@@ -1,8 +1,10 @@
 from unittest import TestCase
 import mock
+import zlib
 from complex_xml_to_csvs import record_processors as module
 from collections import defaultdict
 from complex_schema import Table, Field
+from complex_xml_to_csvs.changes import content_hash
 
 
 class TestCountLimitingRecordProcessor(TestCase):
@@ -37,6 +39,46 @@ class TestCountLimitingRecordProcessor(TestCase):
         rp.process.assert_called_once_with(mock.sentinel.document)
 
 
+class TestChangeFilteringRecordProcessor(TestCase):
+
+    def setUp(self):
+        self.unchanged = dict(ceg_id=u'1', rovat_1=[dict(a=u'x')])
+        self.changed = dict(ceg_id=u'2', rovat_1=[dict(a=u'y')])
+        self.new = dict(ceg_id=u'3', rovat_1=[dict(a=u'z')])
+        previous = {
+            u'1': content_hash(self.unchanged),
+            u'2': content_hash(dict(self.changed, rovat_1=[])),
+        }
+        self.collector = mock.Mock()
+        self.rp = module.RecordProcessor()
+        self.rp.process = mock.Mock(self.rp.process)
+        self.cfrp = module.ChangeFilteringRecordProcessor(
+            previous, self.collector, self.rp
+        )
+
+    def test_only_new_and_changed_records_are_passed_on(self):
+        for document in (self.unchanged, self.changed, self.new):
+            self.cfrp.process(document)
+
+        self.assertEquals(
+            [mock.call(self.changed), mock.call(self.new)],
+            self.rp.process.call_args_list
+        )
+        self.assertEquals(1, self.cfrp.unchanged_count)
+
+    def test_hashes_of_all_records_are_collected(self):
+        for document in (self.unchanged, self.new):
+            self.cfrp.process(document)
+
+        self.assertEquals(
+            [
+                mock.call(u'1', content_hash(self.unchanged)),
+                mock.call(u'3', content_hash(self.new)),
+            ],
+            self.collector.add.call_args_list
+        )
+
+
 class TestBatchMakerRecordProcessor(TestCase):
 
     def test_process_small_batch_adds_document_to_batch(self):
@@ -88,6 +130,24 @@ class TestBatchMakerRecordProcessor(TestCase):
         self.assertEquals([], bm.batch)
 
 
+class TestSortingBatchProcessor(TestCase):
+
+    def test_records_are_passed_on_in_ceg_id_order(self):
+        bp = module.BatchProcessor()
+        bp.process = mock.Mock(bp.process)
+        records = [
+            dict(ceg_id=u'2', n=1),
+            dict(ceg_id=u'1', n=2),
+            dict(ceg_id=u'2', n=3),
+        ]
+
+        module.SortingBatchProcessor(bp).process(list(records))
+
+        bp.process.assert_called_once_with(
+            [records[1], records[0], records[2]]
+        )
+
+
 class StringIO(object):
 
     def __init__(self):
@@ -102,6 +162,9 @@ class StringIO(object):
     def write(self, data):
         self.__content.append(str(data))
 
+    def tell(self):
+        return sum(len(data) for data in self.__content)
+
     @property
     def content(self):
         return u''.join(self.__content)
@@ -185,6 +248,35 @@ class TestCsvSplitter(TestCase):
             .content.splitlines()
         )
 
+    def test_written_files_are_recorded(self):
+        batch = [
+            {
+                'ceg_id': '110011001100',
+                'b': [
+                    {'alrovat_id': 1, 'b': 0},
+                    {'alrovat_id': 2, 'b': 'b'},
+                ],
+            },
+        ]
+
+        self.csv_splitter.process(batch)
+
+        self.assertEqual(
+            [
+                (
+                    'rovat_b',
+                    'oxtput_dir/rovat_b/ixput_fname_0000.csv',
+                    2,
+                    len(
+                        'ceg_id,alrovat_id,b\r\n'
+                        '110011001100,1,0\r\n'
+                        '110011001100,2,b\r\n'
+                    )
+                )
+            ],
+            self.csv_splitter.written
+        )
+
     def test_process_increments_batch_number(self):
         old_number = self.csv_splitter.batch_number
 
@@ -240,3 +332,159 @@ class TestCsvSplitter(TestCase):
             self.fs['oxtput_dir/rovat_a/ixput_fname_0001.csv']
             .content.splitlines()
         )
+
+
+class XCsvAppender(module.CsvAppender):
+
+    def __init__(self, input_fname, output_dir, tables, fs):
+        super(XCsvAppender, self).__init__(input_fname, output_dir, tables)
+        self.fs = fs
+
+    def batch_csv_file(self, rovat):
+        return self.fs[self.batch_csv_name(rovat)]
+
+    def needs_header(self, f):
+        return not f.content
+
+
+class TestCsvAppender(TestCase):
+
+    def table_a(self):
+        table = Table('rovat_a', 'test table a')
+        table.add(Field('a', 'a', 11, 'char'))
+        return table
+
+    def test_rows_of_all_files_go_to_the_same_table_file(self):
+        fs = defaultdict(StringIO)
+        for input_fname, ceg_id in (('in1.xml', '1'), ('in2.xml.gz', '2')):
+            appender = XCsvAppender(input_fname, 'out', [self.table_a()], fs)
+            appender.process([
+                {'ceg_id': ceg_id, 'a': [{'alrovat_id': 1, 'a': 'x'}]}
+            ])
+            appender.process([
+                {'ceg_id': ceg_id, 'a': [{'alrovat_id': 2, 'a': 'y'}]}
+            ])
+
+        self.assertEqual(['out/rovat_a.csv'], fs.keys())
+        self.assertEqual(
+            [
+                u'ceg_id,alrovat_id,a',
+                u'1,1,x',
+                u'1,2,y',
+                u'2,1,x',
+                u'2,2,y',
+            ],
+            fs['out/rovat_a.csv'].content.splitlines()
+        )
+
+
+class XPartitioningCsvAppender(module.PartitioningCsvAppender):
+
+    def __init__(self, input_fname, output_dir, tables, fs, partitions):
+        super(XPartitioningCsvAppender, self).__init__(
+            input_fname, output_dir, tables, partitions=partitions
+        )
+        self.fs = fs
+
+    def batch_csv_file(self, rovat):
+        return self.fs[self.batch_csv_name(rovat)]
+
+    def needs_header(self, f):
+        return not f.content
+
+
+class TestPartitioningCsvAppender(TestCase):
+
+    def table(self, name):
+        table = Table(name, 'test table')
+        table.add(Field('a', 'a', 11, 'char'))
+        return table
+
+    def test_partition_of_is_the_crc32_of_ceg_id(self):
+        self.assertEquals(
+            (zlib.crc32('0000000042') & 0xffffffff) % 7,
+            module.partition_of(u'0000000042', 7)
+        )
+        self.assertEquals(
+            module.partition_of('0000000042', 7),
+            module.partition_of(u'0000000042', 7)
+        )
+
+    def test_rows_of_a_ceg_are_in_the_same_partition_of_all_tables(self):
+        fs = defaultdict(StringIO)
+        appender = XPartitioningCsvAppender(
+            'in.xml', 'out', [self.table('rovat_a'), self.table('rovat_b')],
+            fs, partitions=3
+        )
+        ceg_ids = [str(ceg_id) for ceg_id in range(20)]
+        appender.process([
+            {
+                'ceg_id': ceg_id,
+                'a': [{'alrovat_id': 1, 'a': 'x'}],
+                'b': [{'alrovat_id': 1, 'a': 'y'}, {'alrovat_id': 2}],
+            }
+            for ceg_id in ceg_ids
+        ])
+
+        for partition in range(3):
+            for table, rows_per_ceg in (('rovat_a', 1), ('rovat_b', 2)):
+                lines = (
+                    fs['out/{0}.{1:03d}.csv'.format(table, partition)]
+                    .content.splitlines()
+                )
+                self.assertEquals(u'ceg_id,alrovat_id,a', lines[0])
+                self.assertEquals(
+                    [
+                        ceg_id
+                        for ceg_id in ceg_ids
+                        if module.partition_of(ceg_id, 3) == partition
+                        for _ in range(rows_per_ceg)
+                    ],
+                    [line.split(',')[0] for line in lines[1:]]
+                )
+
+
+class TestTransformingBatchProcessor(TestCase):
+
+    def test_columns_are_transformed_before_passing_the_batch_on(self):
+        calls = []
+
+        def upper(values):
+            calls.append(values)
+            return [value.upper() for value in values]
+
+        column_transforms = mock.Mock()
+        column_transforms.for_column.side_effect = (
+            lambda table_name, field_name:
+            [upper] if (table_name, field_name) == ('rovat_1', 'a') else []
+        )
+        bp = module.BatchProcessor()
+        bp.process = mock.Mock(bp.process)
+        batch = [
+            {
+                'ceg_id': '1',
+                '01': [{'alrovat_id': '1', 'a': 'x'}, {'alrovat_id': '2'}],
+                '2': [{'alrovat_id': '1', 'a': 'y'}],
+            },
+            {
+                'ceg_id': '2',
+                '1': [{'alrovat_id': '1', 'a': 'z'}],
+            },
+        ]
+
+        module.TransformingBatchProcessor(column_transforms, bp).process(batch)
+
+        self.assertEqual([['x', 'z']], calls)
+        bp.process.assert_called_once_with(
+            [
+                {
+                    'ceg_id': '1',
+                    '01': [{'alrovat_id': '1', 'a': 'X'}, {'alrovat_id': '2'}],
+                    '2': [{'alrovat_id': '1', 'a': 'y'}],
+                },
+                {
+                    'ceg_id': '2',
+                    '1': [{'alrovat_id': '1', 'a': 'Z'}],
+                },
+            ]
+        )
@@ -0,0 +1,141 @@
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+import mock
+from complex_xml_to_csvs import rovat_dir_to_csv as module
+from complex_xml_to_csvs import manifests
+
+
+HEADER = 'ceg_id,a\r\n'
+FILES = {
+    'complex1_0000.csv': HEADER + '2,"x\ny"\r\n3,b\r\n',
+    'complex1_0001.csv': HEADER + '1,c\r\n',
+}
+
+
+class TestMergeRovatDir(TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.rovat_dir = os.path.join(self.output_dir, 'rovat_1')
+        os.mkdir(self.rovat_dir)
+        for fname, content in FILES.items():
+            with open(os.path.join(self.rovat_dir, fname), 'wb') as f:
+                f.write(content)
+        manifests.write_manifest(
+            manifests.manifest_name(self.output_dir, 'complex1'),
+            [
+                (
+                    'rovat_1',
+                    os.path.join('rovat_1', fname),
+                    content.count('\r\n') - 1,
+                    len(content)
+                )
+                for fname, content in FILES.items()
+            ]
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def read(self, fname):
+        with open(os.path.join(self.output_dir, fname), 'rb') as f:
+            return f.read()
+
+    def test_files_are_concatenated_with_a_single_header(self):
+        self.assertEquals([], module.merge_rovat_dir(self.rovat_dir))
+
+        self.assertEquals(
+            HEADER + '2,"x\ny"\r\n3,b\r\n1,c\r\n',
+            self.read('rovat_1.csv')
+        )
+        self.assertFalse(os.path.exists(self.rovat_dir))
+        self.assertFalse(
+            os.path.exists(os.path.join(self.output_dir, '_manifests'))
+        )
+
+    def test_quoted_line_ends_are_not_rows(self):
+        content = HEADER + '4,"x\r\ny"\r\n'
+        with open(
+                os.path.join(self.rovat_dir, 'complex2_0000.csv'), 'wb') as f:
+            f.write(content)
+        manifests.write_manifest(
+            manifests.manifest_name(self.output_dir, 'complex2'),
+            [('rovat_1', 'rovat_1/complex2_0000.csv', 1, len(content))]
+        )
+
+        self.assertEquals([], module.merge_rovat_dir(self.rovat_dir))
+        self.assertEquals(
+            ['complex2_0000.csv', '1', str(len(content))],
+            self.read('rovat_1.csv.sha1').splitlines()[2].split('\t')[1:]
+        )
+
+    def test_checksums_are_written(self):
+        module.merge_rovat_dir(self.rovat_dir)
+
+        lines = [
+            line.split('\t')
+            for line in self.read('rovat_1.csv.sha1').splitlines()
+        ]
+        self.assertEquals(
+            [
+                ['complex1_0000.csv', '2', '24'],
+                ['complex1_0001.csv', '1', '15'],
+                ['rovat_1.csv', '3', '29'],
+            ],
+            [line[1:] for line in lines]
+        )
+
+    def test_sorted_merge(self):
+        self.assertEquals(
+            [], module.merge_rovat_dir(self.rovat_dir, sort=True)
+        )
+
+        self.assertEquals(
+            HEADER + '1,c\r\n2,"x\ny"\r\n3,b\r\n',
+            self.read('rovat_1.csv')
+        )
+
+    def test_directory_is_kept_if_a_file_is_incomplete(self):
+        with open(
+                os.path.join(self.rovat_dir, 'complex1_0000.csv'), 'wb') as f:
+            f.write(HEADER + '2,"x\ny"\r\n')
+
+        problems = module.merge_rovat_dir(self.rovat_dir)
+
+        self.assertEquals(2, len(problems))
+        self.assertTrue(os.path.isdir(self.rovat_dir))
+
+    def test_directory_is_kept_if_a_file_is_missing(self):
+        os.remove(os.path.join(self.rovat_dir, 'complex1_0001.csv'))
+
+        self.assertEquals(
+            ['rovat_1/complex1_0001.csv: missing'],
+            module.merge_rovat_dir(self.rovat_dir)[:1]
+        )
+        self.assertTrue(os.path.isdir(self.rovat_dir))
+
+    def test_different_header(self):
+        with open(
+                os.path.join(self.rovat_dir, 'complex1_0001.csv'), 'wb') as f:
+            f.write('ceg_id,b\r\n1,c\r\n')
+
+        self.assertEquals(1, len(module.merge_rovat_dir(self.rovat_dir)))
+        self.assertFalse(
+            os.path.exists(os.path.join(self.output_dir, 'rovat_1.csv'))
+        )
+
+    def test_partial_output_is_removed_on_errors(self):
+        def fail(fnames, output, **kwargs):
+            output.write(HEADER)
+            raise IOError(24, 'Too many open files')
+
+        with mock.patch.object(module.csv_sort, 'sort_merge', fail):
+            with self.assertRaises(IOError):
+                module.merge_rovat_dir(self.rovat_dir, sort=True)
+
+        self.assertFalse(
+            os.path.exists(os.path.join(self.output_dir, 'rovat_1.csv'))
+        )
+        self.assertTrue(os.path.isdir(self.rovat_dir))
@@ -0,0 +1,88 @@
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+import mock
+from complex_xml_to_csvs import schema_cache as module
+from complex_schema import Table, Field
+
+
+def tables():
+    table = Table('rovat_a', 'test table a')
+    table.add(Field('a', 'a', 11, 'char'))
+    table.add(Field('b', 'b', 8, 'date'))
+    return [table]
+
+
+class TestSchemaCache(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.xls = os.path.join(self.tmpdir, 'R_export.txt.xls')
+        with open(self.xls, 'wb') as f:
+            f.write('not really an xls')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_compiled_tables_keep_names_and_fields(self):
+        compiled_fname = os.path.join(self.tmpdir, 'schema.json')
+        table, = tables()
+        module.write_compiled([table], compiled_fname)
+
+        compiled, = module.read_compiled(compiled_fname)
+        self.assertEqual('rovat_a', compiled.name)
+        # Table has the ceg_id and alrovat_id fields too
+        self.assertEqual(
+            [field.name for field in table.fields],
+            [field.name for field in compiled.fields]
+        )
+        self.assertEqual(
+            ['ceg_id', 'alrovat_id', 'a', 'b'],
+            [field.name for field in compiled.fields]
+        )
+
+    def test_load_tables_reads_precompiled_json(self):
+        compiled_fname = os.path.join(self.tmpdir, 'schema.json')
+        module.write_compiled(tables(), compiled_fname)
+
+        with mock.patch.object(module, 'compile_schema') as compile_schema:
+            compiled, = module.load_tables(compiled_fname)
+
+        self.assertEqual('rovat_a', compiled.name)
+        self.assertFalse(compile_schema.called)
+
+    def test_load_tables_compiles_xls_only_once(self):
+        with mock.patch.object(
+                module, 'compile_schema', return_value=tables()
+        ) as compile_schema:
+            first, = module.load_tables(self.xls)
+            second, = module.load_tables(self.xls)
+
+        compile_schema.assert_called_once_with(self.xls)
+        self.assertEqual(first.name, second.name)
+        self.assertTrue(
+            os.path.exists(module.cached_name(self.xls))
+        )
+
+    def test_changed_xls_is_recompiled(self):
+        old_cached_name = module.cached_name(self.xls)
+        with open(self.xls, 'ab') as f:
+            f.write('changed')
+
+        self.assertNotEqual(old_cached_name, module.cached_name(self.xls))
+
+    def test_cache_dir(self):
+        cache_dir = os.path.join(self.tmpdir, 'cache')
+        os.mkdir(cache_dir)
+
+        with mock.patch.object(
+                module, 'compile_schema', return_value=tables()
+        ):
+            module.load_tables(self.xls, cache_dir)
+
+        self.assertEqual(
+            cache_dir,
+            os.path.dirname(module.cached_name(self.xls, cache_dir))
+        )
+        self.assertEqual(1, len(os.listdir(cache_dir)))
@@ -0,0 +1,56 @@
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+from complex_xml_to_csvs import scratch as module
+
+
+class TestPublisher(TestCase):
+
+    def setUp(self):
+        self.scratch_dir = tempfile.mkdtemp()
+        self.output_dir = tempfile.mkdtemp()
+        self.publisher = module.Publisher(self.scratch_dir, self.output_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch_dir)
+        shutil.rmtree(self.output_dir)
+
+    def write_local(self, fname, content):
+        with open(self.publisher.local_name(fname), 'wb') as f:
+            f.write(content)
+
+    def test_local_name_is_in_scratch_dir(self):
+        fname = os.path.join(self.output_dir, 'rovat_1', 'x.csv')
+
+        self.assertEquals(
+            os.path.join(self.scratch_dir, 'rovat_1', 'x.csv'),
+            self.publisher.local_name(fname)
+        )
+        self.assertTrue(
+            os.path.isdir(os.path.join(self.scratch_dir, 'rovat_1'))
+        )
+
+    def test_published_files_are_moved(self):
+        fnames = [
+            os.path.join(self.output_dir, 'rovat_{0}'.format(i), 'x.csv')
+            for i in range(5)
+        ]
+        for i, fname in enumerate(fnames):
+            self.write_local(fname, 'content {0}'.format(i))
+            self.publisher.publish(fname)
+
+        self.publisher.close()
+
+        for i, fname in enumerate(fnames):
+            with open(fname, 'rb') as f:
+                self.assertEquals('content {0}'.format(i), f.read())
+            self.assertFalse(
+                os.path.exists(self.publisher.local_name(fname))
+            )
+
+    def test_failed_moves_are_reported_on_close(self):
+        self.publisher.publish(os.path.join(self.output_dir, 'missing.csv'))
+
+        with self.assertRaises(IOError):
+            self.publisher.close()
@@ -0,0 +1,108 @@
+from unittest import TestCase
+from collections import Counter
+from cStringIO import StringIO
+import os
+import shutil
+import socket
+import tempfile
+import threading
+from complex_xml_to_csvs import service as module
+
+
+class TestConversionServer(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tmpdir, 'sock')
+        self.converted = []
+        self.server = module.ConversionServer(
+            self.socket_path, self.convert, open_file=self.open_file
+        )
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        self.server.wait_for_requests()
+        shutil.rmtree(self.tmpdir)
+
+    def open_file(self, fname):
+        if fname.endswith('missing.xml'):
+            raise IOError('No such file')
+        return StringIO('<xml of {0}/>'.format(os.path.basename(fname)))
+
+    def convert(self, name, input_source):
+        content = input_source.read()
+        self.converted.append((name, content))
+        return 'bad' not in content, Counter(records=1)
+
+    def test_convert_file(self):
+        self.assertTrue(module.convert_file(self.socket_path, 'a.xml'))
+        self.assertEquals(
+            [(os.path.abspath('a.xml'), '<xml of a.xml/>')], self.converted
+        )
+
+    def test_convert_stream(self):
+        self.assertTrue(
+            module.convert_stream(
+                self.socket_path, 'b.xml', StringIO('<ceg/>' * 1000)
+            )
+        )
+        self.assertEquals([('b.xml', '<ceg/>' * 1000)], self.converted)
+
+    def test_failed_conversion(self):
+        self.assertFalse(
+            module.convert_stream(self.socket_path, 'c.xml', StringIO('bad'))
+        )
+
+    def test_missing_file_fails(self):
+        self.assertFalse(module.convert_file(self.socket_path, 'missing.xml'))
+        self.assertEquals([], self.converted)
+
+    def test_unknown_request_fails(self):
+        connection = module.connect(self.socket_path)
+        try:
+            connection.sendall('DELETE a.xml\n')
+            self.assertFalse(module.read_reply(connection))
+        finally:
+            connection.close()
+
+    def test_report(self):
+        module.convert_file(self.socket_path, 'a.xml')
+        module.convert_stream(self.socket_path, 'c.xml', StringIO('bad'))
+        module.convert_file(self.socket_path, 'missing.xml')
+        self.assertEquals(
+            Counter(records=2, converted_files=1, failed_files=2),
+            self.server.report
+        )
+
+    def test_socket_is_removed_on_close(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        self.assertFalse(os.path.exists(self.socket_path))
+
+
+class TestRemoveStaleSocket(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_stale_socket_is_removed(self):
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.path)
+        stale.close()
+        module.remove_stale_socket(self.path)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_other_files_are_kept(self):
+        with open(self.path, 'wb') as f:
+            f.write('data')
+        module.remove_stale_socket(self.path)
+        self.assertTrue(os.path.exists(self.path))
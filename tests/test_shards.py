@@ -0,0 +1,51 @@
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+from complex_xml_to_csvs import shards as module
+
+
+class TestMergeShard(TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def write(self, fname, content):
+        dirname = os.path.dirname(fname)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(fname, 'wb') as f:
+            f.write(content)
+
+    def read(self, fname):
+        with open(os.path.join(self.output_dir, fname), 'rb') as f:
+            return f.read()
+
+    def test_shards_are_concatenated_with_a_single_header(self):
+        for sequence, row in enumerate(['1,a\r\n', '2,"b\nb"\r\n']):
+            shard_dir = module.shard_dir(self.output_dir, sequence)
+            self.write(
+                os.path.join(shard_dir, 'rovat_1.csv'),
+                'ceg_id,a\r\n' + row
+            )
+            module.merge_shard(shard_dir, self.output_dir)
+
+        self.assertEqual(
+            'ceg_id,a\r\n1,a\r\n2,"b\nb"\r\n',
+            self.read('rovat_1.csv')
+        )
+
+    def test_merged_shard_is_removed(self):
+        shard_dir = module.shard_dir(self.output_dir, 3)
+        self.write(os.path.join(shard_dir, 'rovat_2.csv'), 'ceg_id\r\n1\r\n')
+
+        module.merge_shard(shard_dir, self.output_dir)
+
+        self.assertFalse(os.path.exists(shard_dir))
+        self.assertEqual(
+            ['rovat_2.csv'],
+            module.final_csv_names(self.output_dir)
+        )
@@ -0,0 +1,83 @@
+from unittest import TestCase
+from complex_xml_to_csvs import transforms as module
+from complex_xml_to_csvs.schema_cache import CompiledTable
+
+
+def tables():
+    return [
+        CompiledTable(
+            name='rovat_1',
+            fields=[dict(name='alrovat_id'), dict(name='nev')]
+        ),
+        CompiledTable(
+            name='rovat_2',
+            fields=[dict(name='alrovat_id'), dict(name='datum')]
+        ),
+    ]
+
+
+class TestTransforms(TestCase):
+
+    def test_strip(self):
+        self.assertEqual(['a', 'b c'], module.strip([' a', 'b c\n']))
+
+    def test_utf8_values_are_stripped_as_unicode_ones(self):
+        values = [u'\xa0a\u2003', u' \xe1 ', u'\xa0\n b \xa0\n\xa0', u'']
+        utf8_values = [value.encode('utf-8') for value in values]
+
+        for transform in module.strip, module.lines, module.oneline:
+            self.assertEqual(
+                [value.encode('utf-8') for value in transform(values)],
+                transform(utf8_values)
+            )
+        self.assertEqual(['a', '\xc3\xa1'], module.strip(utf8_values[:2]))
+
+    def test_lines(self):
+        self.assertEqual(
+            ['a\nb', ''],
+            module.lines([' a \n\n b\n', ' \n'])
+        )
+
+    def test_oneline(self):
+        self.assertEqual(['a b'], module.oneline([' a \n\n b\n']))
+
+    def test_date(self):
+        self.assertEqual(
+            ['1999-12-31', '1999-12-31', '2001-02-03', 'unknown', ''],
+            module.date(['1999.12.31.', '19991231', '2001-02-03',
+                         'unknown', ''])
+        )
+
+    def test_number(self):
+        self.assertEqual(
+            ['1234.5', '-12', 'n/a', ''],
+            module.number(['1 234,5', '-12', 'n/a', ''])
+        )
+
+
+class TestColumnTransforms(TestCase):
+
+    def test_transforms_are_selected_by_table_and_field(self):
+        transforms = module.ColumnTransforms(
+            ['*=strip', 'rovat_2.datum=date', 'nev=lines,oneline'],
+            tables()
+        )
+
+        self.assertEqual(
+            [module.strip, module.date],
+            transforms.for_column('rovat_2', 'datum')
+        )
+        self.assertEqual(
+            [module.strip, module.lines, module.oneline],
+            transforms.for_column('rovat_1', 'nev')
+        )
+        self.assertEqual([], transforms.for_column('rovat_1', 'alrovat_id'))
+
+    def test_fields_are_checked_against_the_schema(self):
+        for spec in ('rovat_1.datum=date', 'rovat_9.nev=strip', 'x=strip',
+                     'nev=unknown_transform', 'nev'):
+            with self.assertRaises(module.InvalidTransformSpec):
+                module.ColumnTransforms([spec], tables())
+
+    def test_no_declaration_is_false(self):
+        self.assertFalse(module.ColumnTransforms([], tables()))
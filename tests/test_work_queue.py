@@ -0,0 +1,92 @@
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+import StringIO
+import mock
+from complex_xml_to_csvs import work_queue as module
+
+
+class TestWorkQueue(TestCase):
+
+    def setUp(self):
+        self.queue_dir = tempfile.mkdtemp()
+        self.queue = module.WorkQueue(self.queue_dir)
+        self.queue.add(['a.xml.gz', 'b.xml.gz'])
+
+    def tearDown(self):
+        shutil.rmtree(self.queue_dir)
+
+    def test_items_are_claimed_in_order(self):
+        self.assertEquals(
+            module.Item(0, 'a.xml.gz', False), self.queue.claim('w1')
+        )
+        self.assertEquals(
+            module.Item(1, 'b.xml.gz', False), self.queue.claim('w2')
+        )
+        self.assertIsNone(self.queue.claim('w1'))
+
+    def test_added_items_get_new_sequence_numbers(self):
+        item = self.queue.claim('w1')
+        self.queue.finish(item, 'w1', True)
+
+        self.queue.add(['c.xml.gz'])
+
+        self.assertEquals(
+            [1, 2],
+            [module.sequence_of(name) for name in self.queue.names('todo')]
+        )
+
+    def test_complete_when_all_items_are_finished(self):
+        first = self.queue.claim('w1')
+        second = self.queue.claim('w2')
+        self.queue.finish(first, 'w1', True)
+        self.assertFalse(self.queue.is_complete())
+
+        self.queue.finish(second, 'w2', False)
+
+        self.assertTrue(self.queue.is_complete())
+        self.assertEquals([0, 1], self.queue.finished_sequences())
+        self.assertEquals(
+            dict(todo=0, claimed=0, done=1, failed=1), self.queue.counts()
+        )
+
+    def test_only_one_merges(self):
+        self.assertTrue(self.queue.start_merge())
+        self.assertFalse(self.queue.start_merge())
+
+    def test_requeue(self):
+        self.queue.claim('w1')
+
+        self.assertEquals(0, self.queue.requeue(older_than=60))
+        self.assertEquals(1, self.queue.requeue(older_than=0))
+
+        self.assertEquals(
+            module.Item(0, 'a.xml.gz', True), self.queue.claim('w2')
+        )
+
+    def test_finish_of_a_requeued_item_is_not_recorded(self):
+        item = self.queue.claim('w1')
+        self.queue.requeue(older_than=0)
+        requeued = self.queue.claim('w2')
+        self.assertEquals(item._replace(requeued=True), requeued)
+
+        self.assertFalse(self.queue.finish(item, 'w1', True))
+
+        self.assertTrue(self.queue.finish(requeued, 'w2', False))
+        self.assertEquals(
+            dict(todo=1, claimed=0, done=0, failed=1), self.queue.counts()
+        )
+
+    def test_requeue_needs_an_age(self):
+        with mock.patch('sys.stderr', StringIO.StringIO()):
+            with self.assertRaises(SystemExit):
+                module.parse_args(['requeue', self.queue_dir])
+        self.assertEquals(
+            30, module.parse_args(
+                ['requeue', '--older-than=30', self.queue_dir]
+            ).older_than
+        )
+
+    def test_worker_name_is_unique_per_process(self):
+        self.assertTrue(module.worker_name().endswith(str(os.getpid())))